@@ -13,23 +13,147 @@
 #include "osrm/osrm.hpp"
 #include "osrm/status.hpp"
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
 #include <exception>
+#include <future>
 #include <iostream>
+#include <limits>
+#include <memory>
+#include <mutex>
+#include <optional>
 #include <string>
+#include <thread>
+#include <type_traits>
+#include <unordered_map>
 #include <utility>
+#include <vector>
 
 #include <cstdlib>
+#include <stdexcept>
 
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 
-osrm::OSRM* osrm_machine;
+namespace py = pybind11;
+
+using coordinate_array = py::array_t<double, py::array::c_style | py::array::forcecast>;
+
+// Loads each .osrm dataset once per process: concurrent initialize() calls for a
+// path share one load, and the engine stays loaded for as long as any handle to
+// it is alive. Which profiles stay resident is decided by the handles the
+// Python side (osrm_engines) keeps, the registry only holds weak references.
+//
+// Datasets load outside the registry lock: the first caller for a path
+// publishes a future and builds the engine, later callers for the same path
+// wait on that future while queries and loads on other profiles carry on.
+class EngineRegistry
+{
+    using engine_future = std::shared_future<std::shared_ptr<osrm::OSRM>>;
+
+  public:
+    std::shared_ptr<osrm::OSRM> get(const std::string &filepath)
+    {
+        std::promise<std::shared_ptr<osrm::OSRM>> promise;
+        engine_future loading;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+
+            auto found = loaded.find(filepath);
+            if (found != loaded.end())
+            {
+                if (auto engine = found->second.lock())
+                    return engine;
+                loaded.erase(found); // every handle was released
+            }
 
-void initialize(std::string filepath){
-    osrm::EngineConfig config;
-    config.storage_config = {filepath};
-    config.use_shared_memory = false;
-    config.algorithm = osrm::EngineConfig::Algorithm::CH;
-    osrm_machine = new osrm::OSRM(config);
+            auto pending = loading_engines.find(filepath);
+            if (pending != loading_engines.end())
+                loading = pending->second;
+            else
+                loading_engines[filepath] = promise.get_future().share();
+        }
+
+        if (loading.valid())
+            return loading.get(); // wait for the caller loading it
+
+        std::shared_ptr<osrm::OSRM> engine;
+        try
+        {
+            osrm::EngineConfig config;
+            config.storage_config = {filepath};
+            config.use_shared_memory = false;
+            config.algorithm = osrm::EngineConfig::Algorithm::CH;
+            engine = std::make_shared<osrm::OSRM>(config);
+        }
+        catch (...)
+        {
+            // Don't keep the failure, the next initialize retries the load
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                loading_engines.erase(filepath);
+            }
+            promise.set_exception(std::current_exception());
+            throw;
+        }
+
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            loaded[filepath] = engine;
+            loading_engines.erase(filepath);
+        }
+        promise.set_value(engine);
+        return engine;
+    }
+
+    std::vector<std::string> loaded_paths()
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        std::vector<std::string> paths;
+        for (const auto &entry : loaded)
+        {
+            if (!entry.second.expired())
+                paths.push_back(entry.first);
+        }
+        std::sort(paths.begin(), paths.end());
+        return paths;
+    }
+
+  private:
+    std::mutex mutex;
+    std::unordered_map<std::string, engine_future> loading_engines;
+    std::unordered_map<std::string, std::weak_ptr<osrm::OSRM>> loaded;
+};
+
+EngineRegistry registry;
+
+// Handle returned by initialize(). It owns a reference to its engine, so queries
+// never go back through the registry and a profile evicted from the registry
+// stays usable for as long as Python keeps the handle.
+struct Engine
+{
+    std::string filepath;
+    std::shared_ptr<osrm::OSRM> engine;
+
+    osrm::OSRM &get() const
+    {
+        if (!engine)
+            throw std::invalid_argument("engine handle for " + filepath + " is not initialized");
+        return *engine;
+    }
+};
+
+// Loads the dataset if needed and returns the handle the other bindings expect,
+// calling it again for an already resident dataset is cheap.
+Engine initialize(std::string filepath){
+    py::gil_scoped_release release;
+    return Engine{filepath, registry.get(filepath)};
+}
+
+std::vector<std::string> loaded_engines(){
+    return registry.loaded_paths();
 }
 
 // helper to extract a string from the new variant-based json
@@ -37,7 +161,7 @@ static std::string get_string(const osrm::json::Object& obj, const std::string&
     return std::get<osrm::json::String>(obj.values.at(key)).value;
 }
 
-std::string route(pybind11::list longitudes, pybind11::list latitudes)
+std::string route(const Engine &handle, pybind11::list longitudes, pybind11::list latitudes)
 {
     osrm::RouteParameters params;
 
@@ -51,8 +175,11 @@ std::string route(pybind11::list longitudes, pybind11::list latitudes)
     params.overview = osrm::RouteParameters::OverviewType::Full;
     params.geometries = osrm::RouteParameters::GeometriesType::GeoJSON;
 
+    // Inputs are converted, nothing below touches Python objects until we return
+    py::gil_scoped_release release;
+
     osrm::json::Object result;
-    const auto status = osrm_machine->Route(params, result);
+    const auto status = handle.get().Route(params, result);
 
     if (status == osrm::Status::Ok)
     {
@@ -71,13 +198,16 @@ std::string route(pybind11::list longitudes, pybind11::list latitudes)
     return "";
 }
 
-std::string nearest(float longitude, float latitude)
+std::string nearest(const Engine &handle, float longitude, float latitude)
 {
     osrm::NearestParameters params;
     params.coordinates.push_back({osrm::util::FloatLongitude{longitude}, osrm::util::FloatLatitude{latitude}});
 
+    // Inputs are converted, nothing below touches Python objects until we return
+    py::gil_scoped_release release;
+
     osrm::json::Object result;
-    const auto status = osrm_machine->Nearest(params, result);
+    const auto status = handle.get().Nearest(params, result);
 
     if (status == osrm::Status::Ok)
     {
@@ -93,7 +223,28 @@ std::string nearest(float longitude, float latitude)
     return "";
 }
 
-std::string table(pybind11::list longitudes, pybind11::list latitudes)
+// Restricts a table to the given source/destination coordinate indices, all
+// coordinates are used for a side left as None.
+static void set_table_indices(osrm::TableParameters &params,
+                              const std::optional<std::vector<std::size_t>> &sources,
+                              const std::optional<std::vector<std::size_t>> &destinations)
+{
+    for (const auto *indices : {&sources, &destinations}) {
+        if (!indices->has_value())
+            continue;
+        for (const auto index : indices->value()) {
+            if (index >= params.coordinates.size())
+                throw std::out_of_range("source/destination index " + std::to_string(index) + " is out of range");
+        }
+    }
+    if (sources)
+        params.sources = *sources;
+    if (destinations)
+        params.destinations = *destinations;
+}
+
+std::string table(const Engine &handle, pybind11::list longitudes, pybind11::list latitudes,
+                  std::optional<std::vector<std::size_t>> sources, std::optional<std::vector<std::size_t>> destinations)
 {
     osrm::TableParameters params;
 
@@ -103,10 +254,14 @@ std::string table(pybind11::list longitudes, pybind11::list latitudes)
         params.coordinates.push_back({osrm::util::FloatLongitude{longitude}, osrm::util::FloatLatitude{latitude}});
     }
 
+    set_table_indices(params, sources, destinations);
     params.annotations = osrm::TableParameters::AnnotationsType::All;
 
+    // Inputs are converted, nothing below touches Python objects until we return
+    py::gil_scoped_release release;
+
     osrm::json::Object result;
-    const auto status = osrm_machine->Table(params, result);
+    const auto status = handle.get().Table(params, result);
 
     if (status == osrm::Status::Ok)
     {
@@ -125,12 +280,300 @@ std::string table(pybind11::list longitudes, pybind11::list latitudes)
     return "";
 }
 
-namespace py = pybind11;
+template <typename Parameters>
+static void add_coordinates(Parameters &params, const coordinate_array &longitudes, const coordinate_array &latitudes)
+{
+    if (longitudes.ndim() != 1 || latitudes.ndim() != 1 || longitudes.size() != latitudes.size())
+        throw std::invalid_argument("longitudes and latitudes must be 1-d arrays of the same length");
+
+    const auto lons = longitudes.unchecked<1>();
+    const auto lats = latitudes.unchecked<1>();
+    params.coordinates.reserve(lons.shape(0));
+    for (py::ssize_t index = 0; index < lons.shape(0); index++) {
+        params.coordinates.push_back({osrm::util::FloatLongitude{lons(index)}, osrm::util::FloatLatitude{lats(index)}});
+    }
+}
+
+static double get_number(const osrm::json::Value &value)
+{
+    const auto *number = std::get_if<osrm::json::Number>(&value);
+    return number ? number->value : std::numeric_limits<double>::quiet_NaN();
+}
+
+// Copies a durations/distances annotation into a row-major buffer, unreachable
+// pairs (null in the response) become NaN.
+static void copy_matrix(const osrm::json::Object &result, const std::string &key, double *out, std::size_t cols)
+{
+    const auto &rows = std::get<osrm::json::Array>(result.values.at(key)).values;
+    for (std::size_t row = 0; row < rows.size(); row++) {
+        const auto &values = std::get<osrm::json::Array>(rows[row]).values;
+        for (std::size_t col = 0; col < cols; col++) {
+            out[row * cols + col] = get_number(values[col]);
+        }
+    }
+}
+
+// Writes the snapped [lat, lon] location and snap distance of each waypoint,
+// waypoint i goes to slot positions[i] when positions are given.
+static void copy_waypoints(const osrm::json::Object &result, const std::string &key, double *locations, double *distances,
+                           const std::vector<std::size_t> *positions = nullptr)
+{
+    const auto &waypoints = std::get<osrm::json::Array>(result.values.at(key)).values;
+    for (std::size_t index = 0; index < waypoints.size(); index++) {
+        const auto &waypoint = std::get<osrm::json::Object>(waypoints[index]);
+        const auto &location = std::get<osrm::json::Array>(waypoint.values.at("location")).values;
+        const std::size_t slot = positions ? (*positions)[index] : index;
+        locations[2 * slot] = get_number(location[1]);
+        locations[2 * slot + 1] = get_number(location[0]);
+        distances[slot] = get_number(waypoint.values.at("distance"));
+    }
+}
+
+// Same query as table() but reads the result straight into NumPy arrays instead
+// of rendering and re-parsing JSON. Returns (durations, distances, snapped, snap_distances)
+// where the matrices are (sources x destinations) and snapped holds the [lat, lon]
+// of every coordinate, NaN for coordinates that are neither source nor destination.
+// A side left as None covers every coordinate, so only a query given both index
+// lists can leave coordinates NaN.
+py::tuple table_arrays(const Engine &handle, const coordinate_array &longitudes, const coordinate_array &latitudes,
+                       std::optional<std::vector<std::size_t>> sources, std::optional<std::vector<std::size_t>> destinations)
+{
+    osrm::TableParameters params;
+    add_coordinates(params, longitudes, latitudes);
+    set_table_indices(params, sources, destinations);
+    params.annotations = osrm::TableParameters::AnnotationsType::All;
+
+    osrm::json::Object result;
+    osrm::Status status;
+    {
+        py::gil_scoped_release release;
+        status = handle.get().Table(params, result);
+    }
+
+    if (status != osrm::Status::Ok)
+    {
+        throw std::runtime_error(get_string(result, "code") + ": " + get_string(result, "message"));
+    }
+
+    const std::size_t size = params.coordinates.size();
+    const std::size_t rows = sources ? sources->size() : size;
+    const std::size_t cols = destinations ? destinations->size() : size;
+    py::array_t<double> durations({rows, cols});
+    py::array_t<double> distances({rows, cols});
+    py::array_t<double> snapped({size, static_cast<std::size_t>(2)});
+    py::array_t<double> snap_distances(static_cast<py::ssize_t>(size));
+
+    copy_matrix(result, "durations", durations.mutable_data(), cols);
+    copy_matrix(result, "distances", distances.mutable_data(), cols);
+    if (destinations)
+    {
+        std::fill_n(snapped.mutable_data(), 2 * size, std::numeric_limits<double>::quiet_NaN());
+        std::fill_n(snap_distances.mutable_data(), size, std::numeric_limits<double>::quiet_NaN());
+    }
+    // A side left as None holds every coordinate, in order
+    copy_waypoints(result, "destinations", snapped.mutable_data(), snap_distances.mutable_data(), destinations ? &params.destinations : nullptr);
+    copy_waypoints(result, "sources", snapped.mutable_data(), snap_distances.mutable_data(), sources ? &params.sources : nullptr);
+
+    return py::make_tuple(durations, distances, snapped, snap_distances);
+}
+
+// Snaps every coordinate in one call, returning (lats, lons, distances) of the
+// nearest road positions. Coordinates the engine can't snap are NaN in all three.
+py::tuple nearest_many(const Engine &handle, const coordinate_array &longitudes, const coordinate_array &latitudes)
+{
+    if (longitudes.ndim() != 1 || latitudes.ndim() != 1 || longitudes.size() != latitudes.size())
+        throw std::invalid_argument("longitudes and latitudes must be 1-d arrays of the same length");
+
+    const auto lons = longitudes.unchecked<1>();
+    const auto lats = latitudes.unchecked<1>();
+    const py::ssize_t size = lons.shape(0);
+
+    py::array_t<double> snapped_lats(size);
+    py::array_t<double> snapped_lons(size);
+    py::array_t<double> distances(size);
+    double *out_lats = snapped_lats.mutable_data();
+    double *out_lons = snapped_lons.mutable_data();
+    double *out_distances = distances.mutable_data();
+
+    {
+        py::gil_scoped_release release;
+        auto &engine = handle.get();
+
+        for (py::ssize_t index = 0; index < size; index++) {
+            osrm::NearestParameters params;
+            params.coordinates.push_back({osrm::util::FloatLongitude{lons(index)}, osrm::util::FloatLatitude{lats(index)}});
+
+            double location[2] = {std::numeric_limits<double>::quiet_NaN(), std::numeric_limits<double>::quiet_NaN()};
+            double distance = std::numeric_limits<double>::quiet_NaN();
+
+            osrm::json::Object result;
+            if (engine.Nearest(params, result) == osrm::Status::Ok)
+                copy_waypoints(result, "waypoints", location, &distance);
+
+            out_lats[index] = location[0];
+            out_lons[index] = location[1];
+            out_distances[index] = distance;
+        }
+    }
+
+    return py::make_tuple(snapped_lats, snapped_lons, distances);
+}
+
+// Converts a json value to the matching Python object (dict, list, float, ...).
+static py::object to_python(const osrm::json::Value &value)
+{
+    return std::visit([](const auto &item) -> py::object {
+        using T = std::decay_t<decltype(item)>;
+        if constexpr (std::is_same_v<T, osrm::json::String>)
+            return py::str(item.value);
+        else if constexpr (std::is_same_v<T, osrm::json::Number>)
+            return py::float_(item.value);
+        else if constexpr (std::is_same_v<T, osrm::json::Object>)
+        {
+            py::dict dict;
+            for (const auto &entry : item.values)
+                dict[py::str(entry.first)] = to_python(entry.second);
+            return dict;
+        }
+        else if constexpr (std::is_same_v<T, osrm::json::Array>)
+        {
+            py::list list;
+            for (const auto &element : item.values)
+                list.append(to_python(element));
+            return list;
+        }
+        else if constexpr (std::is_same_v<T, osrm::json::True>)
+            return py::bool_(true);
+        else if constexpr (std::is_same_v<T, osrm::json::False>)
+            return py::bool_(false);
+        else
+            return py::none();
+    }, value);
+}
+
+// Reads the GeoJSON overview of a route into a (k, 2) array of [lon, lat],
+// empty when no overview was requested.
+static py::array_t<double> copy_geometry(const osrm::json::Object &route)
+{
+    const auto found = route.values.find("geometry");
+    if (found == route.values.end())
+        return py::array_t<double>({static_cast<std::size_t>(0), static_cast<std::size_t>(2)});
+
+    const auto &geometry = std::get<osrm::json::Object>(found->second);
+    const auto &points = std::get<osrm::json::Array>(geometry.values.at("coordinates")).values;
+    py::array_t<double> coordinates({points.size(), static_cast<std::size_t>(2)});
+    double *out = coordinates.mutable_data();
+    for (std::size_t index = 0; index < points.size(); index++) {
+        const auto &point = std::get<osrm::json::Array>(points[index]).values;
+        out[2 * index] = get_number(point[0]);
+        out[2 * index + 1] = get_number(point[1]);
+    }
+    return coordinates;
+}
+
+// Computes many independent routes on a pool of native threads. Each route is
+// given as one entry of longitudes/latitudes (sequences of waypoints). Returns a
+// list with, per route, a dict holding the geometry as a (k, 2) array of
+// [lon, lat], duration and distance, plus the legs when steps or annotations
+// are requested. Routes the engine can't compute are None.
+py::list route_many(const Engine &handle, py::list longitudes, py::list latitudes,
+                    bool steps, const std::string &overview, bool annotations, unsigned int threads)
+{
+    if (longitudes.size() != latitudes.size())
+        throw std::invalid_argument("longitudes and latitudes must hold the same number of routes");
+
+    osrm::RouteParameters::OverviewType overview_type;
+    if (overview == "full")
+        overview_type = osrm::RouteParameters::OverviewType::Full;
+    else if (overview == "simplified")
+        overview_type = osrm::RouteParameters::OverviewType::Simplified;
+    else if (overview == "false")
+        overview_type = osrm::RouteParameters::OverviewType::False;
+    else
+        throw std::invalid_argument("overview must be one of 'full', 'simplified' or 'false'");
+
+    std::vector<osrm::RouteParameters> queries(longitudes.size());
+    for (std::size_t index = 0; index < queries.size(); index++) {
+        auto &params = queries[index];
+        add_coordinates(params, longitudes[index].cast<coordinate_array>(), latitudes[index].cast<coordinate_array>());
+        params.steps = steps;
+        params.overview = overview_type;
+        params.geometries = osrm::RouteParameters::GeometriesType::GeoJSON;
+        if (annotations)
+        {
+            params.annotations = true;
+            params.annotations_type = osrm::RouteParameters::AnnotationsType::All;
+        }
+    }
+
+    std::vector<osrm::json::Object> results(queries.size());
+    std::vector<char> succeeded(queries.size(), false); // not vector<bool>, threads write neighbouring entries
+    {
+        py::gil_scoped_release release;
+        auto &engine = handle.get();
+
+        std::atomic<std::size_t> next{0};
+        auto work = [&]() {
+            for (std::size_t index = next++; index < queries.size(); index = next++) {
+                try {
+                    succeeded[index] = queries[index].coordinates.size() > 1 &&
+                                       engine.Route(queries[index], results[index]) == osrm::Status::Ok;
+                } catch (const std::exception &) {
+                    succeeded[index] = false;
+                }
+            }
+        };
+
+        if (threads == 0)
+            threads = std::max(1u, std::thread::hardware_concurrency());
+        threads = static_cast<unsigned int>(std::min<std::size_t>(threads, queries.size()));
+
+        std::vector<std::thread> pool;
+        for (unsigned int thread = 1; thread < threads; thread++)
+            pool.emplace_back(work);
+        work();
+        for (auto &thread : pool)
+            thread.join();
+    }
+
+    py::list routes;
+    for (std::size_t index = 0; index < results.size(); index++) {
+        if (!succeeded[index])
+        {
+            routes.append(py::none());
+            continue;
+        }
+        const auto &best = std::get<osrm::json::Object>(std::get<osrm::json::Array>(results[index].values.at("routes")).values.at(0));
+        py::dict route;
+        route["geometry"] = copy_geometry(best);
+        route["duration"] = get_number(best.values.at("duration"));
+        route["distance"] = get_number(best.values.at("distance"));
+        if (steps || annotations)
+            route["legs"] = to_python(best.values.at("legs"));
+        routes.append(route);
+    }
+    return routes;
+}
 
 PYBIND11_MODULE(osrmbindings, m) {
     m.doc() = "OSRM Bindings";
+    py::class_<Engine>(m, "Engine", "Handle to a loaded dataset, pass it as first argument to the queries")
+        .def_readonly("filepath", &Engine::filepath)
+        .def("__repr__", [](const Engine &engine) { return "<osrmbindings.Engine '" + engine.filepath + "'>"; });
     m.def("route", &route, "Route binding");
-    m.def("table", &table, "Table binding");
+    m.def("route_many", &route_many, "Route binding over many waypoint sequences, computed in parallel, returns a list of dicts with NumPy geometry",
+          py::arg("handle"), py::arg("longitudes"), py::arg("latitudes"), py::arg("steps") = false,
+          py::arg("overview") = "full", py::arg("annotations") = false, py::arg("threads") = 0);
+    m.def("table", &table, "Table binding, optionally restricted to source/destination coordinate indices",
+          py::arg("handle"), py::arg("longitudes"), py::arg("latitudes"), py::arg("sources") = py::none(),
+          py::arg("destinations") = py::none());
+    m.def("table_arrays", &table_arrays, "Table binding returning (durations, distances, snapped, snap_distances) NumPy arrays, "
+          "the matrices are (sources x destinations) when index subsets are given",
+          py::arg("handle"), py::arg("longitudes"), py::arg("latitudes"), py::arg("sources") = py::none(),
+          py::arg("destinations") = py::none());
     m.def("nearest", &nearest, "Nearest binding");
-    m.def("initialize", &initialize, "Initialize engine, necessary before the other functions are usable");
+    m.def("nearest_many", &nearest_many, "Nearest binding over coordinate arrays, returns (lats, lons, distances) NumPy arrays",
+          py::arg("handle"), py::arg("longitudes"), py::arg("latitudes"));
+    m.def("initialize", &initialize, "Load the engine for a dataset (once per process) and return its handle");
+    m.def("loaded_engines", &loaded_engines, "Sorted dataset paths of the engines a handle still holds");
 }
\ No newline at end of file
@@ -9,16 +9,18 @@ import math
 import pandas as pd
 import logging
 import numpy as np
-import copy
 from config.config_manager import ConfigManager
 from config.gps_input_data import GPSInputData
 from output.cleaned_node_data import CleanedNodeData
 import time #looking at runtime
-import ujson
 import osrmbindings
+import osrm_engines
+import matrix_cache
 import elevation_utils
 
 verbose = False
+unreachable_cost = 10000000 # Stored in the integer matrices for pairs OSRM found no route between (or that weren't computed)
+colocated_precision = 6 # Decimal places of lat/long below which nodes share one OSRM query location, 6 is about 0.1 meter
 
 class NodeData:
     """Container for all nodes, clean and removed/flagged. Keeps information
@@ -47,6 +49,13 @@ class NodeData:
     veh_time_osrmmatrix_dict=None
     veh_dist_osrmmatrix_dict=None
     veh_elevation_cost_osrmmatrix_dict=None
+
+    #name -> rows and zone -> rows indexes, built once per df_gps_verbose
+    _indexed_df = None
+    _name_rows = None
+    _first_name_rows = None
+    _duplicated_names = None
+    _zone_rows = None
     
     def __init__(self, df_gps, df_bad_gps=None, veh_time_osrmmatrix_dict=None, veh_dist_osrmmatrix_dict=None, veh_elevation_cost_osrmmatrix_dict=None):
         """
@@ -77,7 +86,7 @@ class NodeData:
         #make sure time/dist array sizes line up correctly with number of nodes 
         if veh_time_osrmmatrix_dict != None:
             for key, this_orsm_mat in veh_time_osrmmatrix_dict.items():
-                array_shape = this_orsm_mat.time_dist_mat.shape
+                array_shape = this_orsm_mat.shape
                 num_rows = array_shape[0]
                 num_cols = array_shape[1]
                 if (num_rows != self.df_gps_verbose.shape[0]) or (num_cols != self.df_gps_verbose.shape[0])\
@@ -88,7 +97,7 @@ class NodeData:
             
         if veh_dist_osrmmatrix_dict != None:
             for key, this_orsm_mat in veh_dist_osrmmatrix_dict.items():
-                array_shape = this_orsm_mat.time_dist_mat.shape
+                array_shape = this_orsm_mat.shape
                 num_rows = array_shape[0]
                 num_cols = array_shape[1]
                 if (num_rows != self.df_gps_verbose.shape[0]) or (num_cols != self.df_gps_verbose.shape[0])\
@@ -99,7 +108,7 @@ class NodeData:
         
         if veh_elevation_cost_osrmmatrix_dict != None:
             for key, this_orsm_mat in veh_elevation_cost_osrmmatrix_dict.items():
-                array_shape = this_orsm_mat.time_dist_mat.shape
+                array_shape = this_orsm_mat.shape
                 num_rows = array_shape[0]
                 num_cols = array_shape[1]
                 if (num_rows != self.df_gps_verbose.shape[0]) or (num_cols != self.df_gps_verbose.shape[0])\
@@ -122,31 +131,11 @@ class NodeData:
             NodeData instance for subset of nodes
         """
         
-        #create a boolean series of wanted rows, initialize all to False
-        bool_filter_good = pd.Series([False]*self.df_gps_verbose.shape[0], index = self.df_gps_verbose.index)
         bad_df = self.df_bad_gps_verbose
         if bad_df is None:
             bad_df = self.df_gps_verbose.iloc[:0, :].copy()
-        bool_filter_bad = pd.Series([False]*bad_df.shape[0], index=bad_df.index)
-
-        for label, val_list in dict_filter.items():
-            
-            #if single, convert to list
-            if isinstance(val_list, str):
-                val_list = [val_list]
-            
-            #iterate through all values
-            for val in val_list:
-                if (label in ['start', 'end']) or ('unload' in label):
-                    label = 'name'
-                #create a boolean series from wanted rows for this selection
-                this_bool_filter_good = self.df_gps_verbose[label] == val
-                this_bool_filter_bad = bad_df[label] == val
-            
-                #Do an element-wise OR between global mask and this one
-                bool_filter_good = bool_filter_good | this_bool_filter_good
-                bool_filter_bad = bool_filter_bad | this_bool_filter_bad
-    
+        bool_filter_good = self.get_indexed_filter_mask(dict_filter)
+        bool_filter_bad = self.get_filter_mask(bad_df, dict_filter)
     
         #select the subtable of time/dist matrices
         veh_time_osrmmatrix_dict_new = {}
@@ -157,7 +146,7 @@ class NodeData:
             veh_time_osrmmatrix_dict_new[veh] = OSRMMatrix.get_filtered_osrm_mat(this_orsm_mat, bool_filter_good)
         for veh, this_orsm_mat in self.veh_dist_osrmmatrix_dict.items():
             veh_dist_osrmmatrix_dict_new[veh] = OSRMMatrix.get_filtered_osrm_mat(this_orsm_mat, bool_filter_good)
-        for veh, this_orsm_mat in self.veh_elevation_cost_osrmmatrix_dict.items():
+        for veh, this_orsm_mat in (self.veh_elevation_cost_osrmmatrix_dict or {}).items():
             veh_elevation_cost_osrmmatrix_dict_new[veh] = OSRMMatrix.get_filtered_osrm_mat(this_orsm_mat, bool_filter_good)
 
 
@@ -179,6 +168,249 @@ class NodeData:
         return filtered_node_data
     
         
+    def apply_delta(self, added_df=None, removed_names=None, num_containers_default=3, elevation_factor=100, max_dist=300):
+        """
+        Updates the nodes after customers are added or removed without recomputing
+        everything from process_nodes. Rows/columns of removed nodes are dropped and
+        only the rows/columns of added nodes are queried from OSRM. Added nodes go
+        through the same cleaning and snapping checks as in NodeLoader.
+
+        Args:
+            added_df (pd dataframe, default None): new nodes, must contain all columns in
+            NodeData.standard_columns, an added node replaces a node of the same name
+            removed_names (list of str, default None): names of the nodes to remove
+            num_containers_default (int, default 3): buckets assumed for added customers without any
+            elevation_factor (int, default 100): as in NodeLoader, used if elevation costs were computed
+            max_dist (int or float, default 300): as in NodeLoader.clean_snapped_nodes
+        Returns:
+            NodeData instance with the updated nodes and matrices
+        """
+        profiles = list(self.veh_time_osrmmatrix_dict.keys())
+        if added_df is None:
+            added_df = self.df_gps_verbose.iloc[:0]
+        added_df = added_df.dropna(subset=[self.node_name]).copy()
+        added_df[self.node_name] = added_df[self.node_name].astype(str)
+
+        #Added nodes are cleaned like NodeLoader does
+        bad_dfs = [] if self.df_bad_gps_verbose is None else [self.df_bad_gps_verbose]
+        kept, flagged_dfs = NodeLoader.evaluate_cleaning_rules(added_df, NodeLoader.cleaning_rules)
+        bad_dfs.extend(flagged_dfs)
+        added_df = added_df[kept].copy()
+        added_coords = added_df[[self.lat_orig, self.long_orig]].to_numpy(dtype=np.float64)
+        for veh in profiles:
+            lats, lons, dists = osrmbindings.nearest_many(osrm_engines.get_engine(veh), np.ascontiguousarray(added_coords[:,1]),
+                                                          np.ascontiguousarray(added_coords[:,0]))
+            added_df[f'lat_snapped_{veh}'] = lats
+            added_df[f'long_snapped_{veh}'] = lons
+            added_df[f'snapped_dist_{veh}'] = dists
+        kept, flagged_dfs = NodeLoader.evaluate_cleaning_rules(added_df, NodeLoader.get_snapping_rules(added_df, profiles, max_dist))
+        bad_dfs.extend(flagged_dfs)
+        added_df = added_df[kept].copy()
+        added_df.loc[(added_df[self.node_type] == 'Customer') & (added_df[self.buckets] == 0), self.buckets] = num_containers_default
+
+        removed = set(str(name) for name in (removed_names or [])) | set(added_df[self.node_name])
+        kept_rows = np.flatnonzero(~pd.Series(self.names).astype(str).isin(removed).to_numpy())
+        df_gps_new = pd.concat([self.df_gps_verbose.iloc[kept_rows], added_df], ignore_index=True, sort=False)
+        df_bad_gps_new = pd.concat(bad_dfs, sort=False) if len(bad_dfs) > 0 else None
+        new_rows = np.arange(len(kept_rows), df_gps_new.shape[0])
+        nodes = NodeData(df_gps_new)
+        lat_long_coords = np.asarray(nodes.lat_long_coords, dtype=np.float64)
+        zones = df_gps_new[self.zone].to_numpy()
+
+        #Position of the old nodes in the new ones, -1 for removed nodes
+        new_positions = np.full(self.df_gps_verbose.shape[0], -1)
+        new_positions[kept_rows] = np.arange(len(kept_rows))
+
+        veh_matrix_dicts = ({}, {}, {})
+        for veh in profiles:
+            snapped_gps_coords = np.full((df_gps_new.shape[0], 2), np.nan)
+            snapped_gps_coords[:len(kept_rows)] = self.get_snapped_gps_coords(veh)[kept_rows]
+            snapped_gps_coords[new_rows] = added_df[[f'lat_snapped_{veh}', f'long_snapped_{veh}']].to_numpy(dtype=np.float64)
+
+            old_matrices = [self.get_time_or_dist_mat(veh, time_or_dist) for time_or_dist in ('time', 'dist', 'elevation')]
+            if isinstance(old_matrices[0], MatrixBlocks):
+                #Added nodes join the blocks holding nodes of their zone, the others get a block of their own
+                old_blocks = [[block for block in matrix.blocks] if matrix is not None else None for matrix in old_matrices]
+                blocks = ([], [], [])
+                unassigned = np.ones(len(new_rows), dtype=bool)
+                for idx, (block_positions, _) in enumerate(old_blocks[0]):
+                    mapped = new_positions[block_positions]
+                    kept_local = np.flatnonzero(mapped >= 0)
+                    block_zones = pd.Series(zones[mapped[kept_local]]).dropna().unique()
+                    joining = np.isin(zones[new_rows], block_zones)
+                    unassigned &= ~joining
+                    extended = NodeLoader.extend_matrices(
+                        veh, lat_long_coords, snapped_gps_coords, mapped[kept_local], new_rows[joining],
+                        [None if matrix_blocks is None else matrix_blocks[idx][1][np.ix_(kept_local, kept_local)] for matrix_blocks in old_blocks],
+                        elevation_factor)
+                    for matrix_blocks, matrix in zip(blocks, extended[1:]):
+                        matrix_blocks.append((extended[0], matrix))
+                if unassigned.any():
+                    extended = NodeLoader.extend_matrices(veh, lat_long_coords, snapped_gps_coords, np.array([], dtype=int), new_rows[unassigned],
+                                                          [None if matrix is None else np.zeros((0, 0)) for matrix in old_matrices], elevation_factor)
+                    for matrix_blocks, matrix in zip(blocks, extended[1:]):
+                        matrix_blocks.append((extended[0], matrix))
+                matrices = [MatrixBlocks(df_gps_new.shape[0], matrix_blocks) if old_matrix is not None else None
+                            for matrix_blocks, old_matrix in zip(blocks, old_matrices)]
+            else:
+                old_block = np.ix_(kept_rows, kept_rows)
+                extended = NodeLoader.extend_matrices(veh, lat_long_coords, snapped_gps_coords, np.arange(len(kept_rows)), new_rows,
+                                                      [None if matrix is None else np.asarray(matrix)[old_block] for matrix in old_matrices],
+                                                      elevation_factor)
+                matrices = extended[1:]
+
+            for veh_matrix_dict, matrix in zip(veh_matrix_dicts, matrices):
+                if matrix is not None:
+                    veh_matrix_dict[veh] = OSRMMatrix(nodes, matrix, snapped_gps_coords)
+
+        updated_node_data = NodeData(df_gps_new, df_bad_gps_new, *veh_matrix_dicts)
+        if hasattr(self, 'past_adjustments'):
+            updated_node_data.past_adjustments = self.past_adjustments
+        return updated_node_data
+
+    @staticmethod
+    def get_filter_mask(df, dict_filter):
+        """
+        Selects the rows of a node dataframe matching a filter.
+
+        Args:
+            df (pd dataframe): node dataframe, e.g. df_gps_verbose
+            dict_filter (dict): filter as passed to filter_nodedata
+        Returns:
+            Boolean pd series, True for selected rows
+        """
+        #create a boolean series of wanted rows, initialize all to False
+        bool_filter = pd.Series([False]*df.shape[0], index=df.index)
+
+        for label, val_list in dict_filter.items():
+            
+            #if single, convert to list
+            if isinstance(val_list, str):
+                val_list = [val_list]
+            
+            #iterate through all values
+            for val in val_list:
+                if (label in ['start', 'end']) or ('unload' in label):
+                    label = 'name'
+                #Do an element-wise OR between global mask and this selection
+                bool_filter = bool_filter | (df[label] == val)
+
+        return bool_filter
+
+    def get_indexed_filter_mask(self, dict_filter):
+        """
+        Same as get_filter_mask over the clean nodes, with name and zone filters
+        served from the node index instead of comparing every row.
+
+        Args:
+            dict_filter (dict): filter as passed to filter_nodedata
+        Returns:
+            Numpy array of bools, True for selected rows
+        """
+        name_rows, zone_rows = self._node_index()
+        bool_filter = np.zeros(self.df_gps_verbose.shape[0], dtype=bool)
+        other_filters = {}
+        for label, val_list in dict_filter.items():
+            if isinstance(val_list, str):
+                val_list = [val_list]
+            if (label in ['start', 'end', self.node_name]) or ('unload' in label):
+                for val in np.asarray(val_list).astype(str):
+                    bool_filter[name_rows.get(val, [])] = True
+            elif label == self.zone:
+                for val in val_list:
+                    bool_filter[zone_rows.get(val, [])] = True
+            else:
+                other_filters[label] = val_list
+
+        if len(other_filters) > 0:
+            bool_filter |= self.get_filter_mask(self.df_gps_verbose, other_filters).to_numpy()
+        return bool_filter
+
+    def _node_index(self):
+        """
+        Builds the name -> rows and zone -> rows indexes of the clean nodes,
+        again only when df_gps_verbose has been replaced.
+
+        Args:
+            None
+        Returns:
+            dict of name: numpy array of row positions,
+            dict of zone: numpy array of row positions
+        """
+        if self._indexed_df is not self.df_gps_verbose:
+            rows = np.arange(self.df_gps_verbose.shape[0])
+            names = self.df_gps_verbose[self.node_name].astype(str).values
+            self._name_rows = pd.Series(rows).groupby(names).indices
+            first_name_rows = pd.Series(rows, index=names)
+            duplicated = first_name_rows.index.duplicated()
+            self._first_name_rows = first_name_rows[~duplicated]
+            self._duplicated_names = set(first_name_rows.index[duplicated])
+            self._zone_rows = pd.Series(rows).groupby(self.df_gps_verbose[self.zone].values).indices
+            self._indexed_df = self.df_gps_verbose
+        return self._name_rows, self._zone_rows
+
+    def rows_for_names(self, names):
+        """
+        Gets the row positions of nodes by name, one row per name. Names shared
+        by several clean nodes raise ValueError, use filter_nodedata to select
+        all of them.
+
+        Args:
+            names (list or array of str): node names
+        Returns:
+            Numpy array of row positions, in the order of names
+        """
+        self._node_index()
+        names = np.asarray(names).astype(str)
+        rows = self._first_name_rows.reindex(names)
+        if rows.isna().any():
+            raise Exception(f'Unknown node names: {list(names[rows.isna().to_numpy()])}')
+        duplicated = sorted(self._duplicated_names.intersection(names))
+        if len(duplicated) > 0:
+            raise ValueError(f'Node names shared by several nodes: {duplicated}')
+        return rows.to_numpy(dtype=int)
+
+    def rows_for_zones(self, zones):
+        """
+        Gets the row positions of the nodes in zones.
+
+        Args:
+            zones (str or list of str): zone names
+        Returns:
+            Numpy array of row positions, sorted
+        """
+        _, zone_rows = self._node_index()
+        if isinstance(zones, str):
+            zones = [zones]
+        rows = [zone_rows[zone] for zone in zones if zone in zone_rows]
+        if len(rows) == 0:
+            return np.array([], dtype=int)
+        return np.unique(np.concatenate(rows))
+
+    @staticmethod
+    def get_zone_config_filter(zone_config):
+        """
+        Builds the filter selecting the nodes a zone config is solved over:
+        its optimized region plus start/end points, or the unload points
+        when unloading is enabled.
+
+        Args:
+            zone_config (dict): zone config from the routing config
+        Returns:
+            dict filter to pass to filter_nodedata
+        """
+        if zone_config.get('enable_unload'):
+            all_start_end_options = []
+            for v in zone_config['unload_vehicles']:
+                all_start_end_options.extend(v[2:])
+            dict_filter = {f'unload_{idx}': v for idx, v in enumerate(set(all_start_end_options))}
+            dict_filter['zone'] = zone_config['optimized_region']
+            return dict_filter
+
+        return {'zone': zone_config['optimized_region'],
+                'start': zone_config['Start_Point'],
+                'end': zone_config['End_Point']}
+
     def get_time_or_dist_mat(self, veh, time_or_dist='time'):
         """
         Gets time or distance matrix.
@@ -189,13 +421,16 @@ class NodeData:
             or distance matrix. If 'time', time matrix is returned. If 'dist',
             distance matrix is returned. 'elevation' is also an option
         Returns:
-            Numpy array of time or dist matrix
+            Numpy array (int32) of time or dist matrix, None for elevation if it wasn't computed
         """
         if time_or_dist == 'time':
             return self.veh_time_osrmmatrix_dict[veh].time_dist_mat
         elif time_or_dist == 'dist':
             return self.veh_dist_osrmmatrix_dict[veh].time_dist_mat
         elif time_or_dist == 'elevation':
+            #Only computed when a zone considers elevation
+            if veh not in (self.veh_elevation_cost_osrmmatrix_dict or {}):
+                return None
             return self.veh_elevation_cost_osrmmatrix_dict[veh].time_dist_mat
         else:
             raise Exception('Please provide appropriate time_or_dist variable.')
@@ -329,6 +564,29 @@ class NodeData:
             if f_path_bad != None:
                 self.df_bad_gps_verbose.to_csv(f_path_bad, columns=self.standard_columns_bad, index=False)
 
+    def write_matrices_to_file(self, f_path):
+        """Writes the time, distance and elevation cost matrices and snapped GPS coordinates
+        of every vehicle profile to a .npz file, so manual edits can be evaluated without
+        querying OSRM again. Matrices computed per zone are written block by block.
+
+        Args:
+            f_path (str or pathlib.Path): Filename where the matrices are to be written.
+        Returns:
+            None
+        """
+        arrays = {'names': np.asarray(self.names, dtype=str), 'lat_long_coords': np.asarray(self.lat_long_coords, dtype=np.float64)}
+        for time_or_dist, osrm_mat_dict in (('time', self.veh_time_osrmmatrix_dict), ('dist', self.veh_dist_osrmmatrix_dict),
+                                            ('elevation', self.veh_elevation_cost_osrmmatrix_dict)):
+            for veh, osrm_mat in (osrm_mat_dict or {}).items():
+                matrix = osrm_mat.time_dist_mat
+                blocks = matrix.blocks if isinstance(matrix, MatrixBlocks) else [(np.arange(matrix.shape[0]), matrix)]
+                for idx, (positions, block) in enumerate(blocks):
+                    arrays[f'{time_or_dist}/{veh}/{idx}/positions'] = positions
+                    arrays[f'{time_or_dist}/{veh}/{idx}/matrix'] = np.asarray(block)
+                arrays[f'snapped/{veh}'] = osrm_mat.snapped_gps_coords
+        with open(f_path, 'wb') as opened:
+            np.savez(opened, **arrays)
+
     def __reduce__(self):
         """Helps with pickling."""
         return (NodeData, (self.df_gps_verbose, self.df_bad_gps_verbose, self.veh_time_osrmmatrix_dict, self.veh_dist_osrmmatrix_dict, self.veh_elevation_cost_osrmmatrix_dict))
@@ -345,6 +603,18 @@ class NodeLoader:
     #pd dataframe to hold removed and flagged nodes
     df_bad_gps_verbose = pd.DataFrame(data=None, columns=NodeData.standard_columns_bad)
     
+    #Checks run by clean_nodes, see apply_cleaning_rules. Register new checks here
+    #as (flag label, remove node, function of the node dataframe selecting the nodes)
+    cleaning_rules = [
+        #Remove points with closed contracts
+        ('Removed - Contract Closed', True, lambda df: df[NodeData.closed] == 1.0),
+        #Drop any point that do not have a GPS coordinate and store tham in the bad points
+        ('Removed - No GPS Coordinates', True, lambda df: df[NodeData.lat_orig].isna() | df[NodeData.long_orig].isna()),
+        #Flag any 'customer' point with no buckets
+        ('Flagged - No containers at location', False,
+         lambda df: (df[NodeData.node_type] == 'Customer') & (df[NodeData.buckets] == 0)),
+    ]
+
     #dictionaries with key:val pairs as vehicle profile string: OSRMMatrix object 
     #veh_time_osrmmatrix_dict = {}
     #veh_dist_osrmmatrix_dict = {}
@@ -354,10 +624,15 @@ class NodeLoader:
                  config_manager: ConfigManager,
                  zone_configs=None,
                  num_containers_default=3,
-                 elevation_factor=100):
+                 elevation_factor=100,
+                 memmap_matrices=False,
+                 matrix_folder=None):
         """Initializes the NodeData class.
             Args:
                 OSRM time/dist matrices
+                memmap_matrices (bool, default False): back the matrices with .npy files in
+                matrix_folder instead of holding them in RAM, for city-scale inputs
+                matrix_folder (str or pathlib.Path, default None): where the .npy files are written
             Returns:
                 None
         """
@@ -437,8 +712,16 @@ class NodeLoader:
         self.df_gps_verbose['name'] = self.df_gps_verbose['name'].astype(str)
 
         #Clean customer data
-        self.clean_nodes(max_dist=300)
-        #self.clean_nodes()
+        self.clean_nodes()
+
+        #Query the matrices for all vehicle profiles, the same pass snaps every node
+        #so snapping problems are flagged from its output before nodes are committed.
+        #Zones are solved separately, so only the block of nodes each zone config uses is queried
+        veh_matrices = NodeLoader.query_veh_matrices(
+            config_manager, NodeData(self.df_gps_verbose).lat_long_coords, elevation_factor=elevation_factor, consider_elevation=self.consider_elevation,
+            blocks=NodeLoader.get_zone_blocks(self.df_gps_verbose, zone_configs)
+        )
+        veh_matrices = self.clean_snapped_nodes(veh_matrices, max_dist=300)
 
         #Backfill number of buckets to be max
         self.df_gps_verbose.loc[(self.df_gps_verbose['type'] == 'Customer') & (self.df_gps_verbose['buckets'] == 0), 'buckets'] = num_containers_default
@@ -446,132 +729,298 @@ class NodeLoader:
 
         #Build the time and distance matrices for all vehicle profiles
         nodes = NodeData(self.df_gps_verbose)
+        if memmap_matrices and matrix_folder is None:
+            logging.warning('memmap_matrices is set but there is no matrix folder, matrices are kept in memory')
         self.veh_time_osrmmatrix_dict, self.veh_dist_osrmmatrix_dict, self.veh_elevation_cost_osrmmatrix_dict = NodeLoader.build_veh_matrices(
-            config_manager=config_manager, nodes=nodes, elevation_factor=elevation_factor, consider_elevation=self.consider_elevation
+            config_manager=config_manager, nodes=nodes, veh_matrices=veh_matrices,
+            matrix_folder=matrix_folder if memmap_matrices else None
         )
 
     @staticmethod
-    def build_veh_matrices(config_manager, nodes, elevation_factor=100, consider_elevation = False):
+    def get_zone_blocks(df_gps, zone_configs):
+        """
+        Finds the node positions each zone config is solved over, nodes not used
+        by any zone config are grouped in one extra block so all get snapped.
+
+        Args:
+            df_gps (pd dataframe): clean nodes
+            zone_configs (list of dict): zone configs from the routing config
+        Returns:
+            List of position arrays, None if a single block would hold every node
+        """
+        if not zone_configs:
+            return None
+
+        blocks = []
+        for zone_config in zone_configs:
+            positions = np.flatnonzero(NodeData.get_filter_mask(df_gps, NodeData.get_zone_config_filter(zone_config)).values)
+            blocks.append(positions)
+
+        #Largest first so repeated and contained blocks are skipped
+        blocks.sort(key=len, reverse=True)
+        unique_blocks = []
+        for positions in blocks:
+            if len(positions) > 0 and not any(np.isin(positions, other).all() for other in unique_blocks):
+                unique_blocks.append(positions)
+
+        covered = np.zeros(df_gps.shape[0], dtype=bool)
+        for positions in unique_blocks:
+            covered[positions] = True
+        if not covered.all():
+            unique_blocks.append(np.flatnonzero(~covered))
+
+        if len(unique_blocks) <= 1:
+            return None
+        return unique_blocks
+
+    @staticmethod
+    def query_veh_matrices(config_manager, lat_long_coords, elevation_factor=100, consider_elevation=False, blocks=None):
+        """
+        Queries OSRM once per vehicle profile for matrices and snapped locations.
+
+        Args:
+            config_manager (ConfigManager): provides the vehicle profiles
+            lat_long_coords (nx2 numpy array): lat-long coordinates of the nodes
+            blocks (list of int arrays, default None): node positions to query matrices for,
+            if None the matrices cover all pairs of nodes
+        Returns:
+            dict of vehicle profile: (durations, distances, elevations, snapped_gps_coords, snapped_dists),
+            matrices are MatrixBlocks when blocks are given
+        """
+        veh_matrices = {}
+        for veh in config_manager.get_build_parameters().get_vehicle_profiles():
+            if blocks is None:
+                veh_matrices[veh] = NodeLoader.get_matrices(lat_long_coords, veh, consider_elevation=consider_elevation, factor=elevation_factor)
+                continue
+
+            size = lat_long_coords.shape[0]
+            duration_blocks, distance_blocks, elevation_blocks = [], [], []
+            snapped_gps_coords = np.full((size, 2), np.nan)
+            snapped_dists = np.full(size, np.nan)
+            for positions in blocks:
+                durations, distances, elevations, block_snapped_gps_coords, block_snapped_dists = NodeLoader.get_matrices(
+                    lat_long_coords[positions], veh, consider_elevation=consider_elevation, factor=elevation_factor)
+                duration_blocks.append((positions, durations))
+                distance_blocks.append((positions, distances))
+                if elevations is not None:
+                    elevation_blocks.append((positions, elevations))
+                snapped_gps_coords[positions] = block_snapped_gps_coords
+                snapped_dists[positions] = block_snapped_dists
+
+            veh_matrices[veh] = (MatrixBlocks(size, duration_blocks), MatrixBlocks(size, distance_blocks),
+                                 MatrixBlocks(size, elevation_blocks) if consider_elevation else None, snapped_gps_coords, snapped_dists)
+        return veh_matrices
+
+    @staticmethod
+    def build_veh_matrices(config_manager, nodes, elevation_factor=100, consider_elevation = False, veh_matrices=None, matrix_folder=None):
+        if veh_matrices is None:
+            veh_matrices = NodeLoader.query_veh_matrices(config_manager, nodes.lat_long_coords, elevation_factor=elevation_factor, consider_elevation=consider_elevation)
         veh_time_osrmmatrix_dict = {}
         veh_dist_osrmmatrix_dict = {}
         veh_elevation_cost_osrmmatrix_dict = {}
-        for veh in config_manager.get_build_parameters().get_vehicle_profiles():
-            durations, distances, elevations, snapped_gps_coords = NodeLoader.get_matrices(nodes.lat_long_coords, veh, consider_elevation=consider_elevation, factor=elevation_factor)
+        for veh, (durations, distances, elevations, snapped_gps_coords, _) in veh_matrices.items():
+            #Stored as whole seconds/meters, the same values the solver callbacks used to truncate to
+            durations, distances, elevations = compact_matrix(durations), compact_matrix(distances), compact_matrix(elevations)
+            if matrix_folder is not None:
+                durations = memmap_matrix(durations, os.path.join(matrix_folder, f'time_matrix_{veh}'))
+                distances = memmap_matrix(distances, os.path.join(matrix_folder, f'dist_matrix_{veh}'))
+                elevations = memmap_matrix(elevations, os.path.join(matrix_folder, f'elevation_matrix_{veh}'))
             veh_time_osrmmatrix_dict[veh] = OSRMMatrix(nodes, durations, snapped_gps_coords)
             veh_dist_osrmmatrix_dict[veh] = OSRMMatrix(nodes, distances, snapped_gps_coords)
-            veh_elevation_cost_osrmmatrix_dict[veh] = OSRMMatrix(nodes, elevations, snapped_gps_coords)
+            if elevations is not None:
+                veh_elevation_cost_osrmmatrix_dict[veh] = OSRMMatrix(nodes, elevations, snapped_gps_coords)
         return veh_time_osrmmatrix_dict, veh_dist_osrmmatrix_dict, veh_elevation_cost_osrmmatrix_dict
 
-    def clean_nodes(self, max_dist=None):
+    def clean_nodes(self):
         """
         Cleans all the node data. Data cleaning includes removing nodes
         whose contracts closed, dropping points without GPS coordinates
-        and and checking to see that the snapped location is within a
-        threshold distance.
+        and flagging customers without containers. Snapping checks happen
+        afterwards in clean_snapped_nodes, from the matrix query output.
         
         Args:
-            max_dist (int or float, default None): Maximum distance in meters to
-            flag for snapped locations too far from original point. If None,
-            max distance is not checked as part of the data cleaning.
+            None
         Returns:
             None
         """
         
         #Remove lines without a customer id
         self.df_gps_verbose.dropna(subset=[NodeData.node_name], inplace=True)
-        
-        #Remove points with closed contracts
-        # if self.df_gps_verbose[NodeData.cust_contract_close_date].dtypes == datetime.datetime:
-        # 	close_contact_index = self.df_gps_verbose[(self.df_gps_verbose[NodeData.cust_contract_close_date] < datetime.datetime.today())].index
-        # elif self.df_gps_verbose[NodeData.cust_contract_close_date].dtypes == float:
-        # 	close_contact_index = self.df_gps_verbose[(self.df_gps_verbose[NodeData.cust_contract_close_date] == 1.0)].index
-        close_contact_index = self.df_gps_verbose[(self.df_gps_verbose[NodeData.closed] == 1.0)].index
-        temp_contract_closed_df = self.df_gps_verbose.drop(close_contact_index)
-        self.flag_nodes(temp_contract_closed_df, 'Removed - Contract Closed')
-        
-        #Drop any point that do not have a GPS coordinate and store tham in the bad points
-        temp_no_coords_df = self.df_gps_verbose.dropna(subset=[NodeData.lat_orig, NodeData.long_orig])
-        self.flag_nodes(temp_no_coords_df, 'Removed - No GPS Coordinates')
-                
-        #Flag any 'customer' point with no buckets
-        temp_no_buckets_df = self.df_gps_verbose.drop(self.df_gps_verbose[(self.df_gps_verbose[NodeData.node_type] == 'Customer') & (self.df_gps_verbose[NodeData.buckets] == 0)].index)
-        self.flag_nodes(temp_no_buckets_df, 'Flagged - No containers at location', remove_node=False)
-        
-        #If doing a check of snapped locations
-        if max_dist != None and max_dist > 0:
 
-            flagged_indices = []
-            removed_indices = []           
-            
-            for profile in self.config_manager.get_build_parameters().get_vehicle_profiles():
-                veh = profile
-                osrmbindings.initialize(f"/opt/{veh}/{os.environ['osm_filename']}")
-                snapped_lat_profile = []
-                snapped_long_profile = []
-                snapped_dist_profile = []
-            
-                for index, df_row in self.df_gps_verbose.iterrows():
-                    osrm_nearest_response = osrmbindings.nearest(df_row[NodeData.long_orig], df_row[NodeData.lat_orig])
-                    osrm_nearest_response = ujson.loads(osrm_nearest_response)
-                
-                    if osrm_nearest_response['code'] == "Ok":
-                        snapped_lat_profile.append(osrm_nearest_response['waypoints'][0]['location'][1])
-                        snapped_long_profile.append(osrm_nearest_response['waypoints'][0]['location'][0])
-                        snapped_dist_profile.append(osrm_nearest_response['waypoints'][0]['distance'])
-                        
-                        if max_dist != None:
-                            if osrm_nearest_response['waypoints'][0]['distance'] > max_dist:
-                                flagged_indices.append(index)
-                    
-                    else:
-                        snapped_lat_profile.append(None)
-                        snapped_long_profile.append(None)
-                        snapped_dist_profile.append(None)
-                        removed_indices.append(index)
-                    
-                #Add profile snapped GPS coordinates to df
-                self.df_gps_verbose[f'lat_snapped_{veh}'] = snapped_lat_profile
-                self.df_gps_verbose[f'long_snapped_{veh}'] = snapped_long_profile
-                self.df_gps_verbose[f'snapped_dist_{veh}'] = snapped_dist_profile
-        
-            try:
-                removed_indices_series = pd.Series(removed_indices).value_counts()
-                flagged_indices_series = pd.Series(flagged_indices).value_counts()
-            
-                removed_indices = removed_indices_series[removed_indices_series>1].index.to_list()
-                flagged_indices = flagged_indices_series[flagged_indices_series>1].index.to_list()
-            
-                #Remove nodes with bad server code
-                temp_bad_code_df = self.df_gps_verbose.drop(index=removed_indices)
-                self.flag_nodes(temp_bad_code_df, 'Removed - Bad Server Code')
-
-                #Flag nodes with distance too great
-                temp_too_far_df = self.df_gps_verbose.drop(index=flagged_indices)
-                self.flag_nodes(temp_too_far_df, 'Flagged - Snapped node location too far from original GPS coordinates.', remove_node=False)
-            except:
-                logging.error("Could not remove problematic customer nodes")
-                
-        
-        
-    def flag_nodes(self, new_df, flag_label, remove_node=True):
-        """Flags nodes that encountered any issues.
+        self.apply_cleaning_rules(self.cleaning_rules)
+
+    def clean_snapped_nodes(self, veh_matrices, max_dist=None):
+        """
+        Uses the snapped locations returned with the matrices to remove nodes
+        the server could not snap and flag nodes whose snapped location is
+        too far from the original point. Matrices are cut down to the nodes
+        that remain.
+
+        Args:
+            veh_matrices (dict): output of query_veh_matrices for the current nodes
+            max_dist (int or float, default None): Maximum distance in meters to
+            flag for snapped locations too far from original point. If None,
+            max distance is not checked as part of the data cleaning.
+        Returns:
+            veh_matrices for the remaining nodes
+        """
+        queried_index = self.df_gps_verbose.index
+
+        for veh, (_, _, _, snapped_gps_coords, snapped_dists) in veh_matrices.items():
+            #Add profile snapped GPS coordinates to df
+            self.df_gps_verbose[f'lat_snapped_{veh}'] = snapped_gps_coords[:,0]
+            self.df_gps_verbose[f'long_snapped_{veh}'] = snapped_gps_coords[:,1]
+            self.df_gps_verbose[f'snapped_dist_{veh}'] = snapped_dists
+
+        try:
+            self.apply_cleaning_rules(self.get_snapping_rules(self.df_gps_verbose, list(veh_matrices), max_dist))
+        except (KeyError, ValueError) as error:
+            #Missing or malformed snapping columns, the nodes are kept as they are
+            logging.error(f"Could not remove problematic customer nodes: {error!r}")
+
+        #Drop the rows/columns of removed nodes
+        kept = queried_index.get_indexer(self.df_gps_verbose.index)
+        if len(kept) == len(queried_index):
+            return veh_matrices
+
+        def take(matrix):
+            if matrix is None:
+                return None
+            if isinstance(matrix, MatrixBlocks):
+                return matrix.subset(kept)
+            return matrix[np.ix_(kept, kept)]
+
+        return {veh: (take(durations), take(distances), take(elevations), snapped_gps_coords[kept], snapped_dists[kept])
+                for veh, (durations, distances, elevations, snapped_gps_coords, snapped_dists) in veh_matrices.items()}
+
+    def apply_cleaning_rules(self, rules):
+        """Flags nodes that encountered any issues. All rules are evaluated over the
+        nodes in one pass, the matched nodes are added to the removed/flagged nodes
+        with a single concat and removed nodes are dropped once.
         
         Args:
-            new_df (pandas Dataframe): Filtered Dataframe object containing nodes
-            NOT flagged for removal or inspection.
-            flag_label (str): Label for the issue with this node
+            rules (list of tuples): see evaluate_cleaning_rules
         Returns:
             None
         """
-        bad_indices_mask = ~self.df_gps_verbose.index.isin(new_df.index)
-        if True in bad_indices_mask:
-            removed_df = self.df_gps_verbose[bad_indices_mask].copy()
-            removed_df[NodeData.flag] = pd.Series(flag_label, index = removed_df.index)
-            self.df_bad_gps_verbose = pd.concat([self.df_bad_gps_verbose, removed_df], sort=False)
+        df = self.df_gps_verbose
+        kept, bad_dfs = self.evaluate_cleaning_rules(df, rules)
+
+        if len(bad_dfs) > 0:
+            self.df_bad_gps_verbose = pd.concat([self.df_bad_gps_verbose] + bad_dfs, sort=False)
+        if not kept.all():
             #Now, actually remove the rows
-            if remove_node:
-                self.df_gps_verbose.drop(index = removed_df.index, inplace=True)
+            self.df_gps_verbose.drop(index=df.index[~kept], inplace=True)
                 
+    @staticmethod
+    def evaluate_cleaning_rules(df, rules):
+        """Evaluates cleaning rules over a node dataframe.
+
+        Args:
+            df (pandas Dataframe): nodes to check
+            rules (list of tuples): (flag label, remove node, rule) where rule is a function
+            of the node dataframe returning a boolean series, True for nodes with the issue,
+            and remove node is False for nodes that are only flagged for inspection. Rules
+            are applied in order, a node removed by a rule is not checked by later ones.
+        Returns:
+            Numpy array of bools, False for removed nodes,
+            list of dataframes of the matched nodes with their flag
+        """
+        kept = np.ones(df.shape[0], dtype=bool)
+        bad_dfs = []
+        for flag_label, remove_node, rule in rules:
+            matched = np.asarray(rule(df), dtype=bool) & kept
+            if matched.any():
+                bad_dfs.append(df[matched].assign(**{NodeData.flag: flag_label}))
+                if remove_node:
+                    kept &= ~matched
+        return kept, bad_dfs
+
+    @staticmethod
+    def get_snapping_rules(df, profiles, max_dist=None):
+        """Cleaning rules for nodes the server could not snap or snapped too far,
+        from the snapped_dist_<profile> columns. Nodes are removed/flagged when
+        more than one profile has the problem, unsnappable nodes have NaN distances.
+
+        Args:
+            df (pandas Dataframe): nodes with snapped distance columns
+            profiles (list of str): vehicle profiles
+            max_dist (int or float, default None): see clean_snapped_nodes
+        Returns:
+            list of rules, see evaluate_cleaning_rules
+        """
+        snapped_dists = df[[f'snapped_dist_{veh}' for veh in profiles]]
+        snapping_rules = [
+            ('Removed - Bad Server Code', True, lambda df: snapped_dists.isna().sum(axis=1) > 1)
+        ]
+        if max_dist != None and max_dist > 0:
+            snapping_rules.append(('Flagged - Snapped node location too far from original GPS coordinates.', False,
+                                   lambda df: (snapped_dists > max_dist).sum(axis=1) > 1))
+        return snapping_rules
+
+    @staticmethod
+    def extend_matrices(veh, lat_long_coords, snapped_gps_coords, old_positions, added_positions, old_matrices, elevation_factor=100):
+        """
+        Builds the matrices between nodes from the matrices between some of them,
+        querying OSRM only for the rows and columns of the others.
+
+        Args:
+            veh (str): vehicle profile
+            lat_long_coords (nx2 np array): locations of all nodes
+            snapped_gps_coords (nx2 np array): snapped locations of all nodes, NaN if they can't be snapped
+            old_positions (np array of ints): positions of the nodes old_matrices are between
+            added_positions (np array of ints): positions of the nodes to query
+            old_matrices (list): time, distance and elevation (or None) matrices between old_positions
+            elevation_factor (int, default 100): as in get_matrices
+        Returns:
+            positions of the nodes (old then added), their time, distance and elevation (or None) int32 matrices
+        """
+        positions = np.concatenate([old_positions, added_positions]).astype(int)
+        if len(added_positions) == 0:
+            return (positions,) + tuple(old_matrices)
+
+        size = len(positions)
+        old_size = len(old_positions)
+        latitudes = np.ascontiguousarray(lat_long_coords[positions, 0])
+        longitudes = np.ascontiguousarray(lat_long_coords[positions, 1])
+        durations = np.full((size, size), np.nan)
+        distances = np.full((size, size), np.nan)
+        durations[:old_size, :old_size] = old_matrices[0]
+        distances[:old_size, :old_size] = old_matrices[1]
+
+        #A node the server can't snap fails the whole table, their rows/columns are left unreachable
+        snappable = np.flatnonzero(~np.isnan(snapped_gps_coords[positions, 0]))
+        block = np.ix_(snappable, snappable)
+        snappable_durations, snappable_distances = durations[block], distances[block]
+        snappable_gps_coords, snappable_dists = np.full((len(snappable), 2), np.nan), np.full(len(snappable), np.nan)
+        snappable_latitudes, snappable_longitudes = latitudes[snappable], longitudes[snappable]
+
+        #Only added nodes with pairs the cache doesn't have are queried
+        cache = matrix_cache.get_cache(veh)
+        if cache is not None:
+            cache.lookup(snappable_latitudes, snappable_longitudes, snappable_durations, snappable_distances, snappable_gps_coords, snappable_dists)
+        added = np.flatnonzero(snappable >= old_size)
+        missing = added[np.isnan(snappable_durations[added, :]).any(axis=1) | np.isnan(snappable_durations[:, added]).any(axis=0)]
+        NodeLoader.query_table(osrm_engines.get_engine(veh), snappable_longitudes, snappable_latitudes, missing,
+                               snappable_durations, snappable_distances, snappable_gps_coords, snappable_dists)
+        if cache is not None and len(missing) > 0:
+            cache.store(snappable_latitudes, snappable_longitudes, missing, snappable_durations, snappable_distances, snappable_gps_coords, snappable_dists)
+        durations[block], distances[block] = snappable_durations, snappable_distances
+
+        elevations = None
+        if old_matrices[2] is not None:
+            elevations = np.full((size, size), np.nan)
+            elevations[:old_size, :old_size] = old_matrices[2]
+            padding = 0.02 # as in get_matrices
+            elevation_utils.download_elevation_data((min(latitudes)-padding, max(latitudes)+padding, min(longitudes)-padding, max(longitudes)+padding))
+            added_rows = np.arange(old_size, size)
+            elevation_costs = elevation_utils.compute_elevation_costs(veh, longitudes, latitudes, sources=added_rows)
+            elevation_costs += elevation_utils.compute_elevation_costs(veh, longitudes, latitudes, sources=np.arange(old_size), destinations=added_rows)
+            elevations[old_size:, :] = durations[old_size:, :] + elevation_factor*elevation_costs[old_size:, :]
+            elevations[:, old_size:] = durations[:, old_size:] + elevation_factor*elevation_costs[:, old_size:]
+
+        return positions, compact_matrix(durations), compact_matrix(distances), compact_matrix(elevations)
+
     def get_nodedata(self):
         """
         Creates a NodeData instance from variables of the NodeLoader class.
@@ -594,19 +1043,59 @@ class NodeLoader:
         Returns:
             durations (np array): time matrix
             distances (np array): distance matrix
+            elevations (np array): elevation cost matrix, None unless consider_elevation
             snapped_gps_coords (np array): snapped gps coordinates
+            snapped_dists (np array): distance in meters from each node to its snapped location, NaN if it could not be snapped
         """
-        osrmbindings.initialize(f"/opt/{veh}/{os.environ['osm_filename']}")
+        engine = osrm_engines.get_engine(veh)
+
+        #Co-located nodes (unload copies of a depot, customers in one building) are
+        #queried once and expanded back to one row/column per node at the end
+        lat_long_coords = np.asarray(lat_long_coords, dtype=np.float64)
+        _, first_positions, node_to_location = np.unique(
+            np.round(lat_long_coords, colocated_precision), axis=0, return_index=True, return_inverse=True)
+        colocated = len(first_positions) < len(lat_long_coords)
+        if colocated:
+            lat_long_coords = lat_long_coords[first_positions]
+            node_to_location = node_to_location.reshape(-1)
+
+        latitudes = np.ascontiguousarray(lat_long_coords[:,0], dtype=np.float64)
+        longitudes = np.ascontiguousarray(lat_long_coords[:,1], dtype=np.float64)
 
-        latitudes = lat_long_coords[:,0].tolist()
-        longitudes = lat_long_coords[:,1].tolist()
+        size = len(latitudes)
+        durations = np.full((size, size), np.nan)
+        distances = np.full((size, size), np.nan)
+        snapped_gps_coords = np.full((size, 2), np.nan)
+        snapped_dists = np.full(size, np.nan)
 
-        response = osrmbindings.table(longitudes, latitudes)
-        parsed = ujson.loads(response)
+        #Only the rows/columns of locations the cache doesn't fully cover are queried
+        missing = np.arange(size)
+        cache = matrix_cache.get_cache(veh)
+        if cache is not None:
+            missing = cache.lookup(latitudes, longitudes, durations, distances, snapped_gps_coords, snapped_dists)
+            logging.info(f'Matrix cache for {veh}: {size - len(missing)} of {size} locations cached')
+
+        if len(missing) > 0:
+            try:
+                NodeLoader.query_table(engine, longitudes, latitudes, missing, durations, distances, snapped_gps_coords, snapped_dists)
+            except RuntimeError:
+                #A single node the server can't snap fails the whole table, so find those
+                #and query the others, their rows and columns are left as NaN
+                logging.warning(f'Table query failed for {veh}, retrying without unsnappable nodes')
+                _, _, missing_snapped_dists = osrmbindings.nearest_many(engine, longitudes[missing], latitudes[missing])
+                snappable = np.setdiff1d(np.arange(size), missing[np.isnan(missing_snapped_dists)])
+                block = np.ix_(snappable, snappable)
+                snappable_durations, snappable_distances = durations[block], distances[block]
+                snappable_gps_coords, snappable_dists = snapped_gps_coords[snappable], snapped_dists[snappable]
+                NodeLoader.query_table(engine, longitudes[snappable], latitudes[snappable], np.flatnonzero(np.isin(snappable, missing)),
+                                       snappable_durations, snappable_distances, snappable_gps_coords, snappable_dists)
+                durations[block], distances[block] = snappable_durations, snappable_distances
+                snapped_gps_coords[snappable], snapped_dists[snappable] = snappable_gps_coords, snappable_dists
 
-        durations = np.array(parsed["durations"])
-        distances = np.array(parsed["distances"])
-        elevations = (durations*0)+1
+            if cache is not None:
+                cache.store(latitudes, longitudes, missing, durations, distances, snapped_gps_coords, snapped_dists)
+
+        elevations = None
         
         if consider_elevation:
             padding = 0.02 # should catch road segments that extend beyond the bounding box of locations 
@@ -614,58 +1103,231 @@ class NodeLoader:
             elevation_utils.download_elevation_data(bounding_box)
             elevation_output = elevation_utils.compute_elevation_costs(veh, longitudes, latitudes)
             elevations = durations + (factor * elevation_output)
-            
-        snapped_gps_coords = [source["location"] for source in parsed["sources"]]
-        snapped_gps_coords = np.fliplr(snapped_gps_coords)
 
-        return durations, distances, elevations, snapped_gps_coords
+        if colocated:
+            expand = np.ix_(node_to_location, node_to_location)
+            return (durations[expand], distances[expand], None if elevations is None else elevations[expand],
+                    snapped_gps_coords[node_to_location], snapped_dists[node_to_location])
+        return durations, distances, elevations, snapped_gps_coords, snapped_dists
 
     @staticmethod
-    def from_clean_gps_node_data(config_manager, node_data_df) -> NodeData:
+    def query_table(engine, longitudes, latitudes, missing, durations, distances, snapped_gps_coords, snapped_dists):
+        """
+        Queries OSRM for the rows and columns of some locations and writes them
+        into the given arrays, the rest of the arrays is left as is.
+
+        Args:
+            engine (osrmbindings.Engine): handle from osrm_engines.get_engine
+            longitudes, latitudes (np arrays): all locations
+            missing (np array of ints): positions of the locations to query
+            durations, distances (nxn np arrays): matrices to fill in
+            snapped_gps_coords (nx2 np array), snapped_dists (np array): snapping to fill in
+        Returns:
+            None
+        """
+        if len(missing) == 0:
+            return
+
+        known = np.setdiff1d(np.arange(len(latitudes)), missing)
+        if len(known) == 0:
+            durations[:], distances[:], snapped_gps_coords[:], snapped_dists[:] = osrmbindings.table_arrays(engine, longitudes, latitudes)
+            return
+
+        missing_durations, missing_distances, missing_gps_coords, missing_dists = osrmbindings.table_arrays(
+            engine, longitudes, latitudes, sources=missing.tolist())
+        durations[missing, :] = missing_durations
+        distances[missing, :] = missing_distances
+        snapped_gps_coords[missing] = missing_gps_coords[missing]
+        snapped_dists[missing] = missing_dists[missing]
+
+        known_durations, known_distances, _, _ = osrmbindings.table_arrays(
+            engine, longitudes, latitudes, sources=known.tolist(), destinations=missing.tolist())
+        durations[np.ix_(known, missing)] = known_durations
+        distances[np.ix_(known, missing)] = known_distances
+
+    @staticmethod
+    def from_clean_gps_node_data(config_manager, node_data_df, matrices_path=None, blocks=None) -> NodeData:
         """
         Create a NodeData object from a loaded pre-cleaned dataframe
+
+        Args:
+            config_manager (ConfigManager): provides the vehicle profiles
+            node_data_df (pd dataframe): clean nodes
+            matrices_path (str, default None): matrices written by NodeData.write_matrices_to_file,
+            reused instead of querying OSRM when the file exists
+            blocks (list of int arrays, default None): node positions that need matrices between
+            them (e.g. one per route), if None all pairs of nodes are needed
+        Returns:
+            NodeData object
         """
+        nodes = NodeData(node_data_df)
+        veh_matrices = None
+        if matrices_path is not None and os.path.exists(matrices_path):
+            veh_matrices = NodeLoader.load_veh_matrices(config_manager, nodes, matrices_path, blocks=blocks)
+        elif blocks is not None:
+            veh_matrices = NodeLoader.query_veh_matrices(config_manager, nodes.lat_long_coords, blocks=blocks)
         veh_time_osrmmatrix_dict, veh_dist_osrmmatrix_dict, veh_elevation_cost_osrmmatrix_dict = NodeLoader.build_veh_matrices(
-            config_manager=config_manager, nodes=NodeData(node_data_df)
+            config_manager=config_manager, nodes=nodes, veh_matrices=veh_matrices
         )
         return NodeData(node_data_df, None, veh_time_osrmmatrix_dict, veh_dist_osrmmatrix_dict, veh_elevation_cost_osrmmatrix_dict)
 
+    @staticmethod
+    def load_veh_matrices(config_manager, nodes, matrices_path, blocks=None, elevation_factor=100):
+        """
+        Loads the matrices written by NodeData.write_matrices_to_file for the nodes,
+        matching them by name and location. Only blocks of nodes the file has no
+        matrix for are queried from OSRM, e.g. routes with nodes that are new or moved.
+
+        Args:
+            config_manager (ConfigManager): provides the vehicle profiles
+            nodes (NodeData): clean nodes
+            matrices_path (str): .npz file to load
+            blocks (list of int arrays, default None): node positions that need matrices between
+            them, if None all pairs of nodes are needed
+            elevation_factor (int, default 100): as in get_matrices, used for blocks queried
+            when the file holds elevation costs
+        Returns:
+            dict of vehicle profile: (durations, distances, elevations, snapped_gps_coords, None)
+            as in query_veh_matrices, matrices are MatrixBlocks and elevations is None
+            when the file holds no elevation costs for the profile
+        """
+        size = len(nodes.names)
+        if blocks is None:
+            blocks = [np.arange(size)]
+        lat_long_coords = np.asarray(nodes.lat_long_coords, dtype=np.float64)
+
+        with np.load(matrices_path) as saved:
+            saved_arrays = {key: saved[key] for key in saved.files}
+
+        #Saved position of each node, -1 if it's new or was moved
+        saved_names = pd.Series(np.arange(len(saved_arrays['names'])), index=saved_arrays['names'])
+        saved_names = saved_names[~saved_names.index.duplicated()]
+        saved_positions = saved_names.reindex(np.asarray(nodes.names, dtype=str)).fillna(-1).to_numpy(dtype=np.int64, copy=True)
+        known = np.flatnonzero(saved_positions >= 0)
+        moved = np.round(saved_arrays['lat_long_coords'][saved_positions[known]], colocated_precision) != np.round(lat_long_coords[known], colocated_precision)
+        saved_positions[known[moved.any(axis=1)]] = -1
+        known = np.flatnonzero(saved_positions >= 0)
+        new_positions = np.full(len(saved_arrays['names']), -1)
+        new_positions[saved_positions[known]] = known
+
+        veh_matrices = {}
+        for veh in config_manager.get_build_parameters().get_vehicle_profiles():
+            snapped_gps_coords = np.full((size, 2), np.nan)
+            matrix_blocks = {'time': [], 'dist': [], 'elevation': []}
+            if f'snapped/{veh}' in saved_arrays:
+                snapped_gps_coords[known] = saved_arrays[f'snapped/{veh}'][saved_positions[known]]
+                for time_or_dist, veh_blocks in matrix_blocks.items():
+                    idx = 0
+                    while f'{time_or_dist}/{veh}/{idx}/positions' in saved_arrays:
+                        mapped = new_positions[saved_arrays[f'{time_or_dist}/{veh}/{idx}/positions']]
+                        kept = np.flatnonzero(mapped >= 0)
+                        veh_blocks.append((mapped[kept], saved_arrays[f'{time_or_dist}/{veh}/{idx}/matrix'][np.ix_(kept, kept)]))
+                        idx += 1
+
+            consider_elevation = f'elevation/{veh}/0/positions' in saved_arrays
+            loaded = MatrixBlocks(size, matrix_blocks['time'])
+            missing_blocks = [positions for positions in blocks if not loaded.covers(positions)]
+            for positions in missing_blocks:
+                durations, distances, elevations, block_snapped_gps_coords, _ = NodeLoader.get_matrices(
+                    lat_long_coords[positions], veh, consider_elevation=consider_elevation, factor=elevation_factor)
+                matrix_blocks['time'].append((positions, durations))
+                matrix_blocks['dist'].append((positions, distances))
+                if consider_elevation:
+                    matrix_blocks['elevation'].append((positions, elevations))
+                snapped_gps_coords[positions] = block_snapped_gps_coords
+            if len(missing_blocks) > 0:
+                logging.info(f'Queried {len(missing_blocks)} blocks of nodes missing from the saved {veh} matrices')
+
+            veh_matrices[veh] = (MatrixBlocks(size, matrix_blocks['time']), MatrixBlocks(size, matrix_blocks['dist']),
+                                 MatrixBlocks(size, matrix_blocks['elevation']) if consider_elevation else None, snapped_gps_coords, None)
+        return veh_matrices
+
 class OSRMMatrix:
     """
     A time or distance matrix as generated by OSRM.
+
+    Filtered matrices are views: they keep the positions of their nodes in the
+    parent matrix and only build the submatrix when time_dist_mat is read.
     """
-    def __init__(self, clean_nodes, time_dist_mat, snapped_gps_coords):
+    def __init__(self, clean_nodes, time_dist_mat, snapped_gps_coords, positions=None):
         """Instantiates OSRMMatrix object.
 
             Args:
                 clean_nodes (NodeData object): all clean nodes
                 time_or_dist_mat (np array): time or distance matrix
                 snapped_gps_coords (np array): snapped GPS coordinates
+                positions (array of ints, default None): positions of this matrix's nodes in
+                clean_nodes, time_dist_mat and snapped_gps_coords, None if it holds all of them
             Returns:
                 None
         """
-        self.clean_nodes = clean_nodes
-        self.time_dist_mat = time_dist_mat
-        self.snapped_gps_coords = snapped_gps_coords
-    
+        self._clean_nodes = clean_nodes
+        self._matrix = time_dist_mat
+        self._snapped_gps_coords = snapped_gps_coords
+        self._positions = positions
+        self._matrix_positions = positions
+        self._submatrix = None
+
+    @property
+    def clean_nodes(self):
+        if self._positions is not None:
+            self._clean_nodes = NodeData(self._clean_nodes.df_gps_verbose.iloc[self._positions])
+            self._snapped_gps_coords = self._snapped_gps_coords[self._positions]
+            self._positions = None
+        return self._clean_nodes
+
+    @property
+    def snapped_gps_coords(self):
+        if self._positions is not None:
+            return self._snapped_gps_coords[self._positions]
+        return self._snapped_gps_coords
+
+    @property
+    def time_dist_mat(self):
+        if self._matrix_positions is None:
+            return self._matrix
+        if self._submatrix is None:
+            if isinstance(self._matrix, MatrixBlocks):
+                self._submatrix = self._matrix.select(self._matrix_positions)
+            else:
+                self._submatrix = self._matrix[np.ix_(self._matrix_positions, self._matrix_positions)]
+        return self._submatrix
+
+    @time_dist_mat.setter
+    def time_dist_mat(self, time_dist_mat):
+        self._matrix = time_dist_mat
+        self._matrix_positions = None
+        self._submatrix = None
+
+    @property
+    def shape(self):
+        if self._matrix_positions is None:
+            return self._matrix.shape
+        return (len(self._matrix_positions), len(self._matrix_positions))
+
     @staticmethod	
     def get_filtered_osrm_mat(orig_osrm_mat, bool_filter):
         """
         Creates a submatrix of a larger OSRM matrix. Helpful for filtering nodes by some attribute (e.g. zone).
+        Nothing is copied, the submatrix is built from the parent when first used.
         
         Args:
             orig_osrm_mat (OSRM obj): Original OSRMMatrix
-            indices (array of ints): indices of desired subset of nodes
+            bool_filter (array of bools): True for the desired subset of nodes
         Returns:
             OSRMMatrix object for subset of nodes
         """
-        new_osrm_mat = copy.deepcopy(orig_osrm_mat)
-        indices = np.ix_(bool_filter)
-        new_osrm_mat.clean_nodes.df_gps_verbose = orig_osrm_mat.clean_nodes.df_gps_verbose.loc[bool_filter]
-        new_osrm_mat.time_dist_mat = orig_osrm_mat.time_dist_mat[indices[0], :][:, indices[0]]
-        new_osrm_mat.snapped_gps_coords = orig_osrm_mat.snapped_gps_coords[indices, :][0]
+        positions = np.flatnonzero(np.asarray(bool_filter))
+
+        new_osrm_mat = OSRMMatrix(orig_osrm_mat._clean_nodes, orig_osrm_mat._matrix, orig_osrm_mat._snapped_gps_coords)
+        new_osrm_mat._positions = positions if orig_osrm_mat._positions is None else orig_osrm_mat._positions[positions]
+        new_osrm_mat._matrix_positions = positions if orig_osrm_mat._matrix_positions is None else orig_osrm_mat._matrix_positions[positions]
         return new_osrm_mat
-        
+
+    def __getstate__(self):
+        """Pickles only this matrix's nodes, not the parent it views."""
+        return {'_clean_nodes': self.clean_nodes, '_matrix': self.time_dist_mat, '_snapped_gps_coords': self.snapped_gps_coords,
+                '_positions': None, '_matrix_positions': None, '_submatrix': None}
 
     def write_to_file(self, f_path_mat, f_path_gps=None):
         """Writes matrix and snapped gps coordinates to CSV file.
@@ -675,20 +1337,181 @@ class OSRMMatrix:
             Returns:
                 None
         """
-        pd.DataFrame(self.time_dist_mat).to_csv(f_path_mat, index=False, index_label=False, header=False)
+        pd.DataFrame(np.asarray(self.time_dist_mat)).to_csv(f_path_mat, index=False, index_label=False, header=False)
 
         if f_path_gps != None:
             pd.DataFrame(self.snapped_gps_coords,\
             index=self.clean_nodes.names).to_csv(f_path_gps, index=True, index_label=False, header=False)
 
+class MatrixBlocks:
+    """
+    A square matrix over all nodes of which only some blocks were computed,
+    one per zone config. Blocks may overlap (e.g. a shared depot), pairs of
+    nodes no block covers are NaN.
+    """
+    ndim = 2
+
+    def __init__(self, size, blocks):
+        """Instantiates MatrixBlocks object.
+
+            Args:
+                size (int): number of nodes
+                blocks (list of tuples): (positions, matrix) pairs, where matrix
+                holds the values between the nodes at the given positions
+            Returns:
+                None
+        """
+        self.size = size
+        self.blocks = [(np.asarray(positions), matrix) for positions, matrix in blocks]
+
+    @property
+    def shape(self):
+        return (self.size, self.size)
+
+    def _local_positions(self, block_positions, positions):
+        """Position of each node within a block, -1 if the block doesn't hold it."""
+        lookup = np.full(self.size, -1)
+        lookup[block_positions] = np.arange(len(block_positions))
+        return lookup[positions]
+
+    def covers(self, positions):
+        """
+        Whether a single block holds all the given nodes, i.e. select() can serve them.
+
+        Args:
+            positions (array of ints): node positions
+        Returns:
+            bool
+        """
+        positions = np.asarray(positions)
+        return any((self._local_positions(block_positions, positions) >= 0).all() for block_positions, _ in self.blocks)
+
+    def select(self, positions):
+        """
+        Gets the dense submatrix between nodes, served from the block holding
+        all of them.
+
+        Args:
+            positions (array of ints): node positions
+        Returns:
+            Numpy array of shape (len(positions), len(positions))
+        Raises:
+            ValueError: if no single block holds all the nodes, the pairs between
+            blocks were never computed
+        """
+        positions = np.asarray(positions)
+        for block_positions, matrix in self.blocks:
+            local = self._local_positions(block_positions, positions)
+            if (local >= 0).all():
+                return matrix[np.ix_(local, local)]
+        raise ValueError('Selected nodes span several matrix blocks, the pairs between blocks were not computed')
+
+    def pairs(self, sources, destinations):
+        """
+        Gets the values between pairs of nodes, e.g. the legs of a route,
+        without building the submatrix between all of them.
+
+        Args:
+            sources (array of ints): node position each pair starts at
+            destinations (array of ints): node position each pair ends at
+        Returns:
+            Numpy array with one value per pair
+        Raises:
+            ValueError: if no block holds some of the pairs
+        """
+        sources, destinations = np.asarray(sources), np.asarray(destinations)
+        values = self._empty(len(sources))
+        found = np.zeros(len(sources), dtype=bool)
+        for block_positions, matrix in self.blocks:
+            local_sources = self._local_positions(block_positions, sources)
+            local_destinations = self._local_positions(block_positions, destinations)
+            held = ~found & (local_sources >= 0) & (local_destinations >= 0)
+            values[held] = matrix[local_sources[held], local_destinations[held]]
+            found |= held
+        if not found.all():
+            raise ValueError(f'{np.count_nonzero(~found)} pairs of nodes are not held by any matrix block, '
+                             f'e.g. {sources[~found][0]} to {destinations[~found][0]}')
+        return values
+
+    def _empty(self, shape):
+        """Array for values of the blocks' dtype, filled with the value of pairs no block holds."""
+        dtype = self.blocks[0][1].dtype if self.blocks else np.float64
+        fill = unreachable_cost if np.issubdtype(dtype, np.integer) else np.nan
+        return np.full(shape, fill, dtype=dtype)
+
+    def subset(self, positions):
+        """
+        Restricts the blocks to some of the nodes.
+
+        Args:
+            positions (array of ints): positions of the nodes to keep, in their new order
+        Returns:
+            MatrixBlocks object over the kept nodes
+        """
+        new_positions = np.full(self.size, -1)
+        new_positions[positions] = np.arange(len(positions))
+
+        blocks = []
+        for block_positions, matrix in self.blocks:
+            mapped = new_positions[block_positions]
+            kept = np.flatnonzero(mapped >= 0)
+            blocks.append((mapped[kept], matrix[np.ix_(kept, kept)]))
+        return MatrixBlocks(len(positions), blocks)
+
+    def __array__(self, dtype=None, copy=None):
+        """Dense matrix over all nodes, e.g. to write it out, pairs no block holds are NaN/unreachable_cost."""
+        dense = self._empty(self.shape)
+        for block_positions, matrix in self.blocks:
+            dense[np.ix_(block_positions, block_positions)] = matrix
+        return dense if dtype is None else dense.astype(dtype)
+
+def compact_matrix(matrix):
+    """
+    Converts an OSRM matrix to int32, truncating like int() does. Missing
+    values (NaN) become unreachable_cost.
+
+    Args:
+        matrix (np array, MatrixBlocks or None): float matrix
+    Returns:
+        Same kind of matrix holding int32 values
+    """
+    if matrix is None:
+        return None
+    if isinstance(matrix, MatrixBlocks):
+        return MatrixBlocks(matrix.size, [(positions, compact_matrix(block)) for positions, block in matrix.blocks])
+    matrix = np.nan_to_num(matrix, nan=unreachable_cost, posinf=unreachable_cost)
+    return np.minimum(matrix, np.iinfo(np.int32).max).astype(np.int32)
+
+def memmap_matrix(matrix, path):
+    """
+    Writes a matrix to .npy file(s) and maps it back read-only, so its pages are
+    only read from disk when the nodes in them are used. MatrixBlocks get one
+    file per block, so solving a zone only pages in that zone's block.
+
+    Args:
+        matrix (np array, MatrixBlocks or None): matrix to store
+        path (str): file path without the .npy extension
+    Returns:
+        Same kind of matrix backed by np.memmap
+    """
+    if matrix is None:
+        return None
+    if isinstance(matrix, MatrixBlocks):
+        return MatrixBlocks(matrix.size, [(positions, memmap_matrix(block, f'{path}_block{idx}'))
+                                          for idx, (positions, block) in enumerate(matrix.blocks)])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.save(f'{path}.npy', matrix)
+    return np.load(f'{path}.npy', mmap_mode='r')
+
 def process_nodes(config_manager,
                   node_loader_options=None,
-                  zone_configs=None) -> NodeData:
+                  zone_configs=None,
+                  matrix_folder=None) -> NodeData:
     """Reads node data and outputs matrices necessary for optimization."""
 
     # read in file which contains lat long of each pt
     if node_loader_options != None:
-        node_data = NodeLoader(config_manager, zone_configs, **node_loader_options).get_nodedata()
+        node_data = NodeLoader(config_manager, zone_configs, matrix_folder=matrix_folder, **node_loader_options).get_nodedata()
     else:
         node_data = NodeLoader(config_manager).get_nodedata()
 
@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 import logging
 import boto3
 import pandas as pd
+from pandas.io.parsers import TextParser
 import os
 import io
 import pickle
@@ -89,12 +90,19 @@ class GoogleDriveContext():
     def download_input_data(self, local_dir):
         """Get input data for running the model"""
         # Load Data
-        customer_data = self._get_sheet_by_id(self.customer_file_id,
-                                              self._update_rangename('Customer Data'))
+        customer_values = self._get_sheet_values_by_id(self.customer_file_id,
+                                                       self._update_rangename('Customer Data'))
         facility_data = self._get_sheet_by_id(self.facility_file_id,
                                               self._update_rangename('extra_points'))
         # Save Data
-        customer_data.to_excel(f"{local_dir}/customer_data.xlsx", index=False)
+        # The sheet is parsed as read_excel parses an .xlsx and saved as Parquet, which the run
+        # picks through find_node_file instead of writing and parsing an .xlsx
+        customer_data = TextParser(customer_values, header=0).read()
+        try:
+            customer_data.to_parquet(f"{local_dir}/customer_data.parquet", index=False)
+        except (ValueError, TypeError) as error:
+            logging.warning(f'Could not save the customer data as Parquet, saving it as .xlsx: {error!r}')
+            customer_data.to_excel(f"{local_dir}/customer_data.xlsx", index=False)
         facility_data.to_csv(f"{local_dir}/extra_points.csv", index=False)
         config_file_id = self._get_file_id_from_name('config.json', folder_id=self.scenario_folder_id)
         self._load_and_save_json_file(config_file_id, local_dir)
@@ -147,6 +155,12 @@ class GoogleDriveContext():
     def _get_sheet_by_id(self, SPREADSHEET_ID, RANGE_NAME):
         """Get data of sheet
         """
+        values = self._get_sheet_values_by_id(SPREADSHEET_ID, RANGE_NAME)
+        return pd.DataFrame(values[1:], columns = values[0])
+
+    def _get_sheet_values_by_id(self, SPREADSHEET_ID, RANGE_NAME):
+        """Get the cells of sheet as rows of strings, the header first
+        """
         service = self.sheet_service
         spreadsheets = service.spreadsheets()
         # Call the Sheets API
@@ -155,7 +169,7 @@ class GoogleDriveContext():
         values = result.get('values', [])
         if not values:
             logging.error('No data found.')
-        return pd.DataFrame(values[1:], columns = values[0])
+        return values
 
     def _create_sheet(self, parent_folder, sheetname):
         service = self.drive_service
@@ -6,7 +6,7 @@ import logging
 from enum import Enum
 from .routing_configuration import RoutingConfig
 from .build_parameters import BuildParametersConfig
-from .gps_input_data import GPSInputData, GPSInputPaths
+from .gps_input_data import GPSInputData, GPSInputPaths, find_node_file
 from .manual_edits_input_data import ManualEditsInputPaths, ManualEditsInputData
 
 class ConfigType(Enum):
@@ -49,6 +49,7 @@ class ConfigManager(object):
                 manual_route_edits=f"{path}/manual_routes_edits.xlsx",
                 manual_vehicles=f"{path}/manual_vehicles.csv",
                 clean_gps_points=f"{path}/clean_gps_points.csv",
+                node_matrices=f"{path}/node_matrices.npz",
             )
         else:
             manual_edits_input = None
@@ -57,7 +58,7 @@ class ConfigManager(object):
                 routing_config_file=f"{local_dir}/config.json",
                 build_parameters_file='build_parameters.yml',
                 gps_input_files=GPSInputPaths(
-                    gps_file=f"{local_dir}/customer_data.xlsx",
+                    gps_file=find_node_file(local_dir, "customer_data"),
                     custom_header_file=f"{local_dir}/custom_header.yaml",
                     gps_extra_input_file=f"{local_dir}/extra_points.csv"
                 ),
@@ -76,6 +77,7 @@ class ConfigManager(object):
                 manual_route_edits=f"{manual_input_path}/manual_routes_edits.xlsx",
                 manual_vehicles=f"{manual_input_path}/manual_vehicles.csv",
                 clean_gps_points=f"{manual_input_path}/clean_gps_points.csv",
+                node_matrices=f"{manual_input_path}/node_matrices.npz",
             )
         else:
             manual_edit_input_paths = None
@@ -84,7 +86,7 @@ class ConfigManager(object):
                 routing_config_file=f"{local_dir}/config.json",
                 build_parameters_file='build_parameters.yml',
                 gps_input_files=GPSInputPaths(
-                    gps_file=f"{local_dir}/customer_data.xlsx",
+                    gps_file=find_node_file(local_dir, "customer_data"),
                     custom_header_file=f"{local_dir}/custom_header.yaml",
                     gps_extra_input_file=f"{local_dir}/extra_points.csv"
                 ),
@@ -1,9 +1,19 @@
 import attr
+import glob
+import hashlib
+import json
+import os
 import pandas as pd
 import logging
 import ruamel.yaml
 import numpy as np
 import pathlib
+import time
+
+parse_cache_enabled = False # Set to True to reuse parsed .xlsx/.csv node files between runs
+parse_cache_folder = os.environ.get('parse_cache_folder', '/opt/WORKING_DATA_DIR/parse_cache')
+parse_cache_max_age_days = 30 # Cached frames not read for this long are removed when the cache is written
+columnar_extensions = ['.parquet', '.feather'] # Node file formats read without the parse cache, they load fast on their own
 
 @attr.s
 class GPSInputPaths(object):
@@ -11,6 +21,25 @@ class GPSInputPaths(object):
     custom_header_file = attr.ib(type=str)
     gps_extra_input_file = attr.ib(type=str)
 
+def find_node_file(folder, stem, default_extension='.xlsx'):
+    """
+    Picks the node file to read from a folder. When the same nodes exist in
+    several formats (e.g. a converted .parquet next to the uploaded .xlsx)
+    the most recently modified file is used, so a stale copy can't hide a new upload.
+
+    Args:
+        folder (str): folder holding the input files
+        stem (str): file name without extension, e.g. 'customer_data'
+        default_extension (str, default '.xlsx'): extension used when no node file exists
+    Returns:
+        str path of the node file
+    """
+    candidates = [f"{folder}/{stem}{extension}" for extension in [default_extension] + columnar_extensions]
+    existing = [path for path in candidates if os.path.exists(path)]
+    if len(existing) == 0:
+        return candidates[0]
+    return max(existing, key=os.path.getmtime)
+
 class GPSInput(object):
     def __init__(self, filename, label_map):
         self.filename = filename
@@ -76,7 +105,9 @@ class GPSInputData(object):
     @staticmethod
     def read_node_file(f_path, label_map=None):
         """
-        Reads file containing node information and maps
+        Reads file containing node information and maps. Frames parsed from
+        .xlsx/.csv files are cached by file content and label map, so an
+        unchanged file is only parsed once.
 
         Args:
             f_path (str or pathlib.Path): File with node information.
@@ -92,20 +123,61 @@ class GPSInputData(object):
         #if file doesn't exist, throw exception
         if not f_path.exists():
             raise FileNotFoundError(f_path)
+
+        if not parse_cache_enabled or f_path.suffix in columnar_extensions:
+            return GPSInputData.parse_node_file(f_path, label_map)
+
+        digest = hashlib.sha256(f_path.read_bytes())
+        digest.update(json.dumps(label_map, sort_keys=True, default=str).encode())
+        cache_path = pathlib.Path(parse_cache_folder) / f'{f_path.stem}-{digest.hexdigest()[:16]}.pkl'
+        try:
+            if cache_path.exists():
+                cache_path.touch()
+                return pd.read_pickle(cache_path)
+        except Exception as error:
+            logging.warning(f'Could not read parse cache {cache_path}: {error}')
+
+        df_gps_all = GPSInputData.parse_node_file(f_path, label_map)
+        try:
+            os.makedirs(parse_cache_folder, exist_ok=True)
+            #Older versions of this file and frames no run has read for a while are dropped
+            expiry = time.time() - parse_cache_max_age_days * 24 * 3600
+            for stale_path in glob.glob(str(pathlib.Path(parse_cache_folder) / '*.pkl')):
+                if pathlib.Path(stale_path).name.startswith(f'{f_path.stem}-') or os.path.getmtime(stale_path) < expiry:
+                    os.remove(stale_path)
+            df_gps_all.to_pickle(cache_path)
+        except OSError as error:
+            logging.warning(f'Could not write parse cache {cache_path}: {error}')
+        return df_gps_all
+
+    @staticmethod
+    def parse_node_file(f_path, label_map=None):
+        """
+        Parses a node file and standardizes its column labels, see read_node_file.
+
+        Args:
+            f_path (pathlib.Path): File with node information.
+            label_map (dictionary, default None): dictionary maps file labels to NodeData attributes
+        Returns:
+            pandas Dataframe containing all nodes from file
+        """
+        #read in the file
+        if str(f_path).endswith('.parquet'):
+            df_gps_all = pd.read_parquet(f_path)
+        elif str(f_path).endswith('.feather'):
+            df_gps_all = pd.read_feather(f_path)
+        elif str(f_path).endswith('.xlsx'):
+            df_gps_all = pd.read_excel(f_path)
+        elif str(f_path).endswith('.csv'):
+            #Check different encoding possiblities
+            #Encoding possilbities
+            csv_encodings = ['utf-8', 'cp1252', 'latin1']
+            try:
+                df_gps_all = pd.read_csv(f_path, encoding='utf-8')
+            except UnicodeDecodeError:
+                df_gps_all = pd.read_csv(f_path, encoding='cp1252')
         else:
-            #read in the file
-            if str(f_path).endswith('.xlsx'):
-                df_gps_all = pd.read_excel(f_path)
-            elif str(f_path).endswith('.csv'):
-                #Check different encoding possiblities
-                #Encoding possilbities
-                csv_encodings = ['utf-8', 'cp1252', 'latin1']
-                try:
-                    df_gps_all = pd.read_csv(f_path, encoding='utf-8')
-                except UnicodeDecodeError:
-                    df_gps_all = pd.read_csv(f_path, encoding='cp1252')
-            else:
-                raise Exception('File should be either a .xlsx or .csv file.')
+            raise Exception('File should be a .xlsx, .csv, .parquet or .feather file.')
 
         #Standardizing colummn labels
         if label_map != None:
@@ -10,23 +10,30 @@ class ManualEditsInputPaths(object):
     manual_route_edits = attr.ib(type=str)
     manual_vehicles = attr.ib(type=str)
     clean_gps_points = attr.ib(type=str)
+    node_matrices = attr.ib(type=str, default=None)
 
 class ManualEditsInputData(object):
 
-    def __init__(self, manual_routes, manual_vehicles, clean_gps_node_data):
+    def __init__(self, manual_routes, manual_vehicles, clean_gps_node_data, node_matrices_path=None):
         self.manual_routes = manual_routes
         self.clean_gps_node_data = clean_gps_node_data
         self.manual_vehicles = manual_vehicles
+        # Matrices saved by the optimization run, None if they weren't provided
+        self.node_matrices_path = node_matrices_path
 
     @staticmethod
     def load(paths: ManualEditsInputPaths):
         manual_edits_data = pd.ExcelFile(paths.manual_route_edits)
         clean_gps_data = GPSInputData.read_node_file(paths.clean_gps_points)
         manual_vehicles = pd.read_csv(paths.manual_vehicles)
+        node_matrices_path = None
+        if paths.node_matrices is not None and pathlib.Path(paths.node_matrices).exists():
+            node_matrices_path = paths.node_matrices
         return ManualEditsInputData(
             manual_routes=manual_edits_data,
             clean_gps_node_data=clean_gps_data,
-            manual_vehicles=manual_vehicles
+            manual_vehicles=manual_vehicles,
+            node_matrices_path=node_matrices_path
         )
 
     def require(self):
@@ -1,15 +1,14 @@
 import glob
+import logging
 import os
 import numpy as np
 import rasterio
-import ujson
 import pandas as pd
 import requests
 import datetime
 
 import osrmbindings
-
-osrm_filepath = os.environ['osm_filename']
+import osrm_engines
 
 def haversine_np(lon1, lat1, lon2, lat2):
     """
@@ -53,32 +52,36 @@ def download_elevation_data(bounding_box):
 
     return True
 
-def compute_elevation_costs(vehicle, longitudes, latitudes):
+def compute_elevation_costs(vehicle, longitudes, latitudes, sources=None, destinations=None):
     """Keeps the same order as the duration and distance matrices from the NodeData/Loader classes
+    Only the pairs from sources to destinations (positions, all locations when None) are computed, others are left at 0
+    Pairs OSRM can't route between are left at 0 as well
     """
     print(f'Starting elevation calculations: {datetime.datetime.now()}')
-    osrmbindings.initialize(f'/opt/{vehicle}/{osrm_filepath}')
+    engine = osrm_engines.get_engine(vehicle)
 
     elevation_cost = np.zeros((len(longitudes),len(longitudes)))
+    unroutable = 0
 
     with rasterio.open('/elevation.geotiff') as raster:
         altitude = raster.read()[0] #only one channel to extract, result is a xy array
-        for source in range(len(longitudes)): # we could probably cut it in half once we analyze how assymetric routes impact the matrix
-            for destination in range(len(longitudes)):
-                if source == destination:
-                    elevation_cost[source, destination] = 0
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        candidates = np.arange(len(longitudes)) if destinations is None else np.asarray(destinations, dtype=int)
+        for source in (range(len(longitudes)) if sources is None else sources): # we could probably cut it in half once we analyze how assymetric routes impact the matrix
+            # Same location (and the diagonal) costs nothing, the remaining row is routed in one batch
+            row_destinations = candidates[(longitudes[candidates] != longitudes[source]) | (latitudes[candidates] != latitudes[source])]
+            responses = osrmbindings.route_many(
+                engine,
+                [np.array([longitudes[source], longitudes[destination]]) for destination in row_destinations],
+                [np.array([latitudes[source], latitudes[destination]]) for destination in row_destinations],
+                threads=osrm_engines.query_threads)
+
+            for destination, response in zip(row_destinations, responses):
+                if response is None:
+                    unroutable += 1
                     continue
-                
-                lons = [longitudes[source], longitudes[destination]]
-                lats = [latitudes[source], latitudes[destination]]
-                
-                if np.unique(lons).shape[0] == 1 and np.unique(lats).shape[0] == 1:
-                    elevation_cost[source, destination] = 0
-                    continue
-
-                response = osrmbindings.route(lons, lats) # need to write that loop in C++, or use py-osrm with nanobind
-                parsed = ujson.loads(response)
-                coords = np.array(parsed['routes'][0]['geometry']['coordinates'])
+                coords = response['geometry']
                 ys = coords[:,1]
                 xs = coords[:,0]
                 
@@ -100,8 +103,8 @@ def compute_elevation_costs(vehicle, longitudes, latitudes):
                 cost = np.max(change)
                 elevation_cost[source, destination] = cost
 
+    if unroutable:
+        logging.warning(f'No route found for {unroutable} location pairs, their elevation cost is left at 0.')
     print(f'Elevation calculations done: {datetime.datetime.now()}')
-    with open('gimme.cost','wb') as opened: # for debugging purposes
-        np.save(opened, elevation_cost)
     return elevation_cost
 
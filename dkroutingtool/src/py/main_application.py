@@ -6,6 +6,8 @@ Parameters:
   --input: Specify scenario directory name, default is 'input'.
   --local: If set, will use local data
   --manual: If set, will run manual mapping mode
+  --manual_edit_matrices: If set, saves the matrices manual mapping mode reuses
+  instead of querying OSRM again
 
 Require environmental variables are only if we wish to operate from as
 cloud directory, in which case we need access credentials. See run_application.sh.
@@ -32,6 +34,7 @@ parser.add_argument('--input', dest='scenario', default='input')
 parser.add_argument('--local', dest='cloud', action='store_false')
 parser.add_argument('--manual', dest='manual_mapping_mode', action='store_true')
 parser.add_argument('--manual_input_path', dest='manual_input_path', default=None)
+parser.add_argument('--manual_edit_matrices', dest='manual_edit_matrices', action='store_true')
 args = parser.parse_args()
 
 gpx_output = True
@@ -74,10 +77,12 @@ def main(user_directory='data'):
     # Run either config-based routing or manual mapping.
     if not args.manual_mapping_mode:
         logging.info('Running Config-based routing.')
-        solution, vis_data = run_routing_from_config(config_manager=config_manager)
+        solution, vis_data = run_routing_from_config(
+            config_manager=config_manager,
+            matrix_folder=file_manager.root_output_path / output_config.time_and_dist_matrices_folder)
         data_persisting.persist(solution, file_manager)
         node_data = solution.intermediate_optimization_solution.node_data
-        data_persisting.persist(CleanedNodeData(node_data), file_manager)
+        data_persisting.persist(CleanedNodeData(node_data, write_matrices=args.manual_edit_matrices), file_manager)
         data_persisting.persist(vis_data, file_manager)
         if gpx_output:
             geojson_to_gpx_converter(output_path, output_path)
@@ -1,57 +1,75 @@
 """
 Allows for manual editing of routes and subsequent mapping.
 """
+import numpy as np
+import pandas as pd
 import visualization
 import optimization
-from build_time_dist_matrix import NodeLoader
+from build_time_dist_matrix import NodeLoader, MatrixBlocks
 from config.config_manager import ConfigManager
 from output.file_manager import FileManager
 from output.route_solution_data import FinalOptimizationSolution, IntermediateOptimizationSolution
 from output.manual_route_data import ManualRouteData
 
+def get_leg_values(matrix, positions):
+    """
+    Values of a time/distance matrix along a route, from each node to the next.
+    Raises a ValueError if a leg between nodes of different matrix blocks was never computed.
+    """
+    if isinstance(matrix, MatrixBlocks):
+        return matrix.pairs(positions[:-1], positions[1:])
+    return np.asarray(matrix)[positions[:-1], positions[1:]]
+
 def create_route_metrics_dict(solution: FinalOptimizationSolution) -> dict:
     """
     Creates a route_dict object (as in optimization.py) from manual editing files.
+    Only the legs between consecutive nodes of each route are looked up.
     """
     routes_for_mapping = solution.routes_for_mapping
     vehicles = solution.vehicles
     node_data = solution.intermediate_optimization_solution.node_data
 
+    node_positions = pd.Series(np.arange(len(node_data.names)), index=np.asarray(node_data.names, dtype=str))
+    node_positions = node_positions[~node_positions.index.duplicated()]
+    demands = pd.Series(node_data.get_attr('buckets')).fillna(0).to_numpy()
+    load_time = optimization.default_load_time_mins*60
+
     #Initialize the route_dict
     route_metrics_dict = {}
 
     #for each route
     for route_id, route in routes_for_mapping.items():
-        this_veh = vehicles[route_id]
-
-        node_names = []
-        for node in route:
-            node_names.append(node[1][0])
-        data = optimization.DataProblem(node_data, [this_veh], node_name_ordered = node_names)
-        #Find the time matrix (as done in optimizaiton.py)
-        time_matrix = optimization.CreateTimeEvaluator(data, manual_run = True)
-
-        route_dist = 0
-        total_time = 0
-        route_load = 0
-        #for each node, add the time, distance and laod
-        #for i, node_name in enumerate(route[:][1][0]):
-        for i in range(len(node_names)-1):
-            #if i < len(route[:][1][0])-1:
-            total_time += time_matrix.time_evaluator(i, i+1)
-            route_dist += data.distance_matrix[i][i+1]
-            route_load += data.demands[i+1]
-
-        #If key not in dict, add it
-        if route_id not in route_metrics_dict.keys():
-            route_metrics_dict[route_id] = {}
-
-        route_metrics_dict[route_id]['total_time'] = total_time
-        route_metrics_dict[route_id]['total_dist'] = route_dist
-        route_metrics_dict[route_id]['load'] = route_load
+        profile = vehicles[route_id].osrm_profile
+        node_names = np.asarray([node[1][0] for node in route], dtype=str)
+        positions = node_positions[node_names].to_numpy()
+
+        #Same truncation as CreateTimeEvaluator, each leg includes the service time at its start
+        travel_times = get_leg_values(node_data.get_time_or_dist_mat(veh=profile, time_or_dist='time'), positions)
+        distances = get_leg_values(node_data.get_time_or_dist_mat(veh=profile, time_or_dist='dist'), positions)
+
+        route_metrics_dict[route_id] = {
+            'total_time': int(np.trunc(load_time + travel_times).sum()),
+            'total_dist': int(np.trunc(distances).sum()),
+            'load': demands[positions[1:]].sum()
+        }
 
     return route_metrics_dict
 
+def get_route_blocks(manual_routes, node_names):
+    """
+    Positions of each manually edited route's nodes among the clean nodes,
+    the node pairs that need time/distance matrices.
+    """
+    positions = pd.Series(np.arange(len(node_names)), index=np.asarray(node_names, dtype=str))
+    route_blocks = []
+    for sheet in manual_routes.sheet_names:
+        manual_dataframe = manual_routes.parse(sheet)
+        manual_dataframe = manual_dataframe[manual_dataframe['route'] != 'Summary']
+        for _, route in manual_dataframe.groupby(manual_dataframe['route'].astype(str)):
+            route_positions = positions[positions.index.isin(route['node_name'].astype(str))]
+            route_blocks.append(np.unique(route_positions.to_numpy()))
+    return route_blocks
+
 def run_manual_route_update(config_manager: ConfigManager) -> ManualRouteData:
     """
     Reads manual editing excel/csv files and recreates appropriate inputs to visualization.main()
@@ -63,9 +81,14 @@ def run_manual_route_update(config_manager: ConfigManager) -> ManualRouteData:
     #Read the manual editing routes file
     manual_routes = config_manager.get_manual_edits_input_data().manual_routes
     
-    #Reconstruct the nodedata class from file provided
+    #Reconstruct the nodedata class from file provided, reusing the optimization run's
+    #matrices so only routes with new nodes are queried
+    manual_edits_input_data = config_manager.get_manual_edits_input_data()
+    clean_gps_node_data = manual_edits_input_data.clean_gps_node_data
     node_data = NodeLoader.from_clean_gps_node_data(
-        config_manager, config_manager.get_manual_edits_input_data().clean_gps_node_data
+        config_manager, clean_gps_node_data,
+        matrices_path=manual_edits_input_data.node_matrices_path,
+        blocks=get_route_blocks(manual_routes, clean_gps_node_data['name'])
     )
     #for each sheet (zone) in routes file
     routes_for_mapping = {}
@@ -78,20 +101,23 @@ def run_manual_route_update(config_manager: ConfigManager) -> ManualRouteData:
         manual_dataframe = manual_routes.parse(sheet)
         manual_dataframe = manual_dataframe[manual_dataframe['route'] != 'Summary']
         current_load = 0
-        for index, row in manual_dataframe.iterrows():
-            row_key = str(row['route'])
+        #pick the lat/long and additional info from the node data file
+        rows = node_data.rows_for_names(manual_dataframe['node_name'])
+        lat_long_coords = node_data.lat_long_coords[rows]
+        additional_info = node_data.get_attr('additional_info')[rows]
+        buckets = node_data.get_attr('buckets')[rows]
+        for i, row in enumerate(manual_dataframe.itertuples(index=False)):
+            row_key = str(row.route)
             #if route doesn't exist in routes_for_mapping, add it
             if row_key not in routes_for_mapping.keys():
                 routes_for_mapping[row_key] = []
                 zone_route_map[sheet].append(row_key)
                 current_load = 0
             #Reconstruct the array as it was before manual editing
-            #pick the lat/long and additional info from the node data file
-            this_entry_nodedata = node_data.filter_nodedata({'name': row['node_name']})
-            rfm_entry = [(this_entry_nodedata.lat_long_coords[0][0], this_entry_nodedata.lat_long_coords[0][1])]
-            rfm_entry.append((row['node_name'], this_entry_nodedata.get_attr('additional_info')[0]))
+            rfm_entry = [(lat_long_coords[i][0], lat_long_coords[i][1])]
+            rfm_entry.append((row.node_name, additional_info[i]))
             
-            demand = this_entry_nodedata.get_attr('buckets')[0]
+            demand = buckets[i]
             
             rfm_entry.append(current_load)
             rfm_entry.append(demand)
@@ -0,0 +1,350 @@
+"""
+On-disk cache of the OSRM travel times and distances between locations, so a
+run over a mostly unchanged set of nodes only queries OSRM for the pairs
+involving new locations.
+
+Each vehicle profile's dataset gets its own folder. The folder name holds a
+key derived from the .osrm dataset files (name, size and modification time)
+and the profile .lua, so rebuilding the OSRM data starts a fresh cache and the
+stale folder is removed.
+
+The folder holds a SQLite index of the cached locations and, for every store,
+one block of rows/columns saved as .npy files. Blocks are memory mapped on
+lookup so only the rows of the requested locations are read. Once there are
+more than max_blocks blocks they are merged into one, so lookups don't slow
+down run after run. Locations that haven't been looked up or stored for
+max_age_days are dropped when the cache is opened.
+"""
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+import osrm_engines
+
+enabled = False # Set to True to reuse matrices of previous runs, off by default as the cache grows with every new location
+cache_folder = os.environ.get('matrix_cache_folder', '/opt/WORKING_DATA_DIR/matrix_cache')
+coordinate_precision = 6 # Decimal places locations are rounded to before lookup, 6 is about 0.1 meter
+max_age_days = 30 # Locations not used for this long are evicted from the cache
+block_arrays = ('rows', 'cols', 'durations', 'distances') # .npy files making up one block
+max_blocks = 16 # Blocks are merged into one when a store leaves more than this
+not_computed = -1.0 # Duration of the pairs of a merged block no store computed, NaN stays "no route"
+
+_caches = {}
+
+def dataset_key(profile):
+    """
+    Fingerprint of the OSRM dataset and profile a cache is valid for.
+
+    Args:
+        profile (str): vehicle profile name
+    Returns:
+        Hex string, None if the dataset files can't be found
+    """
+    files = sorted(glob.glob(osrm_engines.dataset_path(profile) + '*'))
+    if len(files) == 0:
+        return None
+
+    digest = hashlib.sha256()
+    for path in files:
+        stat = os.stat(path)
+        digest.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+
+    profile_lua = f'/opt/{profile}.lua'
+    if os.path.exists(profile_lua):
+        with open(profile_lua, 'rb') as opened:
+            digest.update(opened.read())
+    return digest.hexdigest()[:16]
+
+def get_cache(profile):
+    """
+    Returns the MatrixCache for a vehicle profile, or None when caching is
+    disabled or the dataset can't be fingerprinted.
+
+    Args:
+        profile (str): vehicle profile name
+    Returns:
+        MatrixCache or None
+    """
+    if not enabled:
+        return None
+
+    key = dataset_key(profile)
+    if key is None:
+        return None
+
+    if _caches.get(profile) is None or _caches[profile].key != key:
+        try:
+            path = os.path.join(cache_folder, f'{profile}-{key}')
+            os.makedirs(path, exist_ok=True)
+            for stale_path in glob.glob(os.path.join(cache_folder, f'{profile}-*')):
+                if stale_path == path:
+                    continue
+                if os.path.isdir(stale_path):
+                    shutil.rmtree(stale_path)
+                else:
+                    os.remove(stale_path)
+            _caches[profile] = MatrixCache(path, key)
+        except (OSError, sqlite3.Error) as error:
+            logging.warning(f'Matrix cache unavailable for {profile}: {error}')
+            return None
+    return _caches[profile]
+
+class MatrixCache:
+    """
+    Durations and distances between locations computed by one OSRM dataset,
+    along with where each location snaps to.
+    """
+    def __init__(self, path, key):
+        """Instantiates MatrixCache object, evicting locations unused for max_age_days.
+
+            Args:
+                path (str): folder to store the cache in
+                key (str): dataset key the cache is valid for
+            Returns:
+                None
+        """
+        self.path = path
+        self.key = key
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS points (
+                id INTEGER PRIMARY KEY, lat INTEGER NOT NULL, lon INTEGER NOT NULL,
+                snapped_lat REAL, snapped_lon REAL, snapped_dist REAL, last_seen REAL NOT NULL, UNIQUE (lat, lon));
+            CREATE TABLE IF NOT EXISTS blocks (id INTEGER PRIMARY KEY);
+        ''')
+        self.evict(time.time() - max_age_days * 24 * 3600)
+
+    @staticmethod
+    def quantize(latitudes, longitudes):
+        """Rounds locations to integers so nearby floats map to the same entry."""
+        scale = 10 ** coordinate_precision
+        return np.round(np.asarray(latitudes) * scale).astype(np.int64), np.round(np.asarray(longitudes) * scale).astype(np.int64)
+
+    def _block_path(self, block_id, name):
+        return os.path.join(self.path, f'block{block_id}_{name}.npy')
+
+    def _load_block(self, block_id):
+        """Row ids, column ids, durations and distances of a block, the matrices memory mapped."""
+        return tuple(np.load(self._block_path(block_id, name), mmap_mode=None if name in ('rows', 'cols') else 'r')
+                     for name in block_arrays)
+
+    def _save_block(self, block_id, arrays):
+        for name, array in zip(block_arrays, arrays):
+            temporary_path = self._block_path(block_id, name) + '.tmp'
+            with open(temporary_path, 'wb') as opened:
+                np.save(opened, array)
+            os.replace(temporary_path, self._block_path(block_id, name))
+
+    def _remove_block(self, block_id):
+        self.connection.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
+        for name in block_arrays:
+            if os.path.exists(self._block_path(block_id, name)):
+                os.remove(self._block_path(block_id, name))
+
+    def _block_ids(self):
+        return [block_id for (block_id,) in self.connection.execute('SELECT id FROM blocks ORDER BY id')]
+
+    def _point_ids(self, latitudes, longitudes, positions):
+        """Cache ids and snapping of the locations at positions that are in the cache."""
+        lats, lons = self.quantize(latitudes, longitudes)
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS requested (position INTEGER PRIMARY KEY, lat INTEGER, lon INTEGER)')
+        self.connection.execute('DELETE FROM requested')
+        self.connection.executemany('INSERT INTO requested VALUES (?, ?, ?)',
+                                    zip(positions.tolist(), lats[positions].tolist(), lons[positions].tolist()))
+        rows = self.connection.execute('''
+            SELECT requested.position, points.id, points.snapped_lat, points.snapped_lon, points.snapped_dist
+            FROM requested JOIN points ON requested.lat = points.lat AND requested.lon = points.lon
+        ''').fetchall()
+        return np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+    def _touch(self, ids):
+        """Marks locations as used now, so they aren't evicted."""
+        self.connection.executemany('UPDATE points SET last_seen = ? WHERE id = ?',
+                                    zip([time.time()] * len(ids), np.unique(ids).tolist()))
+
+    @staticmethod
+    def _match(block_ids, position_ids):
+        """Requested positions whose location is among block_ids, and the index of that location in the block."""
+        if len(block_ids) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        order = np.argsort(block_ids)
+        found = np.minimum(np.searchsorted(block_ids, position_ids, sorter=order), len(block_ids) - 1)
+        positions = np.flatnonzero(block_ids[order[found]] == position_ids)
+        return positions, order[found[positions]]
+
+    def lookup(self, latitudes, longitudes, durations, distances, snapped_gps_coords, snapped_dists):
+        """
+        Fills in the cached values between locations.
+
+        Args:
+            latitudes, longitudes (np arrays): locations
+            durations, distances (nxn np arrays): filled in place for cached pairs
+            snapped_gps_coords (nx2 np array), snapped_dists (np array): filled in place for cached locations
+        Returns:
+            Positions of the locations with at least one pair missing from the cache
+        """
+        size = len(latitudes)
+        points = self._point_ids(latitudes, longitudes, np.arange(size))
+        positions = points[:,0].astype(np.int64)
+        snapped_gps_coords[positions] = points[:,2:4]
+        snapped_dists[positions] = points[:,4]
+
+        position_ids = np.full(size, -1, dtype=np.int64)
+        position_ids[positions] = points[:,1].astype(np.int64)
+        with self.connection:
+            self._touch(position_ids[positions])
+
+        known = np.zeros((size, size), dtype=bool)
+        for block_id in self._block_ids():
+            try:
+                row_ids, col_ids, block_durations, block_distances = self._load_block(block_id)
+            except (OSError, ValueError) as error:
+                logging.warning(f'Dropping unreadable matrix cache block {block_id}: {error}')
+                with self.connection:
+                    self._remove_block(block_id)
+                continue
+            rows, local_rows = self._match(row_ids, position_ids)
+            cols, local_cols = self._match(col_ids, position_ids)
+            if len(rows) == 0 or len(cols) == 0:
+                continue
+            block = np.ix_(rows, cols)
+            stored_durations = block_durations[np.ix_(local_rows, local_cols)]
+            computed = ~(stored_durations < 0)
+            durations[block] = np.where(computed, stored_durations, durations[block])
+            distances[block] = np.where(computed, block_distances[np.ix_(local_rows, local_cols)], distances[block])
+            known[block] |= computed
+
+        #Locations not in the cache are queried, plus cached ones with a pair between them missing
+        cached = position_ids >= 0
+        missing_pairs = ~known & cached[:, None] & cached[None, :]
+        return np.flatnonzero(~cached | missing_pairs.any(axis=0) | missing_pairs.any(axis=1))
+
+    def store(self, latitudes, longitudes, positions, durations, distances, snapped_gps_coords, snapped_dists):
+        """
+        Adds the rows and columns of newly queried locations to the cache as one
+        block. Locations that could not be snapped are left out so they are
+        queried again.
+
+        Args:
+            latitudes, longitudes (np arrays): locations
+            positions (np array of ints): positions of the queried locations
+            durations, distances (nxn np arrays): matrices over all locations
+            snapped_gps_coords (nx2 np array), snapped_dists (np array): snapping of all locations
+        Returns:
+            None
+        """
+        snapped = ~np.isnan(snapped_dists)
+        positions = positions[snapped[positions]]
+        if len(positions) == 0:
+            return
+
+        lats, lons = self.quantize(latitudes, longitudes)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO points (lat, lon, snapped_lat, snapped_lon, snapped_dist, last_seen) VALUES (?, ?, ?, ?, ?, ?)',
+                zip(lats[positions].tolist(), lons[positions].tolist(), snapped_gps_coords[positions, 0].tolist(),
+                    snapped_gps_coords[positions, 1].tolist(), snapped_dists[positions].tolist(), [time.time()] * len(positions)))
+
+            points = self._point_ids(latitudes, longitudes, np.flatnonzero(snapped))
+            ids = np.full(len(latitudes), -1, dtype=np.int64)
+            ids[points[:,0].astype(np.int64)] = points[:,1].astype(np.int64)
+            self._touch(ids[positions])
+
+            #The queried rows against every location, then the other locations' columns of the queried ones
+            all_positions = np.flatnonzero(snapped)
+            others = np.setdiff1d(all_positions, positions)
+            for rows, cols in ((positions, all_positions), (others, positions)):
+                if len(rows) == 0:
+                    continue
+                block_id = self.connection.execute('INSERT INTO blocks DEFAULT VALUES').lastrowid
+                self._save_block(block_id, (ids[rows], ids[cols], durations[np.ix_(rows, cols)], distances[np.ix_(rows, cols)]))
+
+        if len(self._block_ids()) > max_blocks:
+            self.compact()
+
+    def compact(self):
+        """
+        Merges all blocks into one over every location they hold. Pairs none of
+        them holds get not_computed durations. The merged matrices are written
+        to disk directly, so they don't need to fit in memory.
+
+        Returns:
+            None
+        """
+        block_ids = self._block_ids()
+        blocks = []
+        for block_id in block_ids:
+            try:
+                blocks.append(self._load_block(block_id))
+            except (OSError, ValueError):
+                continue
+        if len(blocks) == 0:
+            return
+        ids = np.unique(np.concatenate([np.concatenate([row_ids, col_ids]) for row_ids, col_ids, _, _ in blocks]))
+        logging.info(f'Merging {len(block_ids)} matrix cache blocks over {len(ids)} locations')
+
+        with self.connection:
+            merged_id = self.connection.execute('INSERT INTO blocks DEFAULT VALUES').lastrowid
+            def temporary_path(name):
+                return self._block_path(merged_id, name) + '.tmp'
+            durations = np.lib.format.open_memmap(temporary_path('durations'), mode='w+', dtype=np.float64, shape=(len(ids), len(ids)))
+            distances = np.lib.format.open_memmap(temporary_path('distances'), mode='w+', dtype=np.float64, shape=(len(ids), len(ids)))
+            durations[:] = not_computed
+            distances[:] = np.nan
+            #Blocks are applied oldest first, so newer values win as they do on lookup
+            for row_ids, col_ids, block_durations, block_distances in blocks:
+                merged = np.ix_(np.searchsorted(ids, row_ids), np.searchsorted(ids, col_ids))
+                durations[merged] = block_durations
+                distances[merged] = block_distances
+            durations.flush()
+            distances.flush()
+            del durations, distances, blocks
+
+            for name in ('rows', 'cols'):
+                with open(temporary_path(name), 'wb') as opened:
+                    np.save(opened, ids)
+            for name in block_arrays:
+                os.replace(temporary_path(name), self._block_path(merged_id, name))
+            for block_id in block_ids:
+                self._remove_block(block_id)
+
+    def evict(self, cutoff):
+        """
+        Drops the locations last used before cutoff, rewriting the blocks that
+        hold them and removing blocks left empty.
+
+        Args:
+            cutoff (float): unix time
+        Returns:
+            None
+        """
+        stale = np.array([point_id for (point_id,) in self.connection.execute('SELECT id FROM points WHERE last_seen < ?', (cutoff,))],
+                         dtype=np.int64)
+        if len(stale) == 0:
+            return
+
+        logging.info(f'Evicting {len(stale)} locations unused for {max_age_days} days from the matrix cache')
+        with self.connection:
+            self.connection.execute('DELETE FROM points WHERE last_seen < ?', (cutoff,))
+            for block_id in self._block_ids():
+                try:
+                    row_ids, col_ids, block_durations, block_distances = self._load_block(block_id)
+                except (OSError, ValueError):
+                    self._remove_block(block_id)
+                    continue
+                kept_rows = np.flatnonzero(~np.isin(row_ids, stale))
+                kept_cols = np.flatnonzero(~np.isin(col_ids, stale))
+                if len(kept_rows) == len(row_ids) and len(kept_cols) == len(col_ids):
+                    continue
+                if len(kept_rows) == 0 or len(kept_cols) == 0:
+                    self._remove_block(block_id)
+                    continue
+                kept = np.ix_(kept_rows, kept_cols)
+                self._save_block(block_id, (row_ids[kept_rows], col_ids[kept_cols],
+                                            np.array(block_durations[kept]), np.array(block_distances[kept])))
@@ -16,6 +16,8 @@ import time
 from time import strftime, gmtime
 import os
 import traceback
+import concurrent.futures
+import multiprocessing
 logging.getLogger().setLevel(logging.INFO)
 
 from scipy.cluster.hierarchy import linkage
@@ -26,13 +28,14 @@ from sklearn import decomposition
 import math
 
 import string
-import ujson
 
 import manual_viz
+from build_time_dist_matrix import MatrixBlocks
 import file_config
 from visualization import colorList, color_names
 from output.route_solution_data import IntermediateOptimizationSolution, FinalOptimizationSolution
 import osrmbindings
+import osrm_engines
 
 resequencing = True
 resequencing_step_size = 0.0002 # Arbitrary and small, in the scale of long/lat degrees
@@ -50,10 +53,35 @@ max_time_horizon = 24*60*60
 color_naming = True
 north_south_ordering = True
 
+default_load_time_mins = 2.5 #Service time per stop when there is no zone config (e.g. manual edits)
+unload_arc_cost = 10000000 #Cost of arcs between unload points, or between them and start/end points (big number, the vehicle just started or is ending its run)
+transit_matrix_max_nodes = 4000 #Larger problems register their arc costs as cached callbacks instead of N x N Python lists, see register_arc_costs
+
+parallel_zone_workers = None #Processes used when global_solver_options sets parallel_zones, None for one per zone up to the CPU count
+
+#Search configurations run side by side when global_solver_options sets portfolio to true, a list of configurations can be given instead.
+#Strategy and metaheuristic names are OR-tools' FirstSolutionStrategy and LocalSearchMetaheuristic values, seed reseeds the solver
+#(only changes randomized searches). Configurations that find no solution (e.g. some strategies with unload slack) are skipped.
+#Only the first portfolio_workers configurations run, and with fast_run their metaheuristics are ignored so each stops at its first local optimum
+default_portfolio = [
+    {'first_solution_strategy': 'PATH_MOST_CONSTRAINED_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'SAVINGS', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'PATH_MOST_CONSTRAINED_ARC', 'metaheuristic': 'TABU_SEARCH'},
+]
+portfolio_workers = None #Processes solving a portfolio (its own included), None for the CPU count. Shared between zones with parallel_zones
+
+early_stopping_epsilon = 0.001 #Relative objective improvement below which a solution doesn't count as an improvement, when early stopping is set
+
 vehicle_surplus_factor = 1 #2 would mean twice as many vehicle per zone as the total demand requires
 
 verbose = False
 
+#Settings above a run may change, handed to the processes solving zones with parallel_zones as they are spawned with the defaults
+worker_settings = ['resequencing', 'resequencing_step_size', 'clustering_agglomeration', 'agg_threshold_radius', 'agglomeration_sprawling',
+                   'reoptimize_subnodes', 'reoptimize_time_factor', 'max_time_horizon', 'default_load_time_mins', 'unload_arc_cost',
+                   'transit_matrix_max_nodes', 'default_portfolio', 'portfolio_workers', 'early_stopping_epsilon', 'vehicle_surplus_factor', 'verbose']
+
 def clean_up_time(hour):
     hour = hour.strip()
     if hour.endswith('AM'):
@@ -168,13 +196,40 @@ def get_last_time(data, manager, routing, assignment):
 
     return total_time
 
+class ProfileMatrices():
+    """Time, distance and elevation cost matrices of one vehicle profile over
+    the nodes of a problem, shared by every vehicle using that profile"""
+    def __init__(self, node_data, profile, selected):
+        """
+        :param node_data (NodeData): nodes with their OSRM matrices
+        :param profile (str): vehicle profile
+        :param selected (array of ints): positions of the problem's nodes in node_data
+        """
+        self.profile = profile
+        self.selected = np.asarray(selected, dtype=int)
+        self.time_distance = self._select(node_data.get_time_or_dist_mat(veh=profile, time_or_dist='time'))
+        self.travel_distance = self._select(node_data.get_time_or_dist_mat(veh=profile, time_or_dist='dist'))
+        self.elevation_cost = self._select(node_data.get_time_or_dist_mat(veh=profile, time_or_dist='elevation'))
+
+    def _select(self, matrix):
+        """Submatrix of the selected nodes, the matrix itself when all are selected in order"""
+        if matrix is None:
+            return None
+        if isinstance(matrix, MatrixBlocks):
+            return matrix.select(self.selected)
+        if len(self.selected) == matrix.shape[0] and np.array_equal(self.selected, np.arange(len(self.selected))):
+            return matrix
+        return matrix[np.ix_(self.selected, self.selected)]
+
 class Vehicle():
     """Stores the property of a vehicle"""
     def __init__(self, time_distance=None, travel_distance=None, elevation_cost=None,
                  capacity=45, name=None, osrm_profile=None,
-                 start=None, end=None):
-        """Initializes the vehicle properties"""
+                 start=None, end=None, matrices=None):
+        """Initializes the vehicle properties, matrices (ProfileMatrices) replaces the separate matrices and
+        is set by the DataProblem the vehicle is in"""
         self._capacity = capacity
+        self._matrices = matrices
         self._time_distance = time_distance
         self._travel_distance = travel_distance
         self._elevation_cost = elevation_cost
@@ -188,19 +243,34 @@ class Vehicle():
         """Gets vehicle capacity"""
         return self._capacity
 
+    @property
+    def matrices(self):
+        """ProfileMatrices shared with the other vehicles of this profile"""
+        return self._matrices
+
+    @matrices.setter
+    def matrices(self, matrices):
+        self._matrices = matrices
+
     @property
     def time_distance_matrix(self):
         """time matrices from node to node"""
+        if self._matrices is not None:
+            return self._matrices.time_distance
         return self._time_distance
 
     @property
     def travel_distance_matrix(self):
         """time matrices from node to node"""
+        if self._matrices is not None:
+            return self._matrices.travel_distance
         return self._travel_distance
 
     @property
     def elevation_cost_matrix(self):
         """time + elevation costs matrices from node to node"""
+        if self._matrices is not None:
+            return self._matrices.elevation_cost
         return self._elevation_cost
 
     @property
@@ -237,22 +307,9 @@ class DataProblem():
         self._num_vehicles = len(self._vehicle)
         
         if config:
-#             ## WHY is this here ? We filter in the built_time_dist_matrix.py - filter_nodedata function
-#             _boolean_selected = np.where((node_data.type_name[:, 0] == 'Customer') 
-#                                          | (node_data.type_name[:, 1] == config['Start_Point'])
-#                                          | (node_data.type_name[:, 1] == config['End_Point']))[0]
-
             _boolean_selected = [i for i in range(len(node_data.all_clean_nodes))]
         elif node_name_ordered:
-            _boolean_selected = np.array([])
-            for node_name in node_name_ordered:
-                _boolean_selected = np.append(_boolean_selected, np.where(node_data.names==node_name)[0])
-            _boolean_selected = _boolean_selected.astype(int)
-
-            #_boolean_selected = np.array([])
-            for node_name in node_name_ordered:
-                _boolean_selected = np.append(_boolean_selected, np.where(node_data.names==node_name)[0])
-            _boolean_selected = _boolean_selected.astype(int)
+            _boolean_selected = node_data.rows_for_names(node_name_ordered)
 
         if verbose:
             print("Node filtering")
@@ -261,9 +318,14 @@ class DataProblem():
         self._boolean_selected = _boolean_selected
         self._locations = node_data.lat_long_coords[_boolean_selected]
         self._demands = node_data.get_attr('buckets')[_boolean_selected]
-        self._distance = node_data.get_time_or_dist_mat(veh=vehicle[0].osrm_profile, time_or_dist='dist')[_boolean_selected][:,_boolean_selected]
-        self._time_distance = node_data.get_time_or_dist_mat(veh=vehicle[0].osrm_profile, time_or_dist='time')[_boolean_selected][:,_boolean_selected]
-        self._elevation_cost = node_data.get_time_or_dist_mat(veh=vehicle[0].osrm_profile, time_or_dist='elevation')[_boolean_selected][:,_boolean_selected]
+
+        # One set of matrices per profile over the problem's nodes, the vehicles index into them instead of holding copies
+        self.profile_matrices = {}
+        for v in vehicle:
+            if v.osrm_profile not in self.profile_matrices:
+                self.profile_matrices[v.osrm_profile] = ProfileMatrices(node_data, v.osrm_profile, _boolean_selected)
+            v.matrices = self.profile_matrices[v.osrm_profile]
+        self._matrices = self.profile_matrices[vehicle[0].osrm_profile]
         
         self.dfverbose = node_data.df_gps_verbose.iloc[_boolean_selected].reset_index()
 
@@ -340,7 +402,6 @@ class DataProblem():
         if verbose:
             logging.info('Time windows', self._time_windows)
         
-        default_load_time_mins = 2.5
         if config is not None:
             self._load_time = config['load_time']*60
         else:
@@ -387,15 +448,15 @@ class DataProblem():
 
     @property
     def time_distance(self):
-        return self._time_distance
+        return self._matrices.time_distance
 
     @property
     def distance_matrix(self):
-        return self._distance
+        return self._matrices.travel_distance
 
     @property
     def elevation_cost(self):
-        return self._elevation_cost
+        return self._matrices.elevation_cost
 
 class CreateTimeEvaluator(object):
     """Creates callback to get total times between locations.
@@ -480,11 +541,11 @@ class ConsolePrinter():
                 node_index = self.manager.IndexToNode(index)
                 next_node_index = self.manager.IndexToNode(
                     self.assignment.Value(self.routing.NextVar(index)))
-                route_dist += self.data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index]
+                route_dist += int(self.data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index])
                 load_var = capacity_dimension.CumulVar(index)
                 time_var = time_dimension.CumulVar(index)
                 route_load = self.assignment.Value(load_var)
-                route_time += self.data.vehicle[vehicle_id].time_distance_matrix[node_index][next_node_index]
+                route_time += float(self.data.vehicle[vehicle_id].time_distance_matrix[node_index][next_node_index])
                 time_value = self.assignment.Value(time_var)
                 #transit_quantity = self.assignment.Value(transit_var)
                 plan_output += ' {0} Load({2}) Time({1:3.3}) Window({3})->'.format(node_index,route_time, route_load, time_value)
@@ -572,23 +633,12 @@ def create_vehicle(node_data, config):
     # Determine number of vehicles or trips available 
     if config['enable_unload']: 
         
-        all_start_end_options = []
-        for v in config['unload_vehicles']:
-            all_start_end_options.extend(v[2:])
-        all_start_end_options =  list(set(all_start_end_options))
-        _boolean_selected = np.where(np.isin(node_data.all_clean_nodes[:,1], all_start_end_options)
-                   | (node_data.all_clean_nodes[:,0]=='Customer') )[0]
-        
         # If we are using unloads then the vehicle creation is different
         vehicles_details = config['unload_vehicles']
         vehicles = []
         for vec in vehicles_details:   #, "Zone , 3 Wheeler, Cap 81"
-            _time_distance = node_data.get_time_or_dist_mat(veh = vec[0], time_or_dist='time')[_boolean_selected][:,_boolean_selected]   
-            _travel_distance = node_data.get_time_or_dist_mat(veh = vec[0], time_or_dist='dist')[_boolean_selected][:,_boolean_selected]
-            _elevation_cost = node_data.get_time_or_dist_mat(veh = vec[0], time_or_dist='elevation')[_boolean_selected][:,_boolean_selected]
-        
             metadata = f"{'-'.join(config['optimized_region'])} , {vec[0]}, Cap {vec[1]}"
-            vehicles.append(Vehicle(_time_distance, _travel_distance, _elevation_cost, vec[1], metadata, vec[0], vec[2], vec[3]))
+            vehicles.append(Vehicle(capacity=vec[1], name=metadata, osrm_profile=vec[0], start=vec[2], end=vec[3]))
                    
     else:
         total_demand = sum([i for i in node_data.get_attr('buckets')[_boolean_selected] if i > 0])
@@ -601,81 +651,181 @@ def create_vehicle(node_data, config):
         
         vehicles = []
         for vec in range(num_vehicle_type): # TODO - if there are multiple vehicle types then we create a lot of extra vehicles
-            _time_distance = node_data.get_time_or_dist_mat(veh = vehicle_profile[vec][0], time_or_dist='time')[_boolean_selected][:,_boolean_selected]   
-            _travel_distance = node_data.get_time_or_dist_mat(veh = vehicle_profile[vec][0], time_or_dist='dist')[_boolean_selected][:,_boolean_selected]
-            _elevation_cost = node_data.get_time_or_dist_mat(veh = vehicle_profile[vec][0], time_or_dist='elevation')[_boolean_selected][:,_boolean_selected]
-            
             # Create some summary info for display purposes on maps
             metadata = f"{'-'.join(config['optimized_region'])} , {vehicle_profile[vec][0]}, Cap {vehicle_profile[vec][1]}"
             vehicles = vehicles + [
-                        Vehicle(_time_distance,_travel_distance, _elevation_cost, vehicle_profile[vec][1], 
-                                metadata, vehicle_profile[vec][0], config['Start_Point'][0], config['End_Point'][0]) 
+                        Vehicle(capacity=vehicle_profile[vec][1], name=metadata, osrm_profile=vehicle_profile[vec][0],
+                                start=config['Start_Point'][0], end=config['End_Point'][0]) 
                             for j in range(vehicle_number)
                         ]
     return vehicles
 
 
-def get_optimal_route(data, vehicles, dist_or_time='time', warmed_up = None, max_solver_time_min=2, soft_upper_bound_value=0, soft_upper_bound_penalty=0, span_cost_coefficient=0, clustering_radius=None, fast_run=False, presolved=False, presolved_from_past=False):
-    # Ignores clustering_radius locally, the config argument is taken in globally earlier in the flow
-    manager = pywrapcp.RoutingIndexManager(int(data.num_locations),
-                                        int(data.num_vehicles), 
-                                       [int(data.names_to_nodes[i.start]) for i in vehicles],
-                                       [int(data.names_to_nodes[i.end]) for i in vehicles])
+def create_service_times(data):
+    """
+    Service time of each node, counted on the arcs leaving it. Supernodes are clusters
+    of nearby locations, their service time adds the typical amount of travel time
+    between the locations, which is the aggregation radius.
 
-    routing = pywrapcp.RoutingModel(manager)
+    Args:
+        data (DataProblem): problem the service times are for
+    Returns:
+        Numpy array (int64) of service times by node
+    """
+    service_time = int(data.time_per_demand_unit) # adjust when config suggests the number of containers increases the load time
+    service_times = np.full(data.num_locations, service_time, dtype=np.int64)
+    if data.node_clusters:
+        points = set(data.all_start_points+data.all_end_points)
+        for node in range(data.num_locations):
+            if node not in points:
+                service_times[node] = int(len(data.node_clusters[node])*(service_time + agg_threshold_radius))
+    return service_times
+
+def create_arc_cost_matrix(data, distance_matrix, service_times):
+    """
+    Cost of each arc for a vehicle: travel cost from distance_matrix plus the service
+    time at the start node, unload_arc_cost between unload points and between them
+    and start/end points, no travel cost from a node to itself.
 
-    # Define Specific Vehicle Costs - Allows for vehicles with different costs 
-    # keep transit callback alive
-    transit_callback = []
-    transit_callback_index_arr = []
-    for vehicle_id in range(0, data.num_vehicles):
-            
-        if dist_or_time == 'time':
-            distance_matrix = vehicles[vehicle_id].time_distance_matrix
-        elif dist_or_time == 'dist':
-            distance_matrix = vehicles[vehicle_id].travel_distance_matrix
-        elif data.consider_elevation:
-            distance_matrix = vehicles[vehicle_id].elevation_cost_matrix
-
-        def distance_callback_vehicle(from_index, to_index, data=distance_matrix, service_time = int(data.time_per_demand_unit), clusters=data.node_clusters, points = data.all_start_points+data.all_end_points, unload_indices = data.unload_indices):
-            # Convert from routing variable Index to distance matrix NodeIndex.
-            from_node = manager.IndexToNode(int(from_index))
-            to_node = manager.IndexToNode(int(to_index))
-            
-            total_service_time = service_time # adjust when config suggests the number of containers increases the load time (and think about supernodes/clusters too)
-            if clusters and from_node not in points:
-                cluster = clusters[from_node]
-                total_service_time = int(len(cluster)*(service_time + agg_threshold_radius)) # supernodes are cluster of nearby locations and we're adding the typical amount of travel time between the locations which is the aggregation radius
-            
-            travel_time = 0
-            if from_node == to_node:
-                travel_time = 0
-            elif from_node in unload_indices and to_node in unload_indices:
-                travel_time = 10000000 #big number
-            elif from_node in points and to_node in unload_indices:
-                travel_time = 10000000 #another big number because that vehicle just started
-            elif from_node in unload_indices and to_node in points:
-                travel_time = 10000000 #another big number because that vehicle is ending its run
-            else:
-                travel_time = data[from_node][to_node]
-            
-            return int(travel_time)+int(total_service_time)
+    Args:
+        data (DataProblem): problem the costs are for
+        distance_matrix (array like): vehicle's time, distance or elevation costs between nodes
+        service_times (np array): from create_service_times
+    Returns:
+        Numpy array (int64) of arc costs, indexed by from node and to node
+    """
+    arc_costs = np.array(distance_matrix).astype(np.int64)
+    unload = np.zeros(data.num_locations, dtype=bool)
+    unload[list(data.unload_indices)] = True
+    points = np.zeros(data.num_locations, dtype=bool)
+    points[data.all_start_points+data.all_end_points] = True
+    arc_costs[np.ix_(unload, unload)] = unload_arc_cost
+    arc_costs[np.ix_(points, unload)] = unload_arc_cost
+    arc_costs[np.ix_(unload, points)] = unload_arc_cost
+    np.fill_diagonal(arc_costs, 0)
+    return arc_costs + service_times[:, np.newaxis]
+
+def get_cost_matrix(vehicle, data, dist_or_time='time'):
+    """Vehicle's time, distance or elevation cost matrix the arc costs are computed from, None if
+    elevation costs are asked for a problem that doesn't consider elevation"""
+    if dist_or_time == 'time':
+        return vehicle.time_distance_matrix
+    elif dist_or_time == 'dist':
+        return vehicle.travel_distance_matrix
+    elif data.consider_elevation:
+        return vehicle.elevation_cost_matrix
+    return None
+
+def register_arc_costs(routing, manager, arc_costs, registered_costs):
+    """
+    Transit evaluator of an arc cost matrix, registered unless an identical matrix already was.
 
-        transit_callback.append(distance_callback_vehicle)
-        transit_callback_index_arr.append(routing.RegisterTransitCallback(transit_callback[-1]))
-        routing.SetArcCostEvaluatorOfVehicle(transit_callback_index_arr[-1], vehicle_id) #TODO change it to probably the time evaluator
+    RegisterTransitMatrix takes a list of lists, so each matrix it registers is briefly held
+    as N x N Python ints (about 36 bytes an arc, 580MB for 4000 nodes) next to the solver's
+    own int64 copy. Above transit_matrix_max_nodes a callback reading arc_costs is registered
+    instead. get_optimal_route lets these problems cache callbacks, so the solver evaluates it
+    once into its cache when it is registered and never calls back into Python during the search.
+
+    Args:
+        routing (RoutingModel): model the evaluator is registered with
+        manager (RoutingIndexManager): index manager of the model
+        arc_costs (np array): from create_arc_cost_matrix
+        registered_costs (list): (arc costs, evaluator index) of the matrices registered so far,
+        the new matrix is appended
+    Returns:
+        evaluator index
+    """
+    for costs, evaluator_index in registered_costs:
+        if np.array_equal(costs, arc_costs):
+            return evaluator_index
+    if len(arc_costs) <= transit_matrix_max_nodes:
+        evaluator_index = routing.RegisterTransitMatrix(arc_costs.tolist())
+    else:
+        def arc_cost(from_index, to_index):
+            return arc_costs.item(manager.IndexToNode(from_index), manager.IndexToNode(to_index))
+        evaluator_index = routing.RegisterTransitCallback(arc_cost)
+    registered_costs.append((arc_costs, evaluator_index))
+    return evaluator_index
 
-   
-    def create_demand_evaluator(data):
-        """Creates callback to get demands at each location."""
-        _demands = data.demands
+def register_arc_cost_evaluators(routing, manager, data, vehicles, dist_or_time='time'):
+    """
+    Registers the precomputed arc costs of the vehicles and sets them as their arc cost evaluators.
+    Vehicles sharing matrices (same profile) are one class whose costs are computed once, and
+    classes with identical costs share an evaluator, so the solver caches it once and groups
+    the vehicles in the same cost/dimension classes.
 
-        def demand_evaluator(manager, node):
-            """Returns the demand of the current node"""
-            return int(_demands[manager.IndexToNode(int(node))])
+    Returns:
+        list of the evaluator index of each vehicle, for its dimensions
+    """
+    service_times = create_service_times(data)
+    class_transit_index = {}
+    registered_costs = []
+    transit_callback_index_arr = []
+    for vehicle_id in range(0, data.num_vehicles):
+        vehicle_class = vehicles[vehicle_id].matrices if vehicles[vehicle_id].matrices is not None else vehicles[vehicle_id]
+        if vehicle_class not in class_transit_index:
+            arc_costs = create_arc_cost_matrix(data, get_cost_matrix(vehicles[vehicle_id], data, dist_or_time), service_times)
+            class_transit_index[vehicle_class] = register_arc_costs(routing, manager, arc_costs, registered_costs)
+        transit_callback_index_arr.append(class_transit_index[vehicle_class])
+        routing.SetArcCostEvaluatorOfVehicle(transit_callback_index_arr[-1], vehicle_id) #TODO change it to probably the time evaluator
+    return transit_callback_index_arr
+
+class ConvergenceMonitor():
+    """Stops a routing search once the objective stops improving: after window_sec seconds
+    or max_solutions solutions without a relative improvement above epsilon.
+    It is checked at each solution the search finds, which keeps coming with a metaheuristic
+    (without one, the search already stops at the first local optimum)."""
+    def __init__(self, routing, window_sec=None, max_solutions=None, epsilon=early_stopping_epsilon):
+        """
+        :param routing (RoutingModel): model being solved
+        :param window_sec (float): seconds without improvement before stopping, None to ignore
+        :param max_solutions (int): solutions without improvement before stopping, None to ignore
+        :param epsilon (float): relative improvement needed to count as an improvement
+        """
+        self._routing = routing
+        self._window_sec = window_sec
+        self._max_solutions = max_solutions
+        self._epsilon = epsilon
+        self._best_cost = None
+        self._improved_at = time.perf_counter()
+        self._solutions_since = 0
+
+    def __call__(self):
+        """At solution callback"""
+        cost = self._routing.CostVar().Max()
+        if self._best_cost is None or cost < self._best_cost * (1 - self._epsilon):
+            self._best_cost = cost
+            self._improved_at = time.perf_counter()
+            self._solutions_since = 0
+            return
+
+        self._solutions_since += 1
+        stalled_sec = time.perf_counter() - self._improved_at
+        if (self._window_sec is not None and stalled_sec >= self._window_sec) or \
+           (self._max_solutions is not None and self._solutions_since >= self._max_solutions):
+            logging.info(f'Search converged at cost {self._best_cost}: {self._solutions_since} solutions in {stalled_sec:.1f}s without improvement')
+            self._routing.solver().FinishCurrentSearch()
+
+def build_routing_model(data, vehicles, dist_or_time='time', max_solver_time_min=2, soft_upper_bound_value=0, soft_upper_bound_penalty=0, span_cost_coefficient=0, fast_run=False, presolved=False, early_stopping_window_sec=None, early_stopping_solutions=None, early_stopping_epsilon=early_stopping_epsilon):
+    """Builds the routing model get_optimal_route solves, the arguments are those of get_optimal_route.
+
+    Returns:
+        (RoutingModel, RoutingIndexManager, RoutingSearchParameters)
+    """
+    # early_stopping_* stop the search before the time limit once the objective stops improving, see ConvergenceMonitor
+    manager = pywrapcp.RoutingIndexManager(int(data.num_locations),
+                                        int(data.num_vehicles), 
+                                       [int(data.names_to_nodes[i.start]) for i in vehicles],
+                                       [int(data.names_to_nodes[i.end]) for i in vehicles])
 
+    routing_parameters = pywrapcp.DefaultRoutingModelParameters()
+    if data.num_locations > transit_matrix_max_nodes:
+        # Callbacks are evaluated once into the solver's own cache instead of during the search, see register_arc_costs
+        routing_parameters.max_callback_cache_size = int(data.num_locations)
+    routing = pywrapcp.RoutingModel(manager, routing_parameters)
 
-        return demand_evaluator
+    # Define Specific Vehicle Costs - Allows for vehicles with different costs 
+    transit_callback_index_arr = register_arc_cost_evaluators(routing, manager, data, vehicles, dist_or_time)
 
     def add_capacity_constraints(routing, data, demand_evaluator_index):
         """Adds capacity constraint"""
@@ -701,8 +851,7 @@ def get_optimal_route(data, vehicles, dist_or_time='time', warmed_up = None, max
             capacity_dimension.SetCumulVarSoftUpperBound(index, soft_upper_bound_value, soft_upper_bound_penalty)
         
         # Add Capacity constraint
-    demand_evaluator_index = routing.RegisterUnaryTransitCallback(
-        partial(create_demand_evaluator(data), manager))
+    demand_evaluator_index = routing.RegisterUnaryTransitVector([int(demand) for demand in data.demands])
     add_capacity_constraints(routing, data, demand_evaluator_index)
 
     def add_time_window_constraints(routing, manager, data, time_evaluator_index):
@@ -777,7 +926,7 @@ def get_optimal_route(data, vehicles, dist_or_time='time', warmed_up = None, max
                     return  clusters, grp_c[grp_c.d > .60 * cap].c.values
 
     if data.cluster:
-        linkage_matrix = linkage(distance_matrix, "centroid")
+        linkage_matrix = linkage(get_cost_matrix(vehicles[-1], data, dist_or_time), "centroid")
         
         cap = vehicles[0].capacity
 
@@ -827,37 +976,197 @@ def get_optimal_route(data, vehicles, dist_or_time='time', warmed_up = None, max
             routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
     
     solver = routing.solver()  
+    if early_stopping_window_sec is not None or early_stopping_solutions is not None:
+        convergence_monitor = ConvergenceMonitor(routing, early_stopping_window_sec, early_stopping_solutions, early_stopping_epsilon)
+        routing.AddAtSolutionCallback(convergence_monitor)
 
     time_dimension = routing.GetDimensionOrDie('Time')
     capacity_dimension = routing.GetDimensionOrDie('Capacity')
-        
+    return routing, manager, search_parameters
+
+def get_optimal_route(data, vehicles, dist_or_time='time', warmed_up = None, max_solver_time_min=2, soft_upper_bound_value=0, soft_upper_bound_penalty=0, span_cost_coefficient=0, clustering_radius=None, fast_run=False, presolved=False, presolved_from_past=False, parallel_zones=False, portfolio=None, early_stopping_window_sec=None, early_stopping_solutions=None, early_stopping_epsilon=early_stopping_epsilon):
+    # Ignores clustering_radius and parallel_zones locally, the config arguments are taken in globally earlier in the flow
+    # portfolio solves the model with several search configurations (see default_portfolio) side by side and keeps the best routes
+    model_options = dict(dist_or_time=dist_or_time, max_solver_time_min=max_solver_time_min, soft_upper_bound_value=soft_upper_bound_value,
+                         soft_upper_bound_penalty=soft_upper_bound_penalty, span_cost_coefficient=span_cost_coefficient, fast_run=fast_run,
+                         presolved=presolved, early_stopping_window_sec=early_stopping_window_sec,
+                         early_stopping_solutions=early_stopping_solutions, early_stopping_epsilon=early_stopping_epsilon)
+    routing, manager, search_parameters = build_routing_model(data, vehicles, **model_options)
+
     # Solve the problem.
-    if warmed_up is not None:
-        try:
-            if reoptimize_subnodes == 'strict': 
-                for vehicle_index, route in enumerate(warmed_up):
-                    for node_index in route:
-                        routing.VehicleVar(manager.NodeToIndex(int(node_index))).SetValues([-1, int(vehicle_index)])
-                        #routing.SetAllowedVehiclesForIndex([vehicle_index], manager.NodeToIndex(node_index))
-                search_parameters.time_limit.seconds = int(60 * max_solver_time_min * reoptimize_time_factor)
-                assignment = routing.SolveWithParameters(search_parameters)
-            elif reoptimize_subnodes == 'relaxed':
-                clustered_assignment = routing.ReadAssignmentFromRoutes(warmed_up, ignore_inactive_indices=True)
-                assignment = routing.SolveFromAssignmentWithParameters(clustered_assignment, search_parameters)
-            else:
-                routing.CloseModel()
-                assignment = routing.ReadAssignmentFromRoutes(warmed_up, ignore_inactive_indices=True)
-        except:
-            traceback.print_exc()
-            assignment = None
+    if portfolio and (warmed_up is None or reoptimize_subnodes in ['strict', 'relaxed']):
+        assignment = solve_portfolio(routing, manager, search_parameters, data, vehicles, model_options, portfolio, warmed_up=warmed_up)
     else:
-        assignment = routing.SolveWithParameters(search_parameters)
+        assignment = solve_model(routing, manager, search_parameters, warmed_up=warmed_up, max_solver_time_min=max_solver_time_min)
+    if warmed_up is None:
         assert assignment is not None, "No solution found, maybe increase allowed time or vehicles"
         
     #printer = ConsolePrinter(data, routing, assignment, manager)
     #printer.print()
     return assignment, manager, routing
 
+def solve_model(routing, manager, search_parameters, warmed_up=None, max_solver_time_min=2):
+    """Runs the search on a built routing model, from warmed_up routes when given (see reoptimize_subnodes).
+
+    Returns:
+        Assignment, None if no solution was found
+    """
+    if warmed_up is None:
+        return routing.SolveWithParameters(search_parameters)
+    try:
+        if reoptimize_subnodes == 'strict': 
+            for vehicle_index, route in enumerate(warmed_up):
+                for node_index in route:
+                    routing.VehicleVar(manager.NodeToIndex(int(node_index))).SetValues([-1, int(vehicle_index)])
+                    #routing.SetAllowedVehiclesForIndex([vehicle_index], manager.NodeToIndex(node_index))
+            search_parameters.time_limit.seconds = int(60 * max_solver_time_min * reoptimize_time_factor)
+            return routing.SolveWithParameters(search_parameters)
+        elif reoptimize_subnodes == 'relaxed':
+            clustered_assignment = routing.ReadAssignmentFromRoutes(warmed_up, ignore_inactive_indices=True)
+            return routing.SolveFromAssignmentWithParameters(clustered_assignment, search_parameters)
+        else:
+            routing.CloseModel()
+            return routing.ReadAssignmentFromRoutes(warmed_up, ignore_inactive_indices=True)
+    except:
+        traceback.print_exc()
+        return None
+
+def apply_search_configuration(routing, search_parameters, search_configuration):
+    """Sets up the search of a portfolio configuration.
+
+    Args:
+        routing: RoutingModel to solve
+        search_parameters: RoutingSearchParameters to update
+        search_configuration (dict): optional 'first_solution_strategy', 'metaheuristic' and 'seed', see default_portfolio
+    Returns:
+        None
+    """
+    if 'first_solution_strategy' in search_configuration:
+        search_parameters.first_solution_strategy = getattr(
+            routing_enums_pb2.FirstSolutionStrategy, search_configuration['first_solution_strategy'])
+    if 'metaheuristic' in search_configuration:
+        search_parameters.local_search_metaheuristic = getattr(
+            routing_enums_pb2.LocalSearchMetaheuristic, search_configuration['metaheuristic'])
+    if 'seed' in search_configuration:
+        routing.solver().ReSeed(int(search_configuration['seed']))
+
+def get_solution_values(routing, assignment):
+    """Reads the values of an assignment that the route outputs use: the next of each index
+    and the cumuls of each dimension, as [min, max] pairs.
+
+    Returns:
+        dict of the 'next' values and the cumuls by dimension name
+    """
+    values = {'next': [assignment.Value(routing.NextVar(index)) for index in range(routing.Size())]}
+    for dimension_name in routing.GetAllDimensionNames():
+        dimension = routing.GetDimensionOrDie(dimension_name)
+        cumuls = [dimension.CumulVar(index) for index in range(routing.Size() + routing.vehicles())]
+        values[dimension_name] = [[assignment.Min(cumul), assignment.Max(cumul)] for cumul in cumuls]
+    return values
+
+def assignment_from_values(routing, values, cost):
+    """Assignment of a routing model holding the values get_solution_values read from the
+    same model, built in another process.
+
+    Returns:
+        Assignment with cost as its objective value
+    """
+    assignment = routing.solver().Assignment()
+    for index, next_index in enumerate(values['next']):
+        assignment.Add(routing.NextVar(index))
+        assignment.SetValue(routing.NextVar(index), next_index)
+    for dimension_name in routing.GetAllDimensionNames():
+        dimension = routing.GetDimensionOrDie(dimension_name)
+        for index, (cumul_min, cumul_max) in enumerate(values[dimension_name]):
+            assignment.Add(dimension.CumulVar(index))
+            assignment.SetRange(dimension.CumulVar(index), cumul_min, cumul_max)
+    assignment.AddObjective(routing.CostVar())
+    assignment.SetObjectiveValue(cost)
+    return assignment
+
+def solve_portfolio_member(data, vehicles, model_options, search_configuration, warmed_up, settings):
+    """Builds the model of get_optimal_route and solves it with one portfolio configuration,
+    in a worker process of solve_portfolio. The process imports this module afresh, so the
+    run settings are handed over.
+
+    Args:
+        data, vehicles, model_options: as given to build_routing_model
+        search_configuration (dict): see apply_search_configuration
+        warmed_up: as in solve_model
+        settings (dict): values of the worker_settings of the run
+    Returns:
+        (objective value, values as read by get_solution_values), (None, None) if no solution was found
+    """
+    globals().update(settings)
+    routing, manager, search_parameters = build_routing_model(data, vehicles, **model_options)
+    apply_search_configuration(routing, search_parameters, search_configuration)
+    assignment = solve_model(routing, manager, search_parameters, warmed_up=warmed_up, max_solver_time_min=model_options['max_solver_time_min'])
+    if assignment is None:
+        return None, None
+    return assignment.ObjectiveValue(), get_solution_values(routing, assignment)
+
+def solve_portfolio(routing, manager, search_parameters, data, vehicles, model_options, portfolio, warmed_up=None):
+    """
+    Solves the routing problem with several search configurations side by side, each
+    with the same time limit, and keeps the lowest cost routes. Ties go to the
+    configuration listed first.
+
+    The first configuration is solved on the given model. The others are solved in
+    spawned worker processes, each building its own model from data and vehicles,
+    and the winner's routes are copied back into an assignment of the given model.
+    Only as many configurations as portfolio_workers run, and fast_run drops their
+    metaheuristics.
+
+    Args:
+        routing, manager, search_parameters: model built by build_routing_model with model_options
+        data, vehicles, model_options: as given to build_routing_model
+        portfolio (list of dicts or True): search configurations, default_portfolio when True
+        warmed_up: as in solve_model
+    Returns:
+        Assignment of the best routes, None if no configuration found a solution
+    """
+    if portfolio is True:
+        portfolio = default_portfolio
+    max_workers = portfolio_workers or os.cpu_count() or 1
+    if len(portfolio) > max_workers:
+        logging.info(f'Running the first {max_workers} of {len(portfolio)} portfolio configurations, one per worker')
+        portfolio = portfolio[:max_workers]
+    if model_options.get('fast_run', False):
+        portfolio = [{key: value for key, value in search_configuration.items() if key != 'metaheuristic'}
+                     for search_configuration in portfolio]
+    max_solver_time_min = model_options.get('max_solver_time_min', 2)
+
+    executor = None
+    try:
+        if len(portfolio) > 1:
+            settings = {name: globals()[name] for name in worker_settings}
+            #Spawned rather than forked, forking would copy the OSRM engines and threads of this process
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=len(portfolio) - 1, mp_context=multiprocessing.get_context('spawn'))
+            futures = [executor.submit(solve_portfolio_member, data, vehicles, model_options, search_configuration, warmed_up, settings)
+                       for search_configuration in portfolio[1:]]
+
+        apply_search_configuration(routing, search_parameters, portfolio[0])
+        assignment = solve_model(routing, manager, search_parameters, warmed_up=warmed_up, max_solver_time_min=max_solver_time_min)
+        results = [(None if assignment is None else assignment.ObjectiveValue(), None)]
+        if executor is not None:
+            results.extend(future.result() for future in futures)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    solved = [(cost, idx) for idx, (cost, _) in enumerate(results) if cost is not None]
+    for cost, idx in solved:
+        logging.info(f'Portfolio configuration {portfolio[idx]}: cost {cost}')
+    if len(solved) == 0:
+        logging.warning('No portfolio configuration found a solution')
+        return None
+
+    cost, idx = min(solved)
+    logging.info(f'Portfolio winner: {portfolio[idx]} with cost {cost}')
+    if idx == 0:
+        return assignment
+    return assignment_from_values(routing, results[idx][1], cost)
+
 def create_route_dict(assignment, manager, routing, data, nodedata, vehicles, route_dict_prev=None, vehicles_prev = None):
     """Creates dictionary of routes and total distances
     
@@ -887,11 +1196,11 @@ def create_route_dict(assignment, manager, routing, data, nodedata, vehicles, ro
             next_index = assignment.Value(routing.NextVar(index))
             node_index = manager.IndexToNode(index)
             next_node_index = manager.IndexToNode(next_index)
-            route_dist += data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index]
+            route_dist += int(data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index])
             route_dict[vehicle_id]['current_names'].append(data.nodes_to_names[node_index])
             route_dict[vehicle_id]['next_names'].append(data.nodes_to_names[next_node_index])
-            route_dict[vehicle_id]['travel_time'].append(data.vehicle[vehicle_id].time_distance_matrix[node_index][next_node_index])
-            route_dict[vehicle_id]['current_distance'].append(data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index])
+            route_dict[vehicle_id]['travel_time'].append(int(data.vehicle[vehicle_id].time_distance_matrix[node_index][next_node_index]))
+            route_dict[vehicle_id]['current_distance'].append(int(data.vehicle[vehicle_id].travel_distance_matrix[node_index][next_node_index]))
             #route_time += time_matrix(index, next_index)
             route_time += time_matrix.time_evaluator(node_index, next_node_index)
             #route_load += data.demands[node_index] #+ assignment.Value(routing.GetDimensionOrDie("Capacity").CumulVar(index))
@@ -983,13 +1292,9 @@ def resequence(node_data, data, routing, routes_all, original_routes, vehicle_pr
     for route_key, old_route in enumerate(original_routes):
         if len(old_route) == 0:
             continue
-        per_route_nodes[route_key] = []
-        for node in old_route:
-            name = data.nodes_to_names[node]
-            per_route_nodes[route_key].append(node_data.df_gps_verbose[node_data.df_gps_verbose['name'] == name].values[0])
+        per_route_nodes[route_key] = node_data.rows_for_names([data.nodes_to_names[node] for node in old_route])
 
-        route_df = pd.DataFrame(per_route_nodes[route_key])
-        route_df.columns = node_data.df_gps_verbose.columns
+        route_df = node_data.df_gps_verbose.iloc[per_route_nodes[route_key]].reset_index(drop=True)
         
         step_size_factor = 1.0
         if f'long_snapped_{profiles[route_key]}' in route_df.columns:
@@ -999,7 +1304,10 @@ def resequence(node_data, data, routing, routes_all, original_routes, vehicle_pr
         else:
             logging.warning('Failed to find snapped coordinates while reordering trip sequence.')
             
-        segments = routes_all[route_key]['geometry']['coordinates']    
+        if routes_all[route_key] is None:
+            logging.warning(f'No route found for route {route_key}, keeping its original sequence.')
+            continue
+        segments = routes_all[route_key]['geometry']
         segments = interpolate_segment(segments, step_size_factor)
         
         segment_to_node = dict()
@@ -1018,15 +1326,13 @@ def resequence(node_data, data, routing, routes_all, original_routes, vehicle_pr
     
     
     new_routes_for_assignment = [[] for vehicle in range(len(original_routes))]
+    #Problem node of each node_data row, the first one when a row was selected more than once
+    selected_rows = pd.Series(np.arange(len(data._boolean_selected)), index=data._boolean_selected)
+    selected_rows = selected_rows[~selected_rows.index.duplicated()]
     for key in ordered_nodes:
         new_route = ordered_nodes[key]
-        route_names = new_route['name'].values
-
-        full_names = node_data.df_gps_verbose.iloc[data._boolean_selected]['name'].values
-        node_indices = []
-        for route_name in route_names:
-            node_indices.append(np.where(full_names == route_name)[0][0])
-        new_routes_for_assignment[key] = node_indices
+        route_rows = node_data.rows_for_names(new_route['name'].values)
+        new_routes_for_assignment[key] = selected_rows.loc[route_rows].tolist()
     
     for index in range(len(new_routes_for_assignment)):
         if len(new_routes_for_assignment[index]) == len(original_routes[index]): # Check to see if nodes are missed
@@ -1076,29 +1382,30 @@ def produce_temporary_routes(routes, vehicle_profiles, data, unload_routes = Non
         start_points = data.all_start_points
         end_points = data.all_end_points
     
+    # Only the geometry is needed, so routes are requested without steps and
+    # computed together per profile by the bindings
+    profile_routes = dict()
     for index, route in enumerate(routes):
-        vehicle_profile = profiles[index]
-        start_point = start_points[index]
-        end_point = end_points[index]
-        
-        if len(route) > 0:
-            osrmbindings.initialize(f"/opt/{vehicle_profile}/{os.environ['osm_filename']}")
-            
-            route = [start_point]+route+[end_point]
-            
-            latitudes = []
-            longitudes = []
-            for route_node in route:
-                latitudes.append(data._locations[route_node][0])
-                longitudes.append(data._locations[route_node][1])
-            
-            response = osrmbindings.route(longitudes, latitudes)
+        if len(route) == 0:
+            continue
+
+        route = [start_points[index]]+route+[end_points[index]]
+        locations = np.array([data._locations[route_node] for route_node in route], dtype=np.float64)
+
+        indices, longitudes, latitudes = profile_routes.setdefault(profiles[index], ([], [], []))
+        indices.append(index)
+        longitudes.append(locations[:,1])
+        latitudes.append(locations[:,0])
+
+    parsed_routes = dict()
+    for profile, (indices, longitudes, latitudes) in profile_routes.items():
+        engine = osrm_engines.get_engine(profile)
+        responses = osrmbindings.route_many(engine, longitudes, latitudes, threads=osrm_engines.query_threads)
+        parsed_routes.update(zip(indices, responses))
+
+    for index in range(len(routes)):
+        routes_all[index] = parsed_routes.get(index, [])
 
-            parsed = ujson.loads(response)
-            routes_all[index] = parsed['routes'][0]
-        else:
-            routes_all[index] = []
-    
     return routes_all
 
 def produce_agglomerations_naive(node_data_filtered, starts_ends, current_profile, capacity = 81, consider_elevation=False):
@@ -1322,121 +1629,163 @@ def deconstruct_routes(current_routes, node_data_filtered, data):
     unload_routes = {'fake_routes': fake_routes, 'routes_to_vehicles': routes_to_vehicles, 'starts': starts, 'ends': ends}
     return unload_routes
 
-def solve(node_data, config: str) -> IntermediateOptimizationSolution:
-    """Solve the route for each zone.
+def solve_zone(node_data, this_config, global_solver_options):
+    """Solve the routes of one zone.
 
     Args:
-        config: json route config.
+        node_data: nodes to solve over, only the zone's nodes are used.
+        this_config: json zone config.
+        global_solver_options: json solver options shared by all zones.
+    Returns:
+        (route_dict, vehicles) of the zone's used routes keyed from 0 as in create_route_dict,
+        None if the zone doesn't have enough vehicles.
     """
-    zone_configs = config.get('zone_configs')
-    global_solver_options = config.get('global_solver_options')
-    prev_route_dict = None
-    prev_vehicles = None
+    solver_options = {**this_config.get('solver_options', {}), **global_solver_options}
+    #filter for desired zone and depot/unload nodes
+    zone_filter = node_data.get_zone_config_filter(this_config)
+    node_data_filtered = node_data.filter_nodedata(zone_filter, filter_name_str='multiple_sample')
+    if this_config.get('enable_unload'):
+        all_start_end_options = []
+        for v in this_config['unload_vehicles']:
+            all_start_end_options.extend(v[2:])
+        starts_ends = set(all_start_end_options)
 
-    if 'clustering_radius' in global_solver_options:
-        global agg_threshold_radius
-        agg_threshold_radius = global_solver_options.get('clustering_radius')
+    else:
+        starts_ends = [this_config['Start_Point'][0], this_config['End_Point'][0]]
 
-    prev_keys = set([])
-    zone_route_map = {}
-    #for each zone configuration
-    for this_config in zone_configs:
-        solver_options = {**this_config.get('solver_options', {}), **global_solver_options}
-        if this_config.get('enable_unload'):
-            all_start_end_options = []
-            for v in this_config['unload_vehicles']:
-                all_start_end_options.extend(v[2:])
-            all_start_end_options =  set(all_start_end_options)
-            all_start_end_options_dict = {f'unload_{idx}': v for idx, v in enumerate(set(all_start_end_options))}
-            all_start_end_options_dict['zone'] = this_config['optimized_region']
-            node_data_filtered = node_data.filter_nodedata(all_start_end_options_dict, filter_name_str='multiple_sample')
-            starts_ends = all_start_end_options
+    
+    # Will use elevation-factored cost matrix instead of pure time matrix 
+    if this_config is None:
+        consider_elevation = False
+    else:
+        consider_elevation = this_config.get('consider_elevation', False)
+    #print(consider_elevation)
+    supernodes = []
+    
+    if clustering_agglomeration and not global_solver_options.get('presolved',False):
+        # Filtering again is cheaper than a deep copy, agglomeration replaces the filtered matrices and nodes
+        original_node_data_filtered = node_data.filter_nodedata(zone_filter, filter_name_str='multiple_sample')
+        first_vehicle_profile = this_config['trips_vehicle_profile'][0][0]
+        cluster_capacity = this_config['trips_vehicle_profile'][0][1]
+        if this_config['enable_unload']:
+            first_vehicle_profile = this_config['unload_vehicles'][0][0]
+            cluster_capacity = this_config['unload_vehicles'][0][1]
 
-        else:
-            #filter for desired zone and depot node
-            node_data_filtered = node_data.filter_nodedata(
-                {'zone': this_config['optimized_region'],
-                 'start': this_config['Start_Point']
-                    ,'end': this_config['End_Point']
-                 }, filter_name_str='multiple_sample')
+        node_data_filtered, supernodes, fictional_points = produce_agglomerations(node_data_filtered, starts_ends, current_profile=first_vehicle_profile, capacity=cluster_capacity, consider_elevation=consider_elevation)
 
-            starts_ends = [this_config['Start_Point'][0], this_config['End_Point'][0]]
+    #create vehicles and data problem
+    vehicles = create_vehicle(node_data_filtered,this_config)
+    data = DataProblem(node_data_filtered,vehicles,this_config, node_clusters = supernodes)
+    data.consider_elevation = consider_elevation
 
-        
-        # Will use elevation-factored cost matrix instead of pure time matrix 
-        if this_config is None:
-            consider_elevation = False
-        else:
-            consider_elevation = this_config.get('consider_elevation', False)
-        #print(consider_elevation)
-        supernodes = []
-        
-        if clustering_agglomeration and not global_solver_options.get('presolved',False):
-            original_node_data_filtered = copy.deepcopy(node_data_filtered)
-            first_vehicle_profile = this_config['trips_vehicle_profile'][0][0]
-            cluster_capacity = this_config['trips_vehicle_profile'][0][1]
-            if this_config['enable_unload']:
-                first_vehicle_profile = this_config['unload_vehicles'][0][0]
-                cluster_capacity = this_config['unload_vehicles'][0][1]
+    if (sum(data.demands) > sum([v.capacity for v in vehicles])) and not this_config['enable_unload']:
+        logging.warning('number of vehicles specified is not enough', sum(data.demands), sum([v.capacity for v in vehicles]))
+        return None
+
+    #run optimal route script
+    assignment, manager, routing =  get_optimal_route(data, vehicles, **solver_options)
+
+    #printer = ConsolePrinter(data, routing, assignment, manager)
+    #printer.print()
+    #return routing, assignment, manager, data
 
-            node_data_filtered, supernodes, fictional_points = produce_agglomerations(node_data_filtered, starts_ends, current_profile=first_vehicle_profile, capacity=cluster_capacity, consider_elevation=consider_elevation)
+    if clustering_agglomeration and not global_solver_options.get('presolved',False):
+        current_routes = get_routes(routing, data, assignment, manager)
+        full_routes = get_full_routes(current_routes, supernodes, fictional_points)
 
-        #create vehicles and data problem
+        node_data_filtered = original_node_data_filtered
         vehicles = create_vehicle(node_data_filtered,this_config)
-        data = DataProblem(node_data_filtered,vehicles,this_config, node_clusters = supernodes)
+        data = DataProblem(node_data_filtered, vehicles, this_config)
         data.consider_elevation = consider_elevation
+        assignment, manager, routing =  get_optimal_route(data, vehicles, warmed_up = full_routes, **solver_options)
+        if assignment is None:
+            logging.warning("Clustered version did not work, running without it")
+            assignment, manager, routing =  get_optimal_route(data, vehicles, **solver_options)
+
+    if resequencing:
+        resequence_time = time.perf_counter()
+        current_routes = get_routes(routing, data, assignment, manager)
+        if this_config['enable_unload']:
+            unload_routes = deconstruct_routes(current_routes, node_data_filtered, data)
+            routes_all = produce_temporary_routes(current_routes, [vehicle._osrm_profile for vehicle in vehicles], data, unload_routes = unload_routes)
+            new_assignment = resequence(node_data_filtered, data, routing, routes_all, current_routes, [vehicle._osrm_profile for vehicle in vehicles], unload_routes = unload_routes)
 
-        if (sum(data.demands) > sum([v.capacity for v in vehicles])) and not this_config['enable_unload']:
-            logging.warning('number of vehicles specified is not enough', sum(data.demands), sum([v.capacity for v in vehicles]))
-            continue
+        else:
+            routes_all = produce_temporary_routes(current_routes, [vehicle._osrm_profile for vehicle in vehicles], data)
+            new_assignment = resequence(node_data_filtered, data, routing, routes_all, current_routes, [vehicle._osrm_profile for vehicle in vehicles])
+        if new_assignment is not None:
+            assignment = new_assignment
+        logging.info(f'Took {time.perf_counter() - resequence_time} seconds to resequence')
 
-        #run optimal route script
-        assignment, manager, routing =  get_optimal_route(data, vehicles, **solver_options)
-
-        #printer = ConsolePrinter(data, routing, assignment, manager)
-        #printer.print()
-        #return routing, assignment, manager, data
-
-        if clustering_agglomeration and not global_solver_options.get('presolved',False):
-            current_routes = get_routes(routing, data, assignment, manager)
-            full_routes = get_full_routes(current_routes, supernodes, fictional_points)
-
-            node_data_filtered = original_node_data_filtered
-            vehicles = create_vehicle(node_data_filtered,this_config)
-            data = DataProblem(node_data_filtered, vehicles, this_config)
-            data.consider_elevation = consider_elevation
-            assignment, manager, routing =  get_optimal_route(data, vehicles, warmed_up = full_routes, **solver_options)
-            if assignment is None:
-                logging.warning("Clustered version did not work, running without it")
-                assignment, manager, routing =  get_optimal_route(data, vehicles, **solver_options)
-
-        if resequencing:
-            resequence_time = time.perf_counter()
-            current_routes = get_routes(routing, data, assignment, manager)
-            if this_config['enable_unload']:
-                unload_routes = deconstruct_routes(current_routes, node_data_filtered, data)
-                routes_all = produce_temporary_routes(current_routes, [vehicle._osrm_profile for vehicle in vehicles], data, unload_routes = unload_routes)
-                new_assignment = resequence(node_data_filtered, data, routing, routes_all, current_routes, [vehicle._osrm_profile for vehicle in vehicles], unload_routes = unload_routes)
+    printer = ConsolePrinter(data, routing, assignment, manager)
+    printer.print()
 
-            else:
-                routes_all = produce_temporary_routes(current_routes, [vehicle._osrm_profile for vehicle in vehicles], data)
-                new_assignment = resequence(node_data_filtered, data, routing, routes_all, current_routes, [vehicle._osrm_profile for vehicle in vehicles])
-            if new_assignment is not None:
-                assignment = new_assignment
-            logging.info(f'Took {time.perf_counter() - resequence_time} seconds to resequence')
+    #Reorganize output into a route_dict, also filter out unused routes
+    return create_route_dict(assignment, manager, routing, data, node_data_filtered, vehicles)
+
+def solve_zone_in_process(node_data, this_config, global_solver_options, settings, past_adjustments=None):
+    """solve_zone for a worker process of solve. The process imports this module afresh and
+    pickling node_data drops its past adjustments, so both are handed over.
+
+    Args:
+        settings (dict): values of the worker_settings of the run, with the zone's share of portfolio_workers
+        past_adjustments (pd dataframe, default None): the past_adjustments of the run's node data
+    """
+    globals().update(settings)
+    if past_adjustments is not None:
+        node_data.past_adjustments = past_adjustments
+    return solve_zone(node_data, this_config, global_solver_options)
 
-        printer = ConsolePrinter(data, routing, assignment, manager)
-        printer.print()
+def solve(node_data, config: str) -> IntermediateOptimizationSolution:
+    """Solve the route for each zone.
+
+    Zones are solved one after the other, or concurrently in worker processes when
+    global_solver_options sets parallel_zones, each worker getting only its zone's
+    nodes and matrices. Routes are then numbered in zone config order either way.
+
+    Args:
+        config: json route config.
+    """
+    zone_configs = config.get('zone_configs')
+    global_solver_options = config.get('global_solver_options')
 
-        #Reorganize output into a route_dict, also filter out unused routes and combine w/ prev. configs
-        route_dict, vehicles = create_route_dict(assignment, manager, routing, data, node_data_filtered, vehicles, prev_route_dict, prev_vehicles)
-        prev_route_dict = route_dict
-        prev_vehicles = vehicles
+    if 'clustering_radius' in global_solver_options:
+        global agg_threshold_radius
+        agg_threshold_radius = global_solver_options.get('clustering_radius')
+
+    if global_solver_options.get('parallel_zones', False) and len(zone_configs) > 1:
+        max_workers = min(len(zone_configs), parallel_zone_workers or os.cpu_count() or 1)
+        settings = {name: globals()[name] for name in worker_settings}
+        #Zones solved at the same time split the portfolio processes
+        settings['portfolio_workers'] = max(1, (portfolio_workers or os.cpu_count() or 1) // max_workers)
+        past_adjustments = getattr(node_data, 'past_adjustments', None)
+        logging.info(f'Solving {len(zone_configs)} zones with {max_workers} processes')
+        #Spawned rather than forked, forking would copy the OSRM engines and threads of this process
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(solve_zone_in_process,
+                                       node_data.filter_nodedata(node_data.get_zone_config_filter(this_config), filter_name_str='multiple_sample'),
+                                       this_config, global_solver_options, settings, past_adjustments)
+                       for this_config in zone_configs]
+            zone_solutions = [future.result() for future in futures]
+    else:
+        zone_solutions = (solve_zone(node_data, this_config, global_solver_options) for this_config in zone_configs)
+
+    route_dict = {}
+    vehicles = {}
+    zone_route_map = {}
+    #combine the zones' routes, renumbering them after the previous zones' routes
+    for this_config, zone_solution in zip(zone_configs, zone_solutions):
+        if zone_solution is None:
+            continue
+        zone_route_dict, zone_vehicles = zone_solution
+        this_zone_keys = []
+        for zone_key, route in zone_route_dict.items():
+            route_key = len(route_dict)
+            route_dict[route_key] = route
+            vehicles[route_key] = zone_vehicles[zone_key]
+            this_zone_keys.append(route_key)
 
         #put together a dict of zone(s) name -> routes for per-zone maps
-        curr_keys = set(route_dict.keys())
-        this_zone_keys = curr_keys - prev_keys
-        prev_keys = curr_keys
         zone_name = ''
         for region in this_config['optimized_region']:
             zone_name += region
@@ -1703,7 +2052,7 @@ def presolve(node_data, config):
         gps.loc[:,'principalcomponent'] = rotated[:,0]
         gps.loc[:,'secondcomponent'] = rotated[:,1]
         
-        matrix = node_data.get_time_or_dist_mat(this_config['trips_vehicle_profile'][0][0]) # only one type of vehicle supported
+        matrix = node_data_filtered.get_time_or_dist_mat(this_config['trips_vehicle_profile'][0][0]) # only one type of vehicle supported
         partitions = produce_partitions(gps, partition_size, matrix)
         
         for i, partition in enumerate(partitions):
@@ -0,0 +1,67 @@
+"""
+Maps vehicle profiles to the OSRM engines kept resident by osrmbindings.
+
+Each profile's .osrm dataset is loaded once per process and reused by every
+route/table/nearest call made with its handle. The handles of the most
+recently used profiles are kept here, a dataset is unloaded once no handle to
+it is left.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import osrmbindings
+
+max_resident_engines = 4 # Least recently used profiles are unloaded beyond this, 0 keeps every profile loaded
+query_threads = os.cpu_count() or 1 # The bindings release the GIL, so queries on separate threads run in parallel
+
+_engines = OrderedDict() # profile -> osrmbindings.Engine, least recently used first
+_engines_lock = threading.Lock()
+
+def dataset_path(profile):
+    """Location of the prepared OSRM dataset for a vehicle profile."""
+    return f"/opt/{profile}/{os.environ['osm_filename']}"
+
+def get_engine(profile):
+    """
+    Returns the osrmbindings handle for a vehicle profile, loading the
+    dataset the first time the profile is used. Handles of the
+    max_resident_engines most recently used profiles are kept, so their
+    datasets stay loaded between calls.
+
+    Args:
+        profile (str): vehicle profile name, e.g. 'wheelbarrow'
+    Returns:
+        osrmbindings.Engine to pass as first argument to the queries, it keeps
+        the dataset loaded while held even if the profile is evicted meanwhile
+    """
+    with _engines_lock:
+        if profile in _engines:
+            _engines.move_to_end(profile)
+            return _engines[profile]
+
+    #Loaded outside the lock, osrmbindings shares one load between concurrent callers
+    engine = osrmbindings.initialize(dataset_path(profile))
+    with _engines_lock:
+        _engines[profile] = engine
+        _engines.move_to_end(profile)
+        while max_resident_engines > 0 and len(_engines) > max_resident_engines:
+            _engines.popitem(last=False)
+    return engine
+
+def map_queries(query, items):
+    """
+    Runs an OSRM query function over items on a thread pool.
+
+    Args:
+        query (callable): function of one item calling into osrmbindings
+        items (iterable): query inputs
+    Returns:
+        List of query results in the order of items
+    """
+    items = list(items)
+    if query_threads <= 1 or len(items) <= 1:
+        return [query(item) for item in items]
+    with ThreadPoolExecutor(max_workers=query_threads) as executor:
+        return list(executor.map(query, items))
@@ -12,6 +12,7 @@ matrices_included = False # only use True if you want to look at the data as a d
 @attr.s
 class CleanedNodeData(object):
     node_data = attrib()
+    write_matrices = attrib(default=False) # only needed when the run is adjusted with manual edits
 
 
 class CleanedNodeDataOutput(OutputObjectBase):
@@ -32,6 +33,11 @@ class CleanedNodeDataOutput(OutputObjectBase):
                 f_path_bad=file_manager.make_path(file_manager.output_config.cleaned_dropped_flagged_gps_path),
                 verbose=True
             )
+        if self.data.write_matrices:
+            # Matrices reused by manual edits mode instead of querying OSRM again
+            node_data.write_matrices_to_file(
+                file_manager.make_path(file_manager.output_config.manual_edit_matrices_path)
+            )
         if matrices_included:
             # Write time/dist matrices to file
             # mat_file_config = TimeDistMatOutput(self.post_filename_str)
@@ -15,6 +15,7 @@ MANUAL_MAPS_FOLDER = f"{MANUAL_EDITS_FOLDER}/maps"
 MANUAL_ROUTES_EDITS = 'manual_routes_edits.xlsx'
 MANUAL_VEHICLES = 'manual_vehicles.csv'
 CLEAN_GPS_POINTS = 'clean_gps_points.csv'
+NODE_MATRICES = 'node_matrices.npz'
 
 @attr.s
 class OutputPathConfig(object):
@@ -56,6 +57,9 @@ class OutputPathConfig(object):
     manual_edit_gps_path = attr.ib(
         default=Path(MANUAL_EDITS_FOLDER, CLEAN_GPS_POINTS)
     )
+    manual_edit_matrices_path = attr.ib(
+        default=Path(MANUAL_EDITS_FOLDER, NODE_MATRICES)
+    )
     manual_pickle_node_data_path = attr.ib(
         default=Path(MANUAL_EDITS_FOLDER, 'node_data_pkl.p')
     )
@@ -31,8 +31,13 @@ def initialize_cloud_client(scenario, manual_mapping_mode):
     return cloud_client
 
 
-def run_routing_from_config(config_manager: ConfigManager) -> Tuple[FinalOptimizationSolution, VisualizationData]:
+def run_routing_from_config(config_manager: ConfigManager, matrix_folder=None) -> Tuple[FinalOptimizationSolution, VisualizationData]:
     """Runs
+
+    Args:
+        config_manager: inputs and configs of the run.
+        matrix_folder: where matrices are memory-mapped from when node_loader_options
+          sets memmap_matrices, usually the run's time_and_dist_matrices folder.
     """
     routing_config = config_manager.get_routing_config()
     logging.info('Building Time/Distance Matrices')
@@ -42,7 +47,8 @@ def run_routing_from_config(config_manager: ConfigManager) -> Tuple[FinalOptimiz
         node_data = build_time_dist_matrix.process_nodes(
             config_manager,
             config['node_loader_options'],
-            config['zone_configs'])
+            config['zone_configs'],
+            matrix_folder=matrix_folder)
     else:
         node_data = build_time_dist_matrix.process_nodes(config_manager)
 
@@ -14,6 +14,7 @@ import requests
 import os
 import subprocess
 import pandas as pd
+from config.gps_input_data import GPSInputData, find_node_file
 
 app = fastapi.FastAPI()
 
@@ -68,6 +69,7 @@ def get_solution(session_id: str=''):
     main_application.args.cloud = False
     main_application.args.manual_mapping_mode = False
     main_application.args.manual_input_path = None
+    main_application.args.manual_edit_matrices = True # solutions are adjusted with manual edits
     #temp_output = io.StringIO()
     try:
         main_application.main(user_directory=f'data{session_id}')
@@ -135,7 +137,8 @@ def get_adjustments(session_id: str=''):
     adjustments = adjustments[sheet_name]
     
     dataset['adjustments'] = adjustments.to_json(orient='split', index=False)
-    dataset['customers'] = pd.read_excel(f'/opt/data{session_id}/customer_data.xlsx').to_json(orient='split', index=False)
+    customer_file = find_node_file(f'/opt/data{session_id}', 'customer_data')
+    dataset['customers'] = GPSInputData.parse_node_file(customer_file).to_json(orient='split', index=False)
     with open(f'/opt/data{session_id}/custom_header.yaml', 'r') as path:
         dataset['headers'] = path.read()
     dataset['error'] = error
@@ -10,6 +10,7 @@ from geojson import Feature, MultiLineString, FeatureCollection
 import ujson
 
 import osrmbindings
+import osrm_engines
 
 #import osrm_text_instructions
 import os
@@ -422,6 +423,9 @@ def create_visualizations(solution: FinalOptimizationSolution,
     # Instructions by route id.
     instructions_by_route_id = {}
 
+    # Coordinates of each route, queried together below
+    route_coordinates = {}
+
     for route_id in sorted_keys:
         route = routes_for_mapping[route_id]
         longitudes = []
@@ -429,9 +433,6 @@ def create_visualizations(solution: FinalOptimizationSolution,
 
         route_names[route_id] = vehicles[route_id].name
 
-        #Select the profile for OSRM to construct routes for
-        osrmbindings.initialize(f"/opt/{vehicles[route_id].osrm_profile}/{os.environ['osm_filename']}")
-
         for index, location in enumerate(route): 
             longitudes.append(location[0][1])
             latitudes.append(location[0][0])
@@ -439,8 +440,18 @@ def create_visualizations(solution: FinalOptimizationSolution,
             nodes_for_mapping.append([tuple(location[0]), route_id])
             nodes[route_id].append(tuple((location[0][0], location[0][1], location[1])))
 
-        response = osrmbindings.route(longitudes, latitudes)
-    
+        route_coordinates[route_id] = (longitudes, latitudes)
+
+    def query_route(route_id):
+        #Select the profile for OSRM to construct routes for
+        engine = osrm_engines.get_engine(vehicles[route_id].osrm_profile)
+        longitudes, latitudes = route_coordinates[route_id]
+        return osrmbindings.route(engine, longitudes, latitudes)
+
+    # Routes are independent, so they are rebuilt concurrently
+    responses = osrm_engines.map_queries(query_route, sorted_keys)
+
+    for route_id, response in zip(sorted_keys, responses):
         parsed = ujson.loads(response)
 
         responses_by_route_id[route_id] = response
@@ -0,0 +1,90 @@
+"""Tests the precomputed arc cost matrices against the per arc costs they replace"""
+import types
+
+import numpy as np
+import pytest
+from ortools.constraint_solver import pywrapcp
+
+import optimization
+
+
+def old_arc_cost(data, distance_matrix, from_node, to_node):
+    """Arc cost as the transit callback computed it for each arc."""
+    points = data.all_start_points + data.all_end_points
+    total_service_time = int(data.time_per_demand_unit)
+    if data.node_clusters and from_node not in points:
+        total_service_time = int(len(data.node_clusters[from_node]) * (int(data.time_per_demand_unit) + optimization.agg_threshold_radius))
+
+    if from_node == to_node:
+        travel_time = 0
+    elif from_node in data.unload_indices and to_node in data.unload_indices:
+        travel_time = 10000000
+    elif from_node in points and to_node in data.unload_indices:
+        travel_time = 10000000
+    elif from_node in data.unload_indices and to_node in points:
+        travel_time = 10000000
+    else:
+        travel_time = distance_matrix[from_node][to_node]
+    return int(travel_time) + int(total_service_time)
+
+
+@pytest.mark.parametrize('node_clusters', [None, {node: list(range(node % 3 + 1)) for node in range(7)}])
+def test_arc_cost_matrix_matches_callback(node_clusters):
+    #Node 0 is the start, 6 the end, 4 and 5 are unload points
+    data = types.SimpleNamespace(num_locations=7, time_per_demand_unit=30, node_clusters=node_clusters,
+                                 all_start_points=[0], all_end_points=[6], unload_indices=[4, 5])
+    distance_matrix = np.random.default_rng(0).uniform(0, 5000, size=(7, 7)).astype(np.int32)
+
+    arc_costs = optimization.create_arc_cost_matrix(data, distance_matrix, optimization.create_service_times(data))
+    expected = [[old_arc_cost(data, distance_matrix, from_node, to_node) for to_node in range(7)] for from_node in range(7)]
+    np.testing.assert_array_equal(arc_costs, expected)
+
+
+@pytest.mark.parametrize('max_nodes', [optimization.transit_matrix_max_nodes, 0])
+def test_identical_arc_costs_share_an_evaluator(monkeypatch, max_nodes):
+    #With no nodes allowed in matrices the costs are registered as cached callbacks
+    monkeypatch.setattr(optimization, 'transit_matrix_max_nodes', max_nodes)
+    manager = pywrapcp.RoutingIndexManager(7, 3, 0)
+    parameters = pywrapcp.DefaultRoutingModelParameters()
+    parameters.max_callback_cache_size = 7
+    routing = pywrapcp.RoutingModel(manager, parameters)
+    arc_costs = np.random.default_rng(0).integers(0, 5000, size=(7, 7))
+
+    registered_costs = []
+    evaluator = optimization.register_arc_costs(routing, manager, arc_costs, registered_costs)
+    assert optimization.register_arc_costs(routing, manager, arc_costs.copy(), registered_costs) == evaluator
+    other_evaluator = optimization.register_arc_costs(routing, manager, arc_costs + 1, registered_costs)
+    assert other_evaluator != evaluator
+    assert len(registered_costs) == 2
+
+    for vehicle, vehicle_evaluator in enumerate([evaluator, evaluator, other_evaluator]):
+        routing.SetArcCostEvaluatorOfVehicle(vehicle_evaluator, vehicle)
+    routing.CloseModel()
+    for from_node in range(1, 7):
+        for to_node in range(1, 7):
+            if from_node != to_node:
+                from_index, to_index = manager.NodeToIndex(from_node), manager.NodeToIndex(to_node)
+                assert routing.GetArcCostForVehicle(from_index, to_index, 0) == arc_costs[from_node, to_node]
+                assert routing.GetArcCostForVehicle(from_index, to_index, 2) == arc_costs[from_node, to_node] + 1
+
+
+@pytest.mark.parametrize('same_costs', [False, True])
+def test_vehicles_of_a_class_share_evaluators_and_dimension_classes(same_costs):
+    #Four trucks and two wheelbarrows, all starting at node 0 and ending at node 6
+    data = types.SimpleNamespace(num_locations=7, num_vehicles=6, time_per_demand_unit=30, node_clusters=None,
+                                 all_start_points=[0] * 6, all_end_points=[6] * 6, unload_indices=[], consider_elevation=False)
+    truck_times = np.random.default_rng(0).integers(0, 5000, size=(7, 7))
+    wheelbarrow_times = truck_times.copy() if same_costs else truck_times * 3
+    truck = types.SimpleNamespace(matrices=object(), time_distance_matrix=truck_times)
+    wheelbarrow = types.SimpleNamespace(matrices=object(), time_distance_matrix=wheelbarrow_times)
+    vehicles = [truck] * 4 + [wheelbarrow] * 2
+
+    manager = pywrapcp.RoutingIndexManager(7, 6, [0] * 6, [6] * 6)
+    routing = pywrapcp.RoutingModel(manager)
+    evaluators = optimization.register_arc_cost_evaluators(routing, manager, data, vehicles)
+    routing.AddDimensionWithVehicleTransits(evaluators, 0, 10**9, True, 'Time')
+    routing.CloseModel()
+
+    assert len(set(evaluators[:4])) == len(set(evaluators[4:])) == 1
+    assert (evaluators[0] == evaluators[4]) == same_costs
+    assert routing.GetVehicleClassesCount() == (1 if same_costs else 2)
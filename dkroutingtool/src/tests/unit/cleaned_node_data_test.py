@@ -0,0 +1,28 @@
+"""Tests writing the cleaned nodes of a run"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from build_time_dist_matrix import NodeData, OSRMMatrix
+from output import data_persisting
+from output.cleaned_node_data import CleanedNodeData
+from output.file_manager import FileManager, OutputPathConfig
+
+PROFILE = 'wheelbarrow'
+
+
+def make_node_data():
+    df = pd.DataFrame({'type': 'Customer', 'name': ['a', 'b'], 'lat_orig': [-1.30, -1.31], 'long_orig': [36.80, 36.81],
+                       'closed': 0, 'zone': 'East', 'buckets': 1})
+    nodes = NodeData(df)
+    matrices = {PROFILE: OSRMMatrix(nodes, np.array([[0, 5], [6, 0]], dtype=np.int32), df[['lat_orig', 'long_orig']].to_numpy())}
+    return NodeData(df, pd.DataFrame(columns=NodeData.standard_columns_bad), matrices, matrices)
+
+
+@pytest.mark.parametrize('write_matrices', [False, True])
+def test_matrices_are_only_written_for_manual_edits(tmp_path, write_matrices):
+    file_manager = FileManager(tmp_path, OutputPathConfig())
+    data_persisting.persist(CleanedNodeData(make_node_data(), write_matrices=write_matrices), file_manager)
+
+    assert (tmp_path / file_manager.output_config.manual_edit_gps_path).exists()
+    assert (tmp_path / file_manager.output_config.manual_edit_matrices_path).exists() == write_matrices
@@ -0,0 +1,44 @@
+"""Tests the declarative node cleaning rules"""
+import numpy as np
+import pandas as pd
+
+from build_time_dist_matrix import NodeData, NodeLoader
+
+PROFILES = ['truck', 'wheelbarrow']
+
+
+def test_evaluate_cleaning_rules_in_order():
+    df = pd.DataFrame({'name': ['a', 'b', 'c', 'd'], 'lat_orig': [1.0, np.nan, 200.0, 3.0]})
+    rules = [
+        ('Removed - Missing GPS', True, lambda df: df['lat_orig'].isna()),
+        ('Flagged - Large latitude', False, lambda df: df['lat_orig'] > 2),
+        ('Removed - Out of range', True, lambda df: df['lat_orig'].abs() > 90),
+        ('Removed - Missing again', True, lambda df: df['lat_orig'].isna()),
+    ]
+    kept, bad_dfs = NodeLoader.evaluate_cleaning_rules(df, rules)
+
+    np.testing.assert_array_equal(kept, [True, False, False, True])
+    #Flagged nodes are still checked by later rules, removed ones are not
+    assert [(list(bad['name']), bad[NodeData.flag].unique().tolist()) for bad in bad_dfs] == [
+        (['b'], ['Removed - Missing GPS']),
+        (['c', 'd'], ['Flagged - Large latitude']),
+        (['c'], ['Removed - Out of range']),
+    ]
+
+
+def test_get_snapping_rules():
+    df = pd.DataFrame({'name': ['a', 'b', 'c', 'd'],
+                       'snapped_dist_truck': [1.0, np.nan, np.nan, 500.0],
+                       'snapped_dist_wheelbarrow': [2.0, 3.0, np.nan, 600.0]})
+
+    kept, bad_dfs = NodeLoader.evaluate_cleaning_rules(df, NodeLoader.get_snapping_rules(df, PROFILES))
+    #Only nodes no profile can snap are removed
+    np.testing.assert_array_equal(kept, [True, True, False, True])
+    assert [list(bad['name']) for bad in bad_dfs] == [['c']]
+
+    kept, bad_dfs = NodeLoader.evaluate_cleaning_rules(df, NodeLoader.get_snapping_rules(df, PROFILES, max_dist=100))
+    np.testing.assert_array_equal(kept, [True, True, False, True])
+    assert [(list(bad['name']), bad[NodeData.flag].iloc[0]) for bad in bad_dfs] == [
+        (['c'], 'Removed - Bad Server Code'),
+        (['d'], 'Flagged - Snapped node location too far from original GPS coordinates.'),
+    ]
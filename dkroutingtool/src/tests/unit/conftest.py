@@ -0,0 +1,16 @@
+"""Puts src/py on the path and replaces the native osrmbindings module with the
+straight-line stand-in from osrm_stub, so the unit tests run without OSRM datasets.
+"""
+import os
+import pathlib
+import sys
+
+from . import osrm_stub
+
+SRC_PY = pathlib.Path(__file__).resolve().parents[2] / 'py'
+for path in (SRC_PY, SRC_PY / 'config'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+os.environ.setdefault('osm_filename', 'test.osrm')
+osrm_stub.install()
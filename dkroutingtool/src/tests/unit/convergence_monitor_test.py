@@ -0,0 +1,57 @@
+"""Tests stopping the routing search once the objective converges"""
+import optimization
+
+
+class FakeRouting:
+    """Routing model reporting a given cost at each solution."""
+    def __init__(self):
+        self.cost = None
+        self.finished = 0
+
+    def CostVar(self):
+        return self
+
+    def Max(self):
+        return self.cost
+
+    def solver(self):
+        return self
+
+    def FinishCurrentSearch(self):
+        self.finished += 1
+
+
+def run(monitor, routing, clock, solutions):
+    """Feeds (seconds, cost) solutions to the monitor, returns how many were seen before it stopped the search."""
+    for seen, (seconds, cost) in enumerate(solutions, start=1):
+        clock[0] = seconds
+        routing.cost = cost
+        monitor()
+        if routing.finished:
+            return seen
+    return None
+
+
+def test_stops_after_solutions_without_improvement(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(optimization.time, 'perf_counter', lambda: clock[0])
+    routing = FakeRouting()
+    monitor = optimization.ConvergenceMonitor(routing, max_solutions=3, epsilon=0.01)
+    #1000 -> 900 improves, 895 is within epsilon and doesn't reset the count
+    assert run(monitor, routing, clock, [(0, 1000), (1, 900), (2, 895), (3, 899), (4, 892), (5, 950)]) == 5
+
+
+def test_stops_after_window_without_improvement(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(optimization.time, 'perf_counter', lambda: clock[0])
+    routing = FakeRouting()
+    monitor = optimization.ConvergenceMonitor(routing, window_sec=10, epsilon=0.01)
+    assert run(monitor, routing, clock, [(0, 1000), (8, 900), (17, 899), (18, 800), (27, 800), (28, 800)]) == 6
+
+
+def test_keeps_searching_while_improving(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(optimization.time, 'perf_counter', lambda: clock[0])
+    routing = FakeRouting()
+    monitor = optimization.ConvergenceMonitor(routing, window_sec=10, max_solutions=2, epsilon=0.01)
+    assert run(monitor, routing, clock, [(5 * idx, 1000 - 50 * idx) for idx in range(10)]) is None
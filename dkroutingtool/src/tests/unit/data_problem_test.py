@@ -0,0 +1,36 @@
+"""Tests building the solver's problem from the node data of a zone"""
+import numpy as np
+import pandas as pd
+
+import optimization
+from build_time_dist_matrix import NodeData, OSRMMatrix
+
+PROFILES = ['wheelbarrow', 'truck']
+
+
+def make_node_data():
+    #The unload point isn't a start or end of the vehicles
+    df = pd.DataFrame({'type': ['Start', 'Customer', 'Customer', 'Unload'], 'name': ['depot', 'a', 'b', 'UNLOAD 1'],
+                       'lat_orig': [-1.30, -1.31, -1.32, -1.33], 'long_orig': [36.80, 36.81, 36.82, 36.83],
+                       'closed': 0, 'zone': 'East', 'buckets': [0, 1, 2, 0]})
+    nodes = NodeData(df)
+    coords = df[['lat_orig', 'long_orig']].to_numpy()
+    times = {profile: OSRMMatrix(nodes, np.arange(16, dtype=np.int32).reshape(4, 4) * (i + 1), coords)
+             for i, profile in enumerate(PROFILES)}
+    return NodeData(df, None, times, times)
+
+
+def test_vehicles_index_the_problem_matrices():
+    node_data = make_node_data()
+    config = {'Start_Point': ['depot'], 'End_Point': ['depot'], 'enable_unload': False, 'optimized_region': ['East'],
+              'trips_vehicle_profile': [[profile, 10] for profile in PROFILES], 'load_time': 1}
+
+    vehicles = optimization.create_vehicle(node_data, config)
+    data = optimization.DataProblem(node_data, vehicles, config)
+
+    assert sorted(data.profile_matrices) == sorted(PROFILES)
+    for profile, matrices in data.profile_matrices.items():
+        assert all(v.matrices is matrices for v in vehicles if v.osrm_profile == profile)
+        np.testing.assert_array_equal(matrices.time_distance, node_data.get_time_or_dist_mat(profile, 'time'))
+    assert data.time_distance.shape == (data.num_locations, data.num_locations)
+    assert data.unload_indices == {3}
@@ -0,0 +1,62 @@
+"""Tests the elevation costs between locations"""
+import numpy as np
+import pytest
+
+import elevation_utils
+
+CELL = 0.01 # degrees per raster cell
+ORIGIN_LON, ORIGIN_LAT = 36.70, -1.20 # north west corner of the raster
+ALTITUDE = np.add.outer(np.arange(30) * 7.0, np.arange(30) * 3.0) # meters, by row (south) and column (east)
+
+LONGITUDES = np.array([36.80, 36.81, 36.83, 36.86])
+LATITUDES = np.array([-1.30, -1.35, -1.31, -1.38])
+
+
+class FakeRaster:
+    """Stands in for the elevation geotiff, which rasterio reads as one channel."""
+    transform = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def read(self):
+        return ALTITUDE[np.newaxis]
+
+
+def rowcol(transform, xs, ys):
+    return np.floor((ORIGIN_LAT - np.asarray(ys)) / CELL).astype(int), np.floor((np.asarray(xs) - ORIGIN_LON) / CELL).astype(int)
+
+
+@pytest.fixture(autouse=True)
+def raster(monkeypatch):
+    monkeypatch.setattr(elevation_utils.rasterio, 'open', lambda path: FakeRaster())
+    monkeypatch.setattr(elevation_utils.rasterio.transform, 'rowcol', rowcol)
+
+
+def test_unroutable_pairs_cost_nothing(monkeypatch):
+    route_many = elevation_utils.osrmbindings.route_many
+    def failing_route_many(engine, longitudes, latitudes, **kwargs):
+        #Routes ending at the last location fail
+        routes = route_many(engine, longitudes, latitudes, **kwargs)
+        return [None if lons[-1] == LONGITUDES[3] else route for lons, route in zip(longitudes, routes)]
+    monkeypatch.setattr(elevation_utils.osrmbindings, 'route_many', failing_route_many)
+
+    costs = elevation_utils.compute_elevation_costs('wheelbarrow', LONGITUDES, LATITUDES)
+    assert (costs[:, 3] == 0).all()
+    assert (costs[:3, :3][~np.eye(3, dtype=bool)] > 0).all()
+    assert (costs[3, :3] > 0).all()
+
+
+def test_sources_and_destinations_match_the_full_matrix():
+    full = elevation_utils.compute_elevation_costs('wheelbarrow', LONGITUDES, LATITUDES)
+    sources, destinations = [3, 1], [0, 1, 2]
+    costs = elevation_utils.compute_elevation_costs('wheelbarrow', LONGITUDES, LATITUDES, sources=sources, destinations=destinations)
+
+    block = np.ix_(sources, destinations)
+    np.testing.assert_array_equal(costs[block], full[block])
+    outside = np.ones(full.shape, dtype=bool)
+    outside[block] = False
+    assert (costs[outside] == 0).all()
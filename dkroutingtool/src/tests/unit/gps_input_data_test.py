@@ -0,0 +1,60 @@
+"""Tests picking and reading node input files"""
+import os
+import types
+
+import pandas as pd
+
+import cloud_context
+from config.gps_input_data import GPSInputData, find_node_file
+
+
+def test_find_node_file_defaults_to_xlsx(tmp_path):
+    assert find_node_file(str(tmp_path), 'customer_data') == f'{tmp_path}/customer_data.xlsx'
+
+
+def test_find_node_file_prefers_newest(tmp_path):
+    nodes = pd.DataFrame({'name': ['a', 'b'], 'lat': [1.0, 2.0]})
+    nodes.to_parquet(tmp_path / 'customer_data.parquet', index=False)
+    nodes.to_csv(tmp_path / 'customer_data.xlsx', index=False) # only the modification times matter here
+    os.utime(tmp_path / 'customer_data.parquet', (1, 1))
+    assert find_node_file(str(tmp_path), 'customer_data') == f'{tmp_path}/customer_data.xlsx'
+
+    os.utime(tmp_path / 'customer_data.xlsx', (0, 0))
+    path = find_node_file(str(tmp_path), 'customer_data')
+    assert path == f'{tmp_path}/customer_data.parquet'
+    loaded = GPSInputData.read_node_file(path, {'lat': 'lat_orig'})
+    assert list(loaded.columns) == ['name', 'lat_orig']
+    assert loaded['lat_orig'].tolist() == [1.0, 2.0]
+
+
+class FakeSheets:
+    """Sheets service returning the cells of a sheet per spreadsheet id."""
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range):
+        return types.SimpleNamespace(execute=lambda: {'values': self.sheets[spreadsheetId]})
+
+
+def test_cloud_customer_data_reads_as_the_xlsx_did(tmp_path, monkeypatch):
+    #Rows missing trailing cells and numeric text as the Sheets API returns them
+    customer_values = [['name', 'GPS (Latitude)', 'buckets', 'time_windows'],
+                       ['a', '-1.3', '2', ''], ['b', '-1.4'], ['c', '-1.5', '3', '08:00-09:00']]
+    context = cloud_context.GoogleDriveContext.__new__(cloud_context.GoogleDriveContext)
+    context.customer_file_id, context.facility_file_id, context.scenario_folder_id = 'customers', 'extra', 'scenario'
+    context.sheet_service = FakeSheets({'customers': customer_values, 'extra': [['name', 'type'], ['depot', 'Depot']]})
+    monkeypatch.setattr(context, '_get_file_id_from_name', lambda filename, folder_id=None: filename)
+    monkeypatch.setattr(context, '_load_and_save_json_file', lambda file_id, local_dir: None)
+
+    context.download_input_data(str(tmp_path))
+
+    path = find_node_file(str(tmp_path), 'customer_data')
+    assert path == f'{tmp_path}/customer_data.parquet'
+    pd.DataFrame(customer_values[1:], columns=customer_values[0]).to_excel(tmp_path / 'sheet.xlsx', index=False)
+    pd.testing.assert_frame_equal(GPSInputData.read_node_file(path), GPSInputData.read_node_file(tmp_path / 'sheet.xlsx'))
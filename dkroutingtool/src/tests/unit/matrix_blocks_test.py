@@ -0,0 +1,58 @@
+"""Tests MatrixBlocks, the per zone blocks of an OSRM matrix"""
+import numpy as np
+import pytest
+
+from build_time_dist_matrix import MatrixBlocks, unreachable_cost
+
+# Two zones over 5 nodes sharing node 0 (e.g. a depot), values are 10*from + to
+FULL = (10 * np.arange(5)[:, None] + np.arange(5)).astype(np.int32)
+BLOCK_POSITIONS = [np.array([0, 1, 2]), np.array([3, 0, 4])]
+
+
+def make_blocks():
+    return MatrixBlocks(5, [(positions, FULL[np.ix_(positions, positions)]) for positions in BLOCK_POSITIONS])
+
+
+def test_select_within_block():
+    blocks = make_blocks()
+    np.testing.assert_array_equal(blocks.select([2, 0]), FULL[np.ix_([2, 0], [2, 0])])
+    np.testing.assert_array_equal(blocks.select([4, 3, 0]), FULL[np.ix_([4, 3, 0], [4, 3, 0])])
+
+
+def test_select_across_blocks_raises():
+    with pytest.raises(ValueError):
+        make_blocks().select([1, 4])
+
+
+def test_pairs():
+    values = make_blocks().pairs([0, 2, 4, 3], [1, 0, 0, 4])
+    np.testing.assert_array_equal(values, FULL[[0, 2, 4, 3], [1, 0, 0, 4]])
+
+
+def test_subset():
+    subset = make_blocks().subset(np.array([4, 0, 1]))
+    assert subset.shape == (3, 3)
+    np.testing.assert_array_equal(subset.select([1, 2]), FULL[np.ix_([0, 1], [0, 1])])
+    np.testing.assert_array_equal(subset.select([0, 1]), FULL[np.ix_([4, 0], [4, 0])])
+    with pytest.raises(ValueError):
+        subset.select([0, 2])
+
+
+def test_dense_fills_pairs_between_blocks():
+    dense = np.asarray(make_blocks())
+    for positions in BLOCK_POSITIONS:
+        np.testing.assert_array_equal(dense[np.ix_(positions, positions)], FULL[np.ix_(positions, positions)])
+    assert dense[1, 4] == unreachable_cost
+
+
+def test_covers():
+    blocks = make_blocks()
+    assert blocks.covers([0, 2])
+    assert blocks.covers([4, 0])
+    assert not blocks.covers([1, 3])
+    assert not MatrixBlocks(5, []).covers([0])
+
+
+def test_pairs_not_held_raises():
+    with pytest.raises(ValueError):
+        make_blocks().pairs([0, 1], [1, 4])
@@ -0,0 +1,125 @@
+"""Tests the on-disk OSRM matrix cache"""
+import time
+
+import numpy as np
+
+import matrix_cache
+import osrmbindings
+
+LATITUDES = np.array([-1.30, -1.31, -1.32, -1.33])
+LONGITUDES = np.array([36.80, 36.81, 36.82, 36.83])
+
+
+def query(latitudes, longitudes):
+    """Durations, distances, snapped locations and snap distances from the stubbed OSRM."""
+    return osrmbindings.table_arrays('test', longitudes, latitudes)
+
+
+def empty(size):
+    return np.full((size, size), np.nan), np.full((size, size), np.nan), np.full((size, 2), np.nan), np.full(size, np.nan)
+
+
+def test_store_lookup_round_trip(tmp_path):
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    durations, distances, snapped, snap_distances = empty(3)
+    missing = cache.lookup(LATITUDES[:3], LONGITUDES[:3], durations, distances, snapped, snap_distances)
+    np.testing.assert_array_equal(missing, [0, 1, 2])
+    cache.store(LATITUDES[:3], LONGITUDES[:3], missing, *query(LATITUDES[:3], LONGITUDES[:3]))
+
+    #A new location only misses its own rows and columns, the rest comes back as stored
+    reopened = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    order = np.array([3, 2, 0, 1])
+    durations, distances, snapped, snap_distances = empty(4)
+    missing = reopened.lookup(LATITUDES[order], LONGITUDES[order], durations, distances, snapped, snap_distances)
+    np.testing.assert_array_equal(missing, [0])
+    expected = query(LATITUDES[order], LONGITUDES[order])
+    np.testing.assert_array_equal(durations[1:, 1:], expected[0][1:, 1:])
+    np.testing.assert_array_equal(distances[1:, 1:], expected[1][1:, 1:])
+    np.testing.assert_array_equal(snapped[1:], expected[2][1:])
+
+    reopened.store(LATITUDES[order], LONGITUDES[order], missing, *expected)
+    durations, distances, snapped, snap_distances = empty(4)
+    missing = reopened.lookup(LATITUDES[order], LONGITUDES[order], durations, distances, snapped, snap_distances)
+    assert len(missing) == 0
+    np.testing.assert_array_equal(durations, expected[0])
+    np.testing.assert_array_equal(distances, expected[1])
+
+
+def test_unsnapped_locations_are_not_stored(tmp_path):
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    durations, distances, snapped, snap_distances = query(LATITUDES, LONGITUDES)
+    snap_distances[1] = np.nan
+    cache.store(LATITUDES, LONGITUDES, np.arange(4), durations, distances, snapped, snap_distances)
+
+    missing = cache.lookup(LATITUDES, LONGITUDES, *empty(4))
+    np.testing.assert_array_equal(missing, [1])
+
+
+def test_evict_unused_locations(tmp_path):
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    cache.store(LATITUDES[:2], LONGITUDES[:2], np.arange(2), *query(LATITUDES[:2], LONGITUDES[:2]))
+    cache.store(LATITUDES[2:], LONGITUDES[2:], np.arange(2), *query(LATITUDES[2:], LONGITUDES[2:]))
+
+    cache.evict(time.time() + 1)
+    missing = cache.lookup(LATITUDES, LONGITUDES, *empty(4))
+    np.testing.assert_array_equal(missing, [0, 1, 2, 3])
+    assert list(tmp_path.glob('block*')) == []
+
+
+def test_disabled_by_default():
+    assert matrix_cache.get_cache('wheelbarrow') is None
+
+
+def test_evict_rewrites_partly_used_blocks(tmp_path):
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    cache.store(LATITUDES, LONGITUDES, np.arange(4), *query(LATITUDES, LONGITUDES))
+    with cache.connection:
+        cache.connection.execute('UPDATE points SET last_seen = 0 WHERE lat = ?', (int(round(LATITUDES[3] * 1e6)),))
+
+    reopened = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    durations, distances, snapped, snap_distances = empty(4)
+    missing = reopened.lookup(LATITUDES, LONGITUDES, durations, distances, snapped, snap_distances)
+    np.testing.assert_array_equal(missing, [3])
+    np.testing.assert_array_equal(durations[:3, :3], query(LATITUDES[:3], LONGITUDES[:3])[0])
+    assert np.load(tmp_path / 'block1_durations.npy').shape == (3, 3)
+
+
+def test_compact_keeps_values_and_what_was_not_computed(tmp_path):
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    durations, distances, snapped, snap_distances = query(LATITUDES[:2], LONGITUDES[:2])
+    durations[0, 1] = distances[0, 1] = np.nan # no route
+    cache.store(LATITUDES[:2], LONGITUDES[:2], np.arange(2), durations, distances, snapped, snap_distances)
+    cache.store(LATITUDES[2:], LONGITUDES[2:], np.arange(2), *query(LATITUDES[2:], LONGITUDES[2:]))
+
+    cache.compact()
+    assert len(cache._block_ids()) == 1
+    assert len(list(tmp_path.glob('block*'))) == len(matrix_cache.block_arrays)
+
+    looked_up = empty(2)
+    assert len(cache.lookup(LATITUDES[:2], LONGITUDES[:2], *looked_up)) == 0
+    np.testing.assert_array_equal(looked_up[0], durations)
+    #The pairs between the two stores were never queried
+    missing = cache.lookup(LATITUDES, LONGITUDES, *empty(4))
+    np.testing.assert_array_equal(missing, [0, 1, 2, 3])
+
+
+def test_repeated_stores_keep_lookups_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(matrix_cache, 'max_blocks', 4)
+    cache = matrix_cache.MatrixCache(str(tmp_path), 'key')
+    latitudes = -1.30 - 0.01 * np.arange(30)
+    longitudes = 36.80 + 0.01 * np.arange(30)
+    #Each run adds one location to the previous ones
+    for size in range(1, 31):
+        looked_up = empty(size)
+        missing = cache.lookup(latitudes[:size], longitudes[:size], *looked_up)
+        np.testing.assert_array_equal(missing, [size - 1])
+        cache.store(latitudes[:size], longitudes[:size], missing, *query(latitudes[:size], longitudes[:size]))
+        assert len(cache._block_ids()) <= matrix_cache.max_blocks
+
+    loaded = []
+    load_block = cache._load_block
+    monkeypatch.setattr(cache, '_load_block', lambda block_id: loaded.append(block_id) or load_block(block_id))
+    durations, distances, snapped, snap_distances = empty(30)
+    assert len(cache.lookup(latitudes, longitudes, durations, distances, snapped, snap_distances)) == 0
+    assert len(loaded) <= matrix_cache.max_blocks
+    np.testing.assert_array_equal(durations, query(latitudes, longitudes)[0])
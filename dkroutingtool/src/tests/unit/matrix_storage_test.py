@@ -0,0 +1,37 @@
+"""Tests how OSRM matrices are stored for the solver"""
+import numpy as np
+
+from build_time_dist_matrix import MatrixBlocks, compact_matrix, memmap_matrix, unreachable_cost
+
+
+def test_compact_matrix_truncates_to_int32():
+    matrix = np.array([[0.0, 12.9], [np.nan, 1e12]])
+    compacted = compact_matrix(matrix)
+    assert compacted.dtype == np.int32
+    np.testing.assert_array_equal(compacted, [[0, 12], [unreachable_cost, np.iinfo(np.int32).max]])
+
+
+def test_compact_matrix_blocks_and_none():
+    assert compact_matrix(None) is None
+    blocks = compact_matrix(MatrixBlocks(3, [(np.array([2, 0]), np.array([[0.5, np.inf], [7.2, 0.0]]))]))
+    assert isinstance(blocks, MatrixBlocks)
+    np.testing.assert_array_equal(blocks.select([2, 0]), [[0, unreachable_cost], [7, 0]])
+    assert blocks.select([0]).dtype == np.int32
+
+
+def test_memmap_matrix(tmp_path):
+    matrix = np.arange(9, dtype=np.int32).reshape(3, 3)
+    mapped = memmap_matrix(matrix, str(tmp_path / 'matrices' / 'time_matrix_truck'))
+    assert isinstance(mapped, np.memmap)
+    assert not mapped.flags.writeable
+    np.testing.assert_array_equal(mapped, matrix)
+    assert memmap_matrix(None, str(tmp_path / 'unused')) is None
+
+
+def test_memmap_matrix_one_file_per_block(tmp_path):
+    blocks = MatrixBlocks(4, [(np.array([0, 1]), np.array([[0, 1], [2, 0]], dtype=np.int32)),
+                              (np.array([3, 2]), np.array([[0, 5], [6, 0]], dtype=np.int32))])
+    mapped = memmap_matrix(blocks, str(tmp_path / 'time_matrix_truck'))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['time_matrix_truck_block0.npy', 'time_matrix_truck_block1.npy']
+    assert all(isinstance(block, np.memmap) for _, block in mapped.blocks)
+    np.testing.assert_array_equal(mapped.select([2, 3]), [[0, 6], [5, 0]])
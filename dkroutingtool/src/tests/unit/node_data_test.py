@@ -0,0 +1,128 @@
+"""Tests updating NodeData after nodes are added, removed or edited"""
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import build_time_dist_matrix
+from build_time_dist_matrix import NodeData, NodeLoader, OSRMMatrix, MatrixBlocks, compact_matrix
+
+PROFILE = 'wheelbarrow'
+
+
+def make_nodes(names, latitudes, longitudes, zones):
+    return pd.DataFrame({'type': 'Customer', 'name': names, 'lat_orig': latitudes, 'long_orig': longitudes,
+                         'closed': 0, 'zone': zones, 'buckets': 1})
+
+
+def fresh_matrices(df):
+    """Time and distance matrices as process_nodes would build them for the nodes."""
+    durations, distances, _, snapped_gps_coords, _ = NodeLoader.get_matrices(
+        df[['lat_orig', 'long_orig']].to_numpy(dtype=np.float64), PROFILE, consider_elevation=False, factor=None)
+    return compact_matrix(durations), compact_matrix(distances), snapped_gps_coords
+
+
+def make_node_data(df, blocks=None):
+    durations, distances, snapped_gps_coords = fresh_matrices(df)
+    if blocks is not None:
+        durations = MatrixBlocks(len(df), [(positions, durations[np.ix_(positions, positions)]) for positions in blocks])
+        distances = MatrixBlocks(len(df), [(positions, distances[np.ix_(positions, positions)]) for positions in blocks])
+    nodes = NodeData(df)
+    return NodeData(df, None, {PROFILE: OSRMMatrix(nodes, durations, snapped_gps_coords)},
+                    {PROFILE: OSRMMatrix(nodes, distances, snapped_gps_coords)})
+
+
+ORIGINAL = make_nodes(['a', 'b', 'c', 'd'], [-1.30, -1.31, -1.32, -1.33], [36.80, 36.81, 36.82, 36.83], ['East', 'East', 'West', 'West'])
+#'e' is new without containers, 'b' moved and 'c' is removed
+ADDED = make_nodes(['e', 'b'], [-1.34, -1.35], [36.84, 36.85], ['West', 'East']).assign(buckets=[0, 2])
+EXPECTED = pd.concat([ORIGINAL.iloc[[0, 3]], ADDED], ignore_index=True)
+
+
+def test_apply_delta_dense():
+    updated = make_node_data(ORIGINAL).apply_delta(added_df=ADDED, removed_names=['c'], num_containers_default=3)
+
+    assert list(updated.names) == ['a', 'd', 'e', 'b']
+    assert updated.get_attr('buckets').tolist() == [1, 1, 3, 2]
+    np.testing.assert_allclose(np.asarray(updated.lat_long_coords, dtype=np.float64),
+                               EXPECTED[['lat_orig', 'long_orig']].to_numpy(dtype=np.float64))
+    durations, distances, snapped_gps_coords = fresh_matrices(EXPECTED)
+    np.testing.assert_array_equal(updated.get_time_or_dist_mat(PROFILE, 'time'), durations)
+    np.testing.assert_array_equal(updated.get_time_or_dist_mat(PROFILE, 'dist'), distances)
+    np.testing.assert_allclose(updated.get_snapped_gps_coords(PROFILE), snapped_gps_coords)
+
+
+def test_apply_delta_blocks_by_zone():
+    updated = make_node_data(ORIGINAL, blocks=[np.array([0, 1]), np.array([2, 3])]).apply_delta(
+        added_df=ADDED, removed_names=['c'])
+
+    durations, _, _ = fresh_matrices(EXPECTED)
+    matrix = updated.get_time_or_dist_mat(PROFILE, 'time')
+    #Added nodes join the block of their zone: East is a, b and West is d, e
+    for positions in ([0, 3], [1, 2]):
+        np.testing.assert_array_equal(matrix.select(positions), durations[np.ix_(positions, positions)])
+    assert not matrix.covers([0, 1])
+
+
+def test_apply_delta_drops_unusable_added_nodes():
+    added = make_nodes(['f', 'g'], [-1.36, np.nan], [36.86, 36.87], ['East', 'East'])
+    added.loc[0, 'closed'] = 1
+    updated = make_node_data(ORIGINAL).apply_delta(added_df=added)
+
+    assert list(updated.names) == ['a', 'b', 'c', 'd']
+    assert set(updated.df_bad_gps_verbose['name']) == {'f', 'g'}
+
+
+def test_apply_delta_snaps_added_nodes_in_one_call(monkeypatch):
+    calls = []
+    def nearest_many(engine, longitudes, latitudes):
+        calls.append(len(longitudes))
+        return latitudes + 0.001, longitudes - 0.001, np.full(len(longitudes), 12.5)
+    monkeypatch.setattr(build_time_dist_matrix.osrmbindings, 'nearest_many', nearest_many)
+
+    updated = make_node_data(ORIGINAL).apply_delta(added_df=ADDED)
+
+    assert calls == [2]
+    added = updated.df_gps_verbose.set_index('name').loc[['e', 'b']]
+    np.testing.assert_allclose(added[f'lat_snapped_{PROFILE}'], ADDED['lat_orig'] + 0.001)
+    np.testing.assert_allclose(added[f'long_snapped_{PROFILE}'], ADDED['long_orig'] - 0.001)
+    np.testing.assert_allclose(added[f'snapped_dist_{PROFILE}'], [12.5, 12.5])
+
+
+def test_duplicated_names_are_all_filtered():
+    df = make_nodes(['a', 'b', 'c', 'b'], [-1.30, -1.31, -1.32, -1.33], [36.80, 36.81, 36.82, 36.83], ['East', 'East', 'West', 'West'])
+    node_data = make_node_data(df)
+    durations, _, _ = fresh_matrices(df)
+
+    filtered = node_data.filter_nodedata({'name': ['b']})
+    assert list(filtered.names) == ['b', 'b']
+    np.testing.assert_array_equal(filtered.get_time_or_dist_mat(PROFILE, 'time'), durations[np.ix_([1, 3], [1, 3])])
+    assert list(node_data.filter_nodedata({'start': 'b', 'zone': 'West'}).names) == ['b', 'c', 'b']
+
+    np.testing.assert_array_equal(node_data.rows_for_names(['c', 'a']), [2, 0])
+    with pytest.raises(ValueError, match="'b'"):
+        node_data.rows_for_names(['a', 'b'])
+
+
+def test_filtered_matrices_are_views():
+    node_data = make_node_data(ORIGINAL)
+    durations, _, snapped_gps_coords = fresh_matrices(ORIGINAL)
+    parent = node_data.veh_time_osrmmatrix_dict[PROFILE]
+
+    west = node_data.filter_nodedata({'zone': 'West'})
+    view = west.veh_time_osrmmatrix_dict[PROFILE]
+    assert view._matrix is parent._matrix and view._submatrix is None
+    assert view.shape == (2, 2)
+    np.testing.assert_array_equal(view.time_dist_mat, durations[np.ix_([2, 3], [2, 3])])
+
+    #Filtering a view keeps pointing at the parent matrix
+    d_only = west.filter_nodedata({'name': 'd'}).veh_time_osrmmatrix_dict[PROFILE]
+    assert d_only._matrix is parent._matrix
+    np.testing.assert_array_equal(d_only.time_dist_mat, durations[np.ix_([3], [3])])
+    np.testing.assert_allclose(d_only.snapped_gps_coords, snapped_gps_coords[[3]])
+    assert list(d_only.clean_nodes.names) == ['d']
+
+    #Pickling a view only keeps its own nodes
+    unpickled = pickle.loads(pickle.dumps(view))
+    assert unpickled._positions is None and unpickled._matrix.shape == (2, 2)
+    assert list(unpickled.clean_nodes.names) == ['c', 'd']
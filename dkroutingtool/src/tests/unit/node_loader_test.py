@@ -0,0 +1,116 @@
+"""Tests querying the OSRM matrices of nodes"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import osrmbindings
+from build_time_dist_matrix import NodeLoader
+from .osrm_stub import SPEED, stub_distance
+
+PROFILE = 'wheelbarrow'
+
+
+def expected_distances(coords):
+    return np.array([[stub_distance(lon1, lat1, lon2, lat2) for lat2, lon2 in coords] for lat1, lon1 in coords])
+
+
+def test_colocated_nodes_are_queried_once(monkeypatch):
+    queried_sizes = []
+    table_arrays = osrmbindings.table_arrays
+    def recording_table_arrays(engine, longitudes, latitudes, **kwargs):
+        queried_sizes.append(len(longitudes))
+        return table_arrays(engine, longitudes, latitudes, **kwargs)
+    monkeypatch.setattr(osrmbindings, 'table_arrays', recording_table_arrays)
+
+    #Nodes 0, 2 and 3 share a location (e.g. a depot and its unload copies)
+    coords = np.array([[-1.30, 36.80], [-1.31, 36.81], [-1.30, 36.80], [-1.30 + 1e-8, 36.80], [-1.32, 36.82]])
+    durations, distances, elevations, snapped_gps_coords, snapped_dists = NodeLoader.get_matrices(
+        coords, PROFILE, consider_elevation=False, factor=None)
+
+    assert queried_sizes == [3]
+    assert durations.shape == distances.shape == (5, 5)
+    np.testing.assert_allclose(distances, expected_distances(coords[[0, 1, 0, 0, 4]]))
+    np.testing.assert_allclose(durations, distances / SPEED)
+    assert elevations is None
+    np.testing.assert_allclose(snapped_gps_coords, coords[[0, 1, 0, 0, 4]])
+    np.testing.assert_array_equal(snapped_dists, np.zeros(5))
+
+
+def test_unsnappable_node_falls_back_to_nearest(monkeypatch):
+    #Locations north of 80 degrees can't be snapped: the table fails and nearest finds no road
+    table_arrays, nearest_many = osrmbindings.table_arrays, osrmbindings.nearest_many
+    def failing_table_arrays(engine, longitudes, latitudes, **kwargs):
+        if np.any(np.asarray(latitudes) > 80):
+            raise RuntimeError('Could not find a matching segment for any coordinate')
+        return table_arrays(engine, longitudes, latitudes, **kwargs)
+    def unsnapped_nearest_many(engine, longitudes, latitudes):
+        snapped_lats, snapped_lons, snapped_dists = nearest_many(engine, longitudes, latitudes)
+        snapped_dists[np.asarray(latitudes) > 80] = np.nan
+        return snapped_lats, snapped_lons, snapped_dists
+    monkeypatch.setattr(osrmbindings, 'table_arrays', failing_table_arrays)
+    monkeypatch.setattr(osrmbindings, 'nearest_many', unsnapped_nearest_many)
+
+    coords = np.array([[-1.30, 36.80], [85.0, 36.81], [-1.32, 36.82]])
+    durations, distances, _, snapped_gps_coords, snapped_dists = NodeLoader.get_matrices(
+        coords, PROFILE, consider_elevation=False, factor=None)
+
+    snappable = np.ix_([0, 2], [0, 2])
+    np.testing.assert_allclose(distances[snappable], expected_distances(coords[[0, 2]]))
+    np.testing.assert_allclose(durations[snappable], distances[snappable] / SPEED)
+    assert np.isnan(distances[1]).all() and np.isnan(distances[:, 1]).all()
+    assert np.isnan(durations[1]).all() and np.isnan(durations[:, 1]).all()
+    np.testing.assert_array_equal(np.isnan(snapped_dists), [False, True, False])
+    assert np.isnan(snapped_gps_coords[1]).all()
+
+
+def test_table_snaps_every_coordinate_of_a_sources_only_query():
+    longitudes, latitudes = np.array([36.80, 36.81, 36.82]), np.array([-1.30, -1.31, -1.32])
+    durations, distances, snapped, snap_distances = osrmbindings.table_arrays('test', longitudes, latitudes, sources=[1])
+    assert durations.shape == distances.shape == (1, 3)
+    np.testing.assert_allclose(snapped, np.column_stack([latitudes, longitudes]))
+    assert not np.isnan(snap_distances).any()
+
+    _, _, snapped, snap_distances = osrmbindings.table_arrays('test', longitudes, latitudes, sources=[1], destinations=[2])
+    np.testing.assert_array_equal(np.isnan(snap_distances), [True, False, False])
+
+
+def make_loader(names):
+    loader = NodeLoader.__new__(NodeLoader)
+    loader.df_gps_verbose = pd.DataFrame({'name': names})
+    loader.df_bad_gps_verbose = pd.DataFrame(columns=['name'])
+    return loader
+
+
+def snapping(snapped_dists):
+    size = len(snapped_dists)
+    matrix = np.arange(size * size, dtype=np.float64).reshape(size, size)
+    snapped_gps_coords = np.column_stack([np.arange(size), np.arange(size)]).astype(np.float64)
+    return matrix, matrix.copy(), None, snapped_gps_coords, np.asarray(snapped_dists, dtype=np.float64)
+
+
+def test_clean_snapped_nodes_removes_unsnappable_nodes():
+    loader = make_loader(['a', 'b', 'c'])
+    veh_matrices = loader.clean_snapped_nodes({'truck': snapping([1.0, np.nan, 2.0]), PROFILE: snapping([1.0, np.nan, np.nan])})
+
+    assert list(loader.df_gps_verbose['name']) == ['a', 'c']
+    assert list(loader.df_bad_gps_verbose['name']) == ['b']
+    durations, _, _, snapped_gps_coords, snapped_dists = veh_matrices['truck']
+    np.testing.assert_array_equal(durations, [[0, 2], [6, 8]])
+    np.testing.assert_array_equal(snapped_dists, [1.0, 2.0])
+
+
+def test_clean_snapped_nodes_only_tolerates_data_errors(monkeypatch):
+    def rules_raising(error):
+        def rule(df):
+            raise error
+        return lambda df, profiles, max_dist: [('Removed - Broken', True, rule)]
+
+    monkeypatch.setattr(NodeLoader, 'get_snapping_rules', staticmethod(rules_raising(KeyError('snapped_dist_truck'))))
+    loader = make_loader(['a', 'b'])
+    veh_matrices = {'truck': snapping([1.0, np.nan])}
+    assert loader.clean_snapped_nodes(veh_matrices) is veh_matrices
+    assert list(loader.df_gps_verbose['name']) == ['a', 'b']
+
+    monkeypatch.setattr(NodeLoader, 'get_snapping_rules', staticmethod(rules_raising(TypeError('bug'))))
+    with pytest.raises(TypeError):
+        make_loader(['a', 'b']).clean_snapped_nodes({'truck': snapping([1.0, np.nan])})
@@ -0,0 +1,74 @@
+"""Tests keeping OSRM engines resident and querying them from threads"""
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+import osrm_engines
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Dataset paths osrmbindings.initialize is called with, starting from no resident engines."""
+    loaded = []
+    def initialize(filepath):
+        loaded.append(filepath)
+        return object()
+    monkeypatch.setattr(osrm_engines.osrmbindings, 'initialize', initialize)
+    monkeypatch.setattr(osrm_engines, '_engines', OrderedDict())
+    return loaded
+
+
+def test_engines_are_reused(loads):
+    engine = osrm_engines.get_engine('truck')
+    assert osrm_engines.get_engine('truck') is engine
+    assert loads == [osrm_engines.dataset_path('truck')]
+
+
+def test_least_recently_used_engine_is_released(loads, monkeypatch):
+    monkeypatch.setattr(osrm_engines, 'max_resident_engines', 2)
+    truck = osrm_engines.get_engine('truck')
+    osrm_engines.get_engine('wheelbarrow')
+    assert osrm_engines.get_engine('truck') is truck
+
+    #Loading a third profile releases wheelbarrow, used less recently than truck
+    osrm_engines.get_engine('foot')
+    assert list(osrm_engines._engines) == ['truck', 'foot']
+    assert osrm_engines.get_engine('truck') is truck
+    osrm_engines.get_engine('wheelbarrow')
+    assert loads == [osrm_engines.dataset_path(profile) for profile in ('truck', 'wheelbarrow', 'foot', 'wheelbarrow')]
+    assert list(osrm_engines._engines) == ['truck', 'wheelbarrow']
+
+
+def test_no_limit_keeps_every_engine(loads, monkeypatch):
+    monkeypatch.setattr(osrm_engines, 'max_resident_engines', 0)
+    for profile in ('truck', 'wheelbarrow', 'foot', 'bicycle', 'car'):
+        osrm_engines.get_engine(profile)
+    assert len(osrm_engines._engines) == 5
+    for profile in ('truck', 'wheelbarrow', 'foot', 'bicycle', 'car'):
+        osrm_engines.get_engine(profile)
+    assert len(loads) == 5
+
+
+def test_map_queries_keeps_order_across_threads(monkeypatch):
+    monkeypatch.setattr(osrm_engines, 'query_threads', 4)
+    threads = set()
+    def query(item):
+        threads.add(threading.get_ident())
+        time.sleep(0.01 * (item % 3))
+        return item * item
+
+    assert osrm_engines.map_queries(query, range(12)) == [item * item for item in range(12)]
+    assert len(threads) > 1
+
+
+def test_map_queries_single_thread(monkeypatch):
+    monkeypatch.setattr(osrm_engines, 'query_threads', 1)
+    threads = set()
+    def query(item):
+        threads.add(threading.get_ident())
+        return -item
+
+    assert osrm_engines.map_queries(query, iter([3, 1, 2])) == [-3, -1, -2]
+    assert threads == {threading.get_ident()}
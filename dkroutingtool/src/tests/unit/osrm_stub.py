@@ -0,0 +1,68 @@
+"""Straight-line stand-in for the native osrmbindings module, so the unit tests
+run without OSRM datasets. conftest installs it as osrmbindings.
+"""
+import math
+import sys
+import types
+
+import numpy as np
+
+SPEED = 5.0 # meters per second of the stub's routes
+
+
+def stub_distance(lon1, lat1, lon2, lat2):
+    """Distance in meters the stub uses between two locations."""
+    x = (lon2 - lon1) * 111320 * math.cos(math.radians(lat1))
+    y = (lat2 - lat1) * 110540
+    return math.hypot(x, y)
+
+
+def _initialize(filepath):
+    return filepath
+
+
+def _table_arrays(handle, longitudes, latitudes, sources=None, destinations=None):
+    """Mirrors the native binding: the response holds one waypoint per source and per
+    destination, a side left as None being every coordinate, and only those are snapped."""
+    osrmbindings.calls['table_arrays'] += 1
+    size = len(longitudes)
+    source_positions = list(range(size)) if sources is None else list(sources)
+    destination_positions = list(range(size)) if destinations is None else list(destinations)
+    distances = np.array([[stub_distance(longitudes[i], latitudes[i], longitudes[j], latitudes[j]) for j in destination_positions]
+                          for i in source_positions], dtype=np.float64).reshape(len(source_positions), len(destination_positions))
+    snapped = np.full((size, 2), np.nan)
+    snap_distances = np.full(size, np.nan)
+    for waypoints in (destination_positions, source_positions):
+        for index in waypoints:
+            snapped[index] = latitudes[index], longitudes[index]
+            snap_distances[index] = 0.0
+    return distances / SPEED, distances, snapped, snap_distances
+
+
+def _nearest_many(handle, longitudes, latitudes):
+    osrmbindings.calls['nearest_many'] += 1
+    return (np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64),
+            np.zeros(len(longitudes)))
+
+
+def _route_many(handle, longitudes, latitudes, steps=False, overview='full', annotations=False, threads=0):
+    routes = []
+    for lons, lats in zip(longitudes, latitudes):
+        distance = sum(stub_distance(lons[i], lats[i], lons[i + 1], lats[i + 1]) for i in range(len(lons) - 1))
+        routes.append({'geometry': np.column_stack([lons, lats]).astype(np.float64),
+                       'duration': distance / SPEED, 'distance': distance})
+    return routes
+
+
+osrmbindings = types.ModuleType('osrmbindings')
+osrmbindings.calls = {'table_arrays': 0, 'nearest_many': 0}
+osrmbindings.initialize = _initialize
+osrmbindings.loaded_engines = lambda: []
+osrmbindings.table_arrays = _table_arrays
+osrmbindings.nearest_many = _nearest_many
+osrmbindings.route_many = _route_many
+
+
+def install():
+    """Installs the stub as osrmbindings, also used to set up the worker processes tests spawn."""
+    sys.modules['osrmbindings'] = osrmbindings
@@ -0,0 +1,72 @@
+"""Tests solving the zones of a run in worker processes"""
+import concurrent.futures
+import functools
+
+import numpy as np
+import pandas as pd
+
+import optimization
+from build_time_dist_matrix import NodeData, NodeLoader, OSRMMatrix, compact_matrix
+from . import osrm_stub
+
+PROFILE = 'wheelbarrow'
+
+
+def make_node_data():
+    #A depot shared by two zones of four customers
+    df = pd.DataFrame({'type': ['Start'] + ['Customer'] * 8, 'name': ['depot'] + [f'customer {i}' for i in range(8)],
+                       'lat_orig': [-1.300, -1.301, -1.305, -1.309, -1.302, -1.291, -1.296, -1.292, -1.298],
+                       'long_orig': [36.800, 36.803, 36.801, 36.806, 36.809, 36.794, 36.791, 36.797, 36.793],
+                       'closed': 0, 'zone': ['Depot'] + ['East'] * 4 + ['West'] * 4, 'buckets': [0, 1, 2, 1, 2, 2, 1, 1, 2],
+                       'time_windows': np.nan})
+    durations, distances, _, snapped_gps_coords, _ = NodeLoader.get_matrices(
+        df[['lat_orig', 'long_orig']].to_numpy(dtype=np.float64), PROFILE, consider_elevation=False, factor=None)
+    nodes = NodeData(df)
+    return NodeData(df, None, {PROFILE: OSRMMatrix(nodes, compact_matrix(durations), snapped_gps_coords)},
+                    {PROFILE: OSRMMatrix(nodes, compact_matrix(distances), snapped_gps_coords)})
+
+
+def make_config(parallel_zones):
+    zone_configs = [{'optimized_region': [zone], 'Start_Point': ['depot'], 'End_Point': ['depot'], 'load_time': 1,
+                     'trips_vehicle_profile': [[PROFILE, 3]], 'enable_unload': False, 'unload_vehicles': []}
+                    for zone in ['East', 'West']]
+    return {'zone_configs': zone_configs,
+            'global_solver_options': {'max_solver_time_min': 1, 'fast_run': True, 'parallel_zones': parallel_zones}}
+
+
+def summary(solution):
+    routes = {key: {name: value for name, value in route.items() if name != 'route'} for key, route in solution.route_dict.items()}
+    return routes, {key: vehicle.name for key, vehicle in solution.vehicles.items()}, solution.zone_route_map
+
+
+def test_parallel_zones_match_the_sequential_solution(monkeypatch):
+    #The spawned workers import osrmbindings before solving, so they get the stub first
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor',
+                        functools.partial(concurrent.futures.ProcessPoolExecutor, initializer=osrm_stub.install))
+    monkeypatch.setattr(optimization, 'parallel_zone_workers', 2)
+    monkeypatch.setattr(optimization, 'resequencing', False)
+    node_data = make_node_data()
+
+    sequential = summary(optimization.solve(node_data, make_config(parallel_zones=False)))
+    assert sequential[2] == {'East': [0, 1], 'West': [2, 3]}
+    for _ in range(2):
+        assert summary(optimization.solve(node_data, make_config(parallel_zones=True))) == sequential
+
+
+def test_zone_workers_get_the_run_settings(monkeypatch):
+    #Restored after the test, solve_zone_in_process sets them
+    for name in optimization.worker_settings:
+        monkeypatch.setattr(optimization, name, getattr(optimization, name))
+    seen = {}
+    def recording_solve_zone(node_data, this_config, global_solver_options):
+        seen['settings'] = {name: getattr(optimization, name) for name in ['resequencing', 'default_load_time_mins', 'portfolio_workers']}
+        seen['past_adjustments'] = node_data.past_adjustments
+    monkeypatch.setattr(optimization, 'solve_zone', recording_solve_zone)
+
+    settings = {name: getattr(optimization, name) for name in optimization.worker_settings}
+    settings.update(resequencing=False, default_load_time_mins=4, portfolio_workers=2)
+    past_adjustments = pd.DataFrame({'route': [0], 'node_name': ['customer 0']})
+    optimization.solve_zone_in_process(make_node_data(), make_config(parallel_zones=True)['zone_configs'][0], {}, settings, past_adjustments)
+
+    assert seen['settings'] == {'resequencing': False, 'default_load_time_mins': 4, 'portfolio_workers': 2}
+    assert seen['past_adjustments'] is past_adjustments
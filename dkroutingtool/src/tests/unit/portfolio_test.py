@@ -0,0 +1,58 @@
+"""Tests solving a zone with a portfolio of search configurations"""
+import concurrent.futures
+import functools
+import logging
+import re
+
+import optimization
+from . import osrm_stub
+from .parallel_zones_test import make_config, make_node_data
+
+
+def make_problem():
+    #One zone of the parallel zones test, solved by a single vehicle
+    node_data = make_node_data()
+    this_config = make_config(parallel_zones=False)['zone_configs'][0]
+    this_config['trips_vehicle_profile'] = [[this_config['trips_vehicle_profile'][0][0], 10]]
+    node_data_filtered = node_data.filter_nodedata(node_data.get_zone_config_filter(this_config), filter_name_str='multiple_sample')
+    vehicles = optimization.create_vehicle(node_data_filtered, this_config)
+    return optimization.DataProblem(node_data_filtered, vehicles, this_config), vehicles
+
+
+def route_cost(routing, assignment):
+    cost = 0
+    for vehicle in range(routing.vehicles()):
+        index = routing.Start(vehicle)
+        while not routing.IsEnd(index):
+            next_index = assignment.Value(routing.NextVar(index))
+            cost += routing.GetArcCostForVehicle(index, next_index, vehicle)
+            index = next_index
+    return cost
+
+
+def test_lowest_cost_configuration_is_chosen_and_reported(monkeypatch, caplog):
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor',
+                        functools.partial(concurrent.futures.ProcessPoolExecutor, initializer=osrm_stub.install))
+    monkeypatch.setattr(optimization, 'portfolio_workers', 2)
+    #The configuration solved in this process stops at its first solution, visiting the nodes in index order
+    apply_search_configuration = optimization.apply_search_configuration
+    def first_solution_only(routing, search_parameters, search_configuration):
+        apply_search_configuration(routing, search_parameters, search_configuration)
+        search_parameters.solution_limit = 1
+    monkeypatch.setattr(optimization, 'apply_search_configuration', first_solution_only)
+    portfolio = [{'first_solution_strategy': 'FIRST_UNBOUND_MIN_VALUE'},
+                 {'first_solution_strategy': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'}]
+    data, vehicles = make_problem()
+
+    with caplog.at_level(logging.INFO):
+        assignment, manager, routing = optimization.get_optimal_route(data, vehicles, max_solver_time_min=1, portfolio=portfolio,
+                                                                      early_stopping_solutions=50)
+
+    costs = {message: int(cost) for message, cost in re.findall(r'Portfolio (configuration .*): cost (\d+)', caplog.text)}
+    assert len(costs) == 2
+    first_cost, best_cost = costs[f'configuration {portfolio[0]}'], costs[f'configuration {portfolio[1]}']
+    assert best_cost < first_cost
+    assert f'Portfolio winner: {portfolio[1]} with cost {best_cost}' in caplog.text
+    assert assignment.ObjectiveValue() == route_cost(routing, assignment) == best_cost
+    routes = optimization.get_routes(routing, data, assignment, manager)
+    assert sorted(node for route in routes for node in route) == sorted(set(range(data.num_locations)) - {0})
@@ -0,0 +1,45 @@
+"""Tests computing the road geometry of solved routes"""
+import types
+
+import numpy as np
+import pandas as pd
+
+import optimization
+from build_time_dist_matrix import NodeData
+
+LOCATIONS = [(-1.30, 36.80), (-1.31, 36.81), (-1.32, 36.82), (-1.33, 36.83), (-1.34, 36.84)]
+
+
+def test_failed_routes_are_none(monkeypatch):
+    route_many = optimization.osrmbindings.route_many
+    def failing_route_many(engine, longitudes, latitudes, **kwargs):
+        #Routes through node 3 fail
+        routes = route_many(engine, longitudes, latitudes, **kwargs)
+        return [None if LOCATIONS[3][1] in lons else route for lons, route in zip(longitudes, routes)]
+    monkeypatch.setattr(optimization.osrmbindings, 'route_many', failing_route_many)
+
+    #Vehicles start and end at node 0, the second one is unused
+    data = types.SimpleNamespace(_locations=LOCATIONS, all_start_points=[0, 0, 0], all_end_points=[0, 0, 0])
+    routes_all = optimization.produce_temporary_routes([[1, 2], [], [3, 4]], ['wheelbarrow'] * 3, data)
+
+    assert sorted(routes_all) == [0, 1, 2]
+    np.testing.assert_allclose(routes_all[0]['geometry'], [[36.80, -1.30], [36.81, -1.31], [36.82, -1.32], [36.80, -1.30]])
+    assert routes_all[1] == []
+    assert routes_all[2] is None
+
+
+class ReadRoutes:
+    """Routing model standing in for the solver, returns the routes it is asked to read."""
+    def ReadAssignmentFromRoutes(self, routes, ignore_inactive_indices):
+        return routes
+
+
+def test_resequence_keeps_routes_without_geometry():
+    names = ['depot', 'a', 'b', 'c', 'd']
+    node_data = NodeData(pd.DataFrame({'type': 'Customer', 'name': names, 'lat_orig': [lat for lat, _ in LOCATIONS],
+                                       'long_orig': [lon for _, lon in LOCATIONS], 'closed': 0, 'zone': 'East', 'buckets': 1}))
+    data = types.SimpleNamespace(nodes_to_names=dict(enumerate(names)), _boolean_selected=np.arange(5))
+    original_routes = [[2, 1], [4, 3]]
+
+    routes = optimization.resequence(node_data, data, ReadRoutes(), {0: None, 1: None}, original_routes, ['wheelbarrow'] * 2)
+    assert routes == original_routes